@@ -2,7 +2,7 @@ import yaml
 import os
 import logging
 
-from triggerflow.service.worker import Worker
+from triggerflow.service import build_worker
 
 CONFIG_MAP_PATH = 'config_map.yaml'
 
@@ -21,6 +21,6 @@ if __name__ == '__main__':
     workspace = os.environ['TRIGGERFLOW_BOOTSTRAP_WORKSPACE']
 
     logging.info('Starting Triggerflow Worker for workspace {}'.format(workspace))
-    worker = Worker(workspace=workspace, config=config_map)
+    worker = build_worker(workspace, config_map)
     worker.start()
     worker.join()
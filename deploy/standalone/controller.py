@@ -2,17 +2,25 @@ import logging
 import os
 import signal
 import yaml
-from flask import Flask, jsonify
+from multiprocessing import Queue
+from flask import Flask, jsonify, Response
 from gevent.pywsgi import WSGIServer
-from triggerflow.service import storage
+from triggerflow.service import storage, build_worker
 from triggerflow.service.worker import Worker
+from triggerflow.service.metrics import MetricsAggregator
+from triggerflow.service.host import WorkerHost
 
 app = Flask(__name__)
 app.debug = False
 
 workers = {}
+# Serves all the workspaces when the worker host mode is configured
+host = None
+hosted_workspaces = set()
 config_map = None
 trigger_storage = None
+metrics_queue = Queue()
+metrics = MetricsAggregator(metrics_queue)
 
 CONFIG_MAP_PATH = 'config_map.yaml'
 
@@ -24,11 +32,19 @@ def create_worker(workspace):
     if not trigger_storage.workspace_exists(workspace):
         return jsonify({'error': 'Workspace {} does not exist in the database'.format(workspace)}), 400
 
+    if host is not None:
+        if workspace in hosted_workspaces:
+            return jsonify({'error': 'Workspace {} is already created'.format(workspace)}), 400
+        logging.info('Starting {} workspace in worker host'.format(workspace))
+        host.start_workspace(workspace)
+        hosted_workspaces.add(workspace)
+        return jsonify({'workspace': workspace}), 201
+
     if workspace in workers and workers[workspace].state == Worker.State.RUNNING:
         return jsonify({'error': 'Workspace {} is already created'.format(workspace)}), 400
 
     logging.info('Starting {} workspace'.format(workspace))
-    workers[workspace] = Worker(workspace, config_map)
+    workers[workspace] = build_worker(workspace, config_map, metrics_queue=metrics_queue)
     workers[workspace].start()
 
     return jsonify({'workspace': workspace}), 201
@@ -39,6 +55,14 @@ def delete_worker(workspace):
     logging.info('New request to delete workspace {}'.format(workspace))
     global workers
 
+    if host is not None:
+        if workspace not in hosted_workspaces:
+            return jsonify({'error': 'Workspace {} is not active'.format(workspace)}), 400
+        host.delete_workspace(workspace)
+        hosted_workspaces.discard(workspace)
+        metrics.forget(workspace)
+        return jsonify('Workspace {} deleted'.format(workspace)), 200
+
     if workspace not in workers:
         return jsonify({'error': 'Workspace {} is not active'.format(workspace)}), 400
 
@@ -49,9 +73,18 @@ def delete_worker(workspace):
         workers[workspace].kill()
 
     del workers[workspace]
+    metrics.forget(workspace)
     return jsonify('Workspace {} deleted'.format(workspace)), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Metrics of all the workers, in the Prometheus text exposition format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # Create process group
     os.setpgrp()
@@ -90,9 +123,20 @@ if __name__ == '__main__':
     server = WSGIServer(('', port), app, log=logging.getLogger())
     logging.info('Triggerflow service started on port {}'.format(port))
 
+    # Keep the last metrics snapshot of each worker, whether or not they are scraped
+    metrics.start()
+
     active_workspaces = trigger_storage.list_workspaces()
+    if (config_map.get('worker') or {}).get('host'):
+        logging.info('Starting worker host')
+        host = WorkerHost(config_map, metrics_queue=metrics_queue)
+        host.start()
+        for active_workspace in active_workspaces:
+            host.start_workspace(active_workspace)
+            hosted_workspaces.add(active_workspace)
+        active_workspaces = []
     for active_workspace in active_workspaces:
-        workers[active_workspace] = Worker(active_workspace, config_map)
+        workers[active_workspace] = build_worker(active_workspace, config_map, metrics_queue=metrics_queue)
         workers[active_workspace].start()
 
     try:
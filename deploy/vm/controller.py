@@ -3,11 +3,13 @@ import os
 import signal
 import yaml
 import time
-from flask import Flask, jsonify, request
+from multiprocessing import Queue
+from flask import Flask, jsonify, request, Response
 from gevent.pywsgi import WSGIServer
-from triggerflow.service import storage
+from triggerflow.service import storage, build_worker
 from triggerflow.service.worker import Worker
-from triggerflow import eventsources
+from triggerflow.service.metrics import MetricsAggregator
+from uuid import uuid4
 import threading
 
 app = Flask(__name__)
@@ -17,6 +19,8 @@ workers = {}
 monitors = {}
 config_map = None
 trigger_storage = None
+metrics_queue = Queue()
+metrics = MetricsAggregator(metrics_queue)
 
 CONFIG_MAP_PATH = 'config_map.yaml'
 
@@ -86,7 +90,7 @@ def start_worker(workspace):
 
     if workspace not in workers or not workers[workspace].is_alive():
         logging.info('Starting {} workspace'.format(workspace))
-        workers[workspace] = Worker(workspace, config_map)
+        workers[workspace] = build_worker(workspace, config_map, metrics_queue=metrics_queue)
         workers[workspace].start()
 
 
@@ -103,6 +107,7 @@ def delete_worker(workspace):
                 workers[workspace].stop_worker()
             del workers[workspace]
         del monitors[workspace]
+        metrics.forget(workspace)
         return jsonify('Workspace {} deleted'.format(workspace)), 200
 
 
@@ -113,21 +118,33 @@ def timeout(workspace):
     if timeout_data is None:
         return jsonify('Parameters error'), 400
 
-    def _timeout(timeout_data):
-        logging.debug('Starting event source instance')
-        logging.debug(timeout_data)
-        event_source_class = getattr(eventsources, '{}'.format(timeout_data['event_source']['class']))
-        event_source = event_source_class(**timeout_data['event_source']['parameters'])
-        time.sleep(timeout_data['seconds'])
-        timeout_data['event']['type'] = 'event.triggerflow.timeout'
-        event_source.publish_cloudevent(timeout_data['event'])
-        logging.debug('Event {} sent after {} secodns'.format(timeout_data['event'], timeout_data['seconds']))
+    # Timers are stored in the timeouts document and fired by the timer service of the workspace worker
+    timer_id = timeout_data.get('timer_id') or uuid4().hex
+    timer = {'event': timeout_data['event'], 'deadline': time.time() + float(timeout_data['seconds'])}
+    if timeout_data.get('cancel_subject'):
+        timer['cancel_subject'] = timeout_data['cancel_subject']
+    trigger_storage.set_key(workspace=workspace, document_id='timeouts', key=timer_id, value=timer)
+    logging.debug('Timeout {} set for workspace {}'.format(timer_id, workspace))
 
-    timeout_thread = threading.Thread(target=_timeout, args=(timeout_data.copy(),))
-    timeout_thread.start()
-    logging.debug('Timeout set for workspace {}'.format(workspace))
+    return jsonify({'timer_id': timer_id}), 201
 
-    return jsonify('Timeout set'.format(workspace)), 201
+
+@app.route('/workspace/<workspace>/timeout/<timer_id>', methods=['DELETE'])
+def cancel_timeout(workspace, timer_id):
+    if not trigger_storage.key_exists(workspace=workspace, document_id='timeouts', key=timer_id):
+        return jsonify('Timeout {} not found'.format(timer_id)), 404
+    trigger_storage.delete_key(workspace=workspace, document_id='timeouts', key=timer_id)
+    logging.debug('Timeout {} cancelled for workspace {}'.format(timer_id, workspace))
+
+    return jsonify('Timeout {} cancelled'.format(timer_id)), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Metrics of all the workers, in the Prometheus text exposition format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 def main():
@@ -170,6 +187,9 @@ def main():
     server = WSGIServer(('', port), app, log=logging.getLogger())
     logging.info('Triggerflow service started on port {}'.format(port))
 
+    # Keep the last metrics snapshot of each worker, whether or not they are scraped
+    metrics.start()
+
     workspaces = trigger_storage.list_workspaces()
     for wsp in workspaces:
         start_worker(wsp)
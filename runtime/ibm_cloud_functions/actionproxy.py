@@ -307,6 +307,9 @@ def produce_termination_event(tf_data, env, success, result):
              'subject': subject,
              'datacontenttype': 'application/json',
              'data': json.dumps(result)}
+    if tf_data.get('traceparent'):
+        # Continue the trace of the action that invoked the function
+        event['traceparent'] = tf_data['traceparent']
 
     if sink_class == 'KafkaEventSource':
         config = {'bootstrap.servers': ','.join(sink_params['broker_list'])}
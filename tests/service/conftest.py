@@ -0,0 +1,48 @@
+import pytest
+
+
+class RecordingQueue(list):
+    """
+    Event queue stub that keeps the events put in it
+    """
+
+    def put(self, event):
+        self.append(event)
+
+    def qsize(self):
+        return len(self)
+
+
+def make_trigger(trigger_id, subjects, condition='TRUE', action='PASS', context=None, event_type='t'):
+    return {'id': trigger_id, 'condition': {'name': condition}, 'action': {'name': action}, 'context': context or {},
+            'activation_events': [{'subject': subject, 'type': event_type} for subject in subjects],
+            'transient': False, 'uuid': trigger_id, 'workspace': 'ws', 'timestamp': ''}
+
+
+def make_event(subject, event_id, event_type='t'):
+    return {'specversion': '1.0', 'id': event_id, 'source': 's', 'subject': subject, 'type': event_type,
+            'event_source': 'src'}
+
+
+@pytest.fixture
+def trigger():
+    """
+    Factory of trigger documents of workspace `ws` activated by the events of `subjects`
+    """
+    return make_trigger
+
+
+@pytest.fixture
+def event():
+    """
+    Factory of CloudEvents received from the `src` event source
+    """
+    return make_event
+
+
+@pytest.fixture
+def recording_queue():
+    """
+    Factory of `RecordingQueue`s
+    """
+    return RecordingQueue
@@ -0,0 +1,59 @@
+import pytest
+
+from triggerflow.service.conditions.asf_conditions import (compile_rule, compiled_rule,
+                                                            condition_aws_asf_condition)
+
+DATA = {'value': 5, 'name': 'log-2020.txt', 'flag': True, 'none': None, 'items': [{'n': 1}, {'n': 2}],
+        'time': '2020-01-01T00:00:00Z', 'later': '2020-01-02T00:00:00+00:00', 'limit': 10}
+
+
+def matches(rule):
+    return compile_rule(rule)(DATA)
+
+
+@pytest.mark.parametrize('rule, expected', [
+    ({'Variable': '$.value', 'NumericEquals': 5}, True),
+    ({'Variable': '$.value', 'NumericGreaterThan': 5}, False),
+    ({'Variable': '$.value', 'NumericLessThanEquals': 5}, True),
+    ({'Variable': '$.name', 'StringEquals': 'log-2020.txt'}, True),
+    ({'Variable': '$.name', 'StringLessThan': 'm'}, True),
+    ({'Variable': '$.flag', 'BooleanEquals': False}, False),
+    ({'Variable': '$.time', 'TimestampLessThan': '2020-01-01T12:00:00Z'}, True),
+    ({'Variable': '$.later', 'TimestampGreaterThanEquals': '2020-01-02T00:00:00Z'}, True),
+    ({'Variable': '$.value', 'NumericLessThanPath': '$.limit'}, True),
+    ({'Variable': '$.time', 'TimestampGreaterThanPath': '$.later'}, False),
+    ({'Variable': '$.value', 'NumericEqualsPath': '$.missing'}, False),
+    ({'Variable': '$.items[*].n', 'NumericGreaterThan': 0}, True),
+    ({'Variable': '$.items[*].n', 'NumericGreaterThan': 1}, False),
+    ({'Variable': '$.none', 'IsNull': True}, True),
+    ({'Variable': '$.flag', 'IsNumeric': True}, False),
+    ({'Variable': '$.value', 'IsNumeric': True}, True),
+    ({'Variable': '$.time', 'IsTimestamp': True}, True),
+    ({'Variable': '$.name', 'IsTimestamp': False}, True),
+    ({'Variable': '$.missing', 'IsPresent': False}, True),
+    ({'Variable': '$.name', 'StringMatches': 'log-*.txt'}, True),
+    ({'Variable': '$.name', 'StringMatches': 'log-\\*'}, False),
+])
+def test_comparisons(rule, expected):
+    assert matches(rule) is expected
+
+
+def test_boolean_rules():
+    low = {'Variable': '$.value', 'NumericLessThan': 3}
+    high = {'Variable': '$.value', 'NumericGreaterThan': 3}
+    assert matches({'Not': low})
+    assert not matches({'And': [low, high]})
+    assert matches({'Or': [low, high]})
+    assert matches({'And': [{'Not': low}, {'Or': [low, high]}]})
+
+
+def test_unsupported_rule():
+    with pytest.raises(ValueError):
+        compile_rule({'Variable': '$.value', 'Unknown': 1})
+
+
+def test_compiled_rules_are_reused():
+    condition = {'Variable': '$.value', 'NumericEquals': 5}
+    assert compiled_rule(condition) is compiled_rule(condition)
+    assert condition_aws_asf_condition({'Condition': condition}, {'data': DATA})
+    assert condition_aws_asf_condition({}, {'data': DATA})
@@ -0,0 +1,66 @@
+import time
+import asyncio
+
+import pytest
+
+from triggerflow.service import actions
+from triggerflow.service.async_worker import AsyncWorker
+
+
+def test_dag_join_waits_for_the_actions_updating_its_counters(monkeypatch, trigger, event, recording_queue):
+    def action_slow_dag_dummy_task(context, event):
+        # The termination events of the task arrive before its action has updated the join counters
+        time.sleep(0.1)
+        actions.action_dag_dummy_task(context, event)
+
+    monkeypatch.setattr(actions, 'action_slow_dag_dummy_task', action_slow_dag_dummy_task, raising=False)
+    success = 'event.triggerflow.termination.success'
+
+    async def run():
+        worker = AsyncWorker('ws', {})
+        worker._AsyncWorker__checkpoint_requested = asyncio.Event()
+        worker._AsyncWorker__context_released = asyncio.Condition()
+        worker.local_event_queue = emitted = recording_queue()
+        for task in ('a', 'b'):
+            worker._AsyncWorker__load_trigger(task, trigger(task, ['__init__'], action='SLOW_DAG_DUMMY_TASK',
+                                                            context={'subject': task},
+                                                            event_type='event.triggerflow.init'))
+        worker._AsyncWorker__load_trigger('join', trigger('join', ['a', 'b'], condition='DAG_TASK_JOIN',
+                                                          action='DAG_DUMMY_TASK',
+                                                          context={'subject': 'end', 'result': [],
+                                                                   'dependencies': {'a': {'join': -1, 'counter': 0},
+                                                                                    'b': {'join': -1, 'counter': 0}}},
+                                                          event_type=success))
+
+        worker._AsyncWorker__match_event(event('__init__', '0', event_type='event.triggerflow.init'))
+        worker._AsyncWorker__match_event(event('a', '1', event_type=success))
+        worker._AsyncWorker__match_event(event('b', '2', event_type=success))
+        tasks = worker._AsyncWorker__tasks
+        while tasks:
+            await asyncio.gather(*list(tasks))
+        return worker, emitted
+
+    worker, emitted = asyncio.run(run())
+
+    # The actions of the two tasks run on executor threads in any order
+    assert sorted(e['subject'] for e in emitted[:2]) == ['a', 'b'] and emitted[2]['subject'] == 'end'
+    assert worker.triggers['join'].context['dependencies'] == {'a': {'join': 1, 'counter': 1},
+                                                               'b': {'join': 1, 'counter': 1}}
+    assert len(worker.events) == 0
+
+
+def test_dedup_is_rejected():
+    with pytest.raises(ValueError):
+        AsyncWorker('ws', {'worker': {'dedup': {'enabled': True}}})
+
+
+def test_worker_only_settings_are_reported(caplog):
+    AsyncWorker('ws', {'worker': {'batch_size': 1, 'shards': 1, 'action_threads': 0, 'event_queue': {'class': 'Queue'},
+                                  'process_pool_size': 2}})
+    assert 'not supported' not in caplog.text
+
+    AsyncWorker('ws', {'worker': {'batch_size': 100, 'lanes': True, 'snapshot_dir': '/tmp',
+                                  'event_queue': {'class': 'SharedMemoryEventQueue'}}})
+    assert all('worker.{} is not supported'.format(key) in caplog.text
+               for key in ('batch_size', 'lanes', 'snapshot_dir', 'event_queue'))
+    assert 'worker.shards' not in caplog.text
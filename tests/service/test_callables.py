@@ -0,0 +1,52 @@
+import pickle
+from base64 import b64encode
+from concurrent.futures import Future
+
+from triggerflow.service import callables
+
+
+class RecordingPool:
+
+    def __init__(self):
+        self.shutdown_calls = []
+
+    def shutdown(self, **kwargs):
+        self.shutdown_calls.append(kwargs)
+
+
+def test_shutdown_cancels_pending_calls(monkeypatch):
+    pool, queued, running = RecordingPool(), Future(), Future()
+    running.set_running_or_notify_cancel()
+    monkeypatch.setattr(callables, 'pool', pool)
+    monkeypatch.setattr(callables, 'pending', {queued, running})
+
+    callables.shutdown()
+
+    assert queued.cancelled() and not running.cancelled()
+    assert pool.shutdown_calls == [{'wait': False}]
+    assert callables.pool is None
+
+
+def test_cache_shares_callables_by_digest():
+    encoded = b64encode(pickle.dumps(len)).decode('utf-8')
+    cache = callables.CallableCache(max_size=1)
+    assert cache.get(encoded) is len
+    assert cache.get(''.join(encoded)) is len
+    assert cache.loads == 1 and len(cache) == 1
+
+
+def workspace_of(context, event):
+    context['workspace'] = (context.workspace, context.global_context['name'])
+    context.local_event_queue.put(event)
+    return context.trigger_id
+
+
+def test_pool_calls_get_the_workspace_of_their_trigger():
+    encoded = b64encode(pickle.dumps(workspace_of)).decode('utf-8')
+    digest = callables.cache.digest(encoded)
+    for workspace in ('ws1', 'ws2'):
+        result, context, events = callables._call(digest, encoded, {}, {'id': '1'}, 't', workspace,
+                                                  {'name': workspace})
+        assert result == 't'
+        assert context == {'workspace': (workspace, workspace)}
+        assert events == [{'id': '1'}]
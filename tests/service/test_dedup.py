@@ -0,0 +1,98 @@
+import json
+
+from triggerflow.service.dedup import ScalableBloomFilter, EventDeduplicator, new_deduplicator
+
+
+def event(event_id, source='s', event_source='src'):
+    return {'id': event_id, 'source': source, 'event_source': event_source}
+
+
+def hashes(key):
+    return ScalableBloomFilter.hashes(key)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = ScalableBloomFilter(initial_capacity=100)
+    for i in range(1000):
+        bloom.add(hashes(str(i)))
+    assert all(hashes(str(i)) in bloom for i in range(1000))
+    assert bloom.add(hashes('0'))
+
+
+def test_bloom_filter_grows_within_its_error_rate():
+    bloom = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(hashes(str(i)))
+    assert len(bloom.filters) > 1
+    false_positives = sum(hashes('other{}'.format(i)) in bloom for i in range(10000))
+    assert false_positives < 10000 * 0.01
+
+
+def test_bloom_filter_memory_is_bounded():
+    bloom = ScalableBloomFilter(initial_capacity=10, max_filters=3)
+    for i in range(10000):
+        bloom.add(hashes(str(i)))
+    assert len(bloom.filters) == 3
+    assert hashes('9999') in bloom
+
+
+def test_duplicates_in_the_window_are_dropped():
+    dedup = EventDeduplicator(window=2)
+    assert not dedup.is_duplicate(event('1'))
+    assert dedup.is_duplicate(event('1'))
+    assert not dedup.is_duplicate(event('1', source='other'))
+    assert not dedup.is_duplicate({'source': 's'})
+    assert dedup.duplicates == 1
+
+    # Out of the window, it is only counted as an unconfirmed duplicate
+    dedup.is_duplicate(event('2'))
+    assert not dedup.is_duplicate(event('1'))
+    assert dedup.unconfirmed == 1
+    assert len(dedup) == 2
+
+
+def test_uncommitted_events_are_restored():
+    dedup = EventDeduplicator()
+    dedup.is_duplicate(event('1'))
+    dedup.is_duplicate(event('2'))
+    dedup.commit([('src', '1')])
+    state = dedup.state()
+    assert [entry[:2] for entry in state['uncommitted']] == [['src', '2']]
+
+    restored = EventDeduplicator()
+    restored.restore(state)
+    assert restored.is_duplicate(event('2'))
+    assert restored.is_replayed(event('2'))
+    assert not restored.is_replayed(event('2'))
+    assert not restored.is_duplicate(event('1'))
+
+
+def test_new_deduplicator():
+    assert new_deduplicator({}) is None
+    dedup = new_deduplicator({'worker': {'dedup': {'enabled': True, 'window': 5, 'bloom_max_filters': 2}}})
+    assert dedup.window_size == 5 and dedup.bloom.max_filters == 2
+
+
+def test_tuple_ids_are_restored_from_json():
+    # Kafka event ids are (topic, partition, offset) tuples, they are lists once checkpointed
+    dedup = EventDeduplicator()
+    dedup.is_duplicate(event(('topic', 0, 1)))
+    dedup.is_duplicate(event(('topic', 0, 2)))
+    state = json.loads(json.dumps(dedup.state()))
+
+    restored = EventDeduplicator()
+    restored.restore(state)
+    assert restored.is_duplicate(event(('topic', 0, 1)))
+    assert restored.is_replayed(event(['topic', 0, 1]))
+    restored.commit([['src', ['topic', 0, 2]]])
+    assert restored.state()['uncommitted'] == [['src', ('topic', 0, 1), state['uncommitted'][0][2]]]
+
+
+def test_bloom_filter_misses_skip_the_window():
+    dedup = EventDeduplicator(window=10, bloom_capacity=1, bloom_max_filters=1)
+    assert dedup.bloom.filters[0].capacity == 10 and dedup.bloom.max_filters == 2
+    for i in range(100):
+        assert not dedup.is_duplicate(event(str(i)))
+    # Keys in the window are always in the Bloom filter, even when refreshed after their filter was dropped
+    assert all(dedup.is_duplicate(event(str(i))) for i in range(90, 100))
+    assert dedup.duplicates == 10
@@ -0,0 +1,15 @@
+import time
+
+from triggerflow.service.conditions.default import _event_time
+
+
+def test_rfc3339_times():
+    assert _event_time({'time': '2020-01-01T00:00:00Z'}) == 1577836800
+    assert _event_time({'time': '2020-01-01T01:00:00.500+01:00'}) == 1577836800.5
+    assert _event_time({'time': '2020-01-01T00:00:00'}) == 1577836800
+
+
+def test_epoch_and_missing_times():
+    assert _event_time({'time': 1577836800}) == 1577836800.0
+    before = time.time()
+    assert before <= _event_time({}) <= time.time()
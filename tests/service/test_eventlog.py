@@ -0,0 +1,53 @@
+import logging
+
+from triggerflow.service.eventlog import EventLogger, new_event_logger
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def event_logger(**kwargs):
+    logger = logging.getLogger('test_eventlog')
+    logger.setLevel(logging.DEBUG)
+    handler = RecordingHandler()
+    logger.handlers = [handler]
+    return EventLogger('ws', logger=logger, **kwargs), handler.messages
+
+
+def test_events_and_logs_are_sampled_separately():
+    event_log, messages = event_logger(sample_rate=0.5, max_per_second=100)
+    for i in range(4):
+        event_log.event({'subject': str(i)})
+        event_log.log('record %d', i)
+    assert messages == ['[ws] New event subject=1 type=None source=None id=None', '[ws] record 1',
+                        '[ws] New event subject=3 type=None source=None id=None', '[ws] record 3']
+    assert event_log.events == 4
+
+
+def test_records_are_rate_limited():
+    event_log, messages = event_logger(sample_rate=1, max_per_second=2)
+    for i in range(5):
+        event_log.log('record %d', i)
+    assert len(messages) <= 4 and event_log.suppressed >= 1
+
+
+def test_summary():
+    event_log, messages = event_logger(sample_rate=0, summary_interval=0)
+    event_log.fired(2)
+    event_log.event({'subject': 'a'})
+    assert len(messages) == 1 and '1 events, 2 fires' in messages[0]
+    assert event_log.suppressed == 0
+
+
+def test_new_event_logger():
+    event_log = new_event_logger({'worker': {'logging': {'worker': {'level': 'INFO', 'sample_rate': 0.1}}}},
+                                 'worker', 'ws')
+    assert event_log.level == logging.INFO and event_log.sample_every == 10
+    assert new_event_logger({}, 'event_sources', 'ws').sample_every == 100
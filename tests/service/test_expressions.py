@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+
+from triggerflow.functions import Expression
+from triggerflow.service.expressions import compile_expression, ExpressionError
+from triggerflow.service.conditions.default import condition_expression
+
+
+class TriggerContext(dict):
+    pass
+
+
+def evaluate(source, data=None, context=None):
+    return compile_expression(source)({'subject': 's', 'data': data}, context or {})
+
+
+def test_evaluation():
+    assert evaluate('data.temperature > context.threshold', {'temperature': 30}, {'threshold': 25}) is True
+    assert evaluate('data["values"][1:] == [2, 3]', {'values': [1, 2, 3]})
+    assert evaluate('len(data) if data else -1', [1, 2]) == 2
+    assert evaluate('data.missing.field is None', {})
+    assert evaluate('event.subject + "!"') == 's!'
+    assert evaluate('max(data) * 2 in (6, 8) and not False', [3, 1])
+
+
+@pytest.mark.parametrize('source', [
+    'event.__class__',
+    'data._private',
+    '__import__("os")',
+    '__builtins__',
+    'open("/etc/passwd")',
+    'event.get("data")',
+    'str.join("", [])',
+    'len(data, key=1)',
+    '(lambda: 1)()',
+    '[x for x in data]',
+    'unknown',
+    'data = 1',
+])
+def test_invalid_expressions_are_rejected(source):
+    with pytest.raises(ExpressionError):
+        compile_expression(source)
+
+
+def test_runtime_limits():
+    with pytest.raises(ExpressionError):
+        evaluate('data.real', 1)
+    with pytest.raises(ExpressionError):
+        evaluate('"x" * 1000000')
+    assert evaluate('"x" * 3') == 'xxx'
+
+
+def test_counter():
+    assert not compile_expression('data > 1').counter
+    context = TriggerContext()
+    context.triggers = {'t': SimpleNamespace(condition_meta={'expression': 'counter >= 2'})}
+    context.trigger_id = 't'
+    assert condition_expression(context, {'data': None}) is False
+    assert condition_expression(context, {'data': None}) is True
+    assert context['counter'] == 2
+
+
+def test_client_condition():
+    assert Expression('counter >= 3').value == {'name': 'EXPRESSION', 'expression': 'counter >= 3'}
+    with pytest.raises(ExpressionError):
+        Expression('event.__class__')
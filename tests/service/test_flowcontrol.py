@@ -0,0 +1,40 @@
+from triggerflow.service.flowcontrol import FlowControl, new_flow_control
+
+
+def test_flow_control_is_disabled_by_default():
+    assert new_flow_control({}, lambda: 0, 'ws') is None
+    assert new_flow_control({'worker': {'flow_control': {'high_watermark': 10}}}, lambda: 0, 'ws') is None
+    flow_control = new_flow_control({'worker': {'flow_control': {'enabled': True, 'high_watermark': 10}}},
+                                    lambda: 0, 'ws')
+    assert (flow_control.high_watermark, flow_control.low_watermark) == (10, 5)
+
+
+def test_event_sources_pause_at_the_high_watermark_and_resume_at_the_low_watermark():
+    depth = [0]
+    flow_control = FlowControl(lambda: depth[0], 'ws', high_watermark=10, low_watermark=4)
+    assert flow_control.check() and flow_control.room() == 10
+
+    depth[0] = 10
+    assert not flow_control.check()
+    assert flow_control.paused and flow_control.pauses == 1 and flow_control.room() == 1
+
+    # Paused until the queue is drained down to the low watermark, not just below the high one
+    depth[0] = 5
+    assert not flow_control.check()
+    depth[0] = 4
+    assert flow_control.check() and not flow_control.paused
+
+    depth[0] = 12
+    assert not flow_control.check() and flow_control.pauses == 2
+
+
+def test_wait_polls_while_paused():
+    depth = [10]
+    polls = []
+
+    def poll():
+        polls.append(depth[0])
+        depth[0] -= 2
+
+    FlowControl(lambda: depth[0], 'ws', high_watermark=10).wait(poll)
+    assert polls == [10, 8, 6] and depth[0] == 4
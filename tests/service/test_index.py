@@ -0,0 +1,46 @@
+from triggerflow.service.index import TriggerIndex
+
+
+def test_exact_subjects():
+    index = TriggerIndex()
+    index.add('a', 't', '1')
+    index.add('a', 't', '2')
+    index.add('a', 'u', '3')
+    assert index.match('a', 't') == ['1', '2']
+    assert index.match('a', 'u') == ['3']
+    assert index.match('a', 'v') == []
+    assert index.match('b', 't') == []
+
+
+def test_prefix_subjects():
+    index = TriggerIndex()
+    index.add('map_*', 't', 'join')
+    index.add('m*', 't', 'any')
+    index.add('map_3', 't', 'exact')
+    assert index.match('map_3', 't') == ['exact', 'any', 'join']
+    assert index.match('map_', 't') == ['any', 'join']
+    assert index.match('ma', 't') == ['any']
+    assert index.match('map_3', 'u') == []
+
+
+def test_remove():
+    index = TriggerIndex()
+    index.add('a', 't', '1')
+    index.add('map_*', 't', 'join')
+    index.remove('a', 't', '1')
+    index.remove('map_*', 't', 'join')
+    index.remove('missing', 't', '1')
+    assert index.match('a', 't') == []
+    assert index.match('map_1', 't') == []
+    assert len(index) == 0
+    assert index.subjects() == []
+
+
+def test_dict_access_only_sees_exact_subjects():
+    index = TriggerIndex()
+    index.add('a', 't', '1')
+    index.add('map_*', 't', 'join')
+    assert 'a' in index and 'map_*' not in index
+    assert list(index['a']['t']) == ['1']
+    assert sorted(index.subjects()) == ['a', 'map_*']
+    assert len(index) == 2
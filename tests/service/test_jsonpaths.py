@@ -0,0 +1,34 @@
+import pytest
+from jsonpath_ng import parse
+
+from triggerflow.service.jsonpaths import DottedPath, JsonPath, compile_path, find_values
+
+DATA = {'a': {'b': [{'c': 1}, {'c': 2}], 'd': None, 'e': 'text'}, 'list': [[1, 2], [3]], 'f': 0}
+
+
+@pytest.mark.parametrize('expression', ['$', '$.a', '$.a.b', '$.a.b[1].c', '$.a.b[5]', '$.a.d', '$.a.d.x',
+                                        '$.list[0][1]', '$.missing.x', '$.f', '$.a.b[0].c.x'])
+def test_dotted_paths_match_jsonpath_ng(expression):
+    path = compile_path(expression)
+    assert isinstance(path, DottedPath)
+    assert path.values(DATA) == [match.value for match in parse(expression).find(DATA)]
+
+
+@pytest.mark.parametrize('expression', ['$.a.b[*].c', '$..c', '$.a.*', 'a.b', '$.a.b[0:1]', '$["a"]'])
+def test_other_paths_use_jsonpath_ng(expression):
+    path = compile_path(expression)
+    assert isinstance(path, JsonPath)
+    assert path.values(DATA) == [match.value for match in parse(expression).find(DATA)]
+
+
+def test_update():
+    data = {'a': {'b': [1, 2]}, 'c': [{'d': 1}, {'d': 2}]}
+    compile_path('$.a.b[1]').update(data, 3)
+    compile_path('$.c[*].d').update(data, 0)
+    assert data == {'a': {'b': [1, 3]}, 'c': [{'d': 0}, {'d': 0}]}
+
+
+def test_find_values():
+    assert find_values('$.a.b[0].c', DATA) == [1]
+    assert find_values('$.a.b[*].c', DATA) == [1, 2]
+    assert compile_path('$.a') is compile_path('$.a')
@@ -0,0 +1,62 @@
+from triggerflow.service.lanes import EventLanes, CONTROL_LANES, new_event_lanes
+
+
+def event(subject, event_type='event.data'):
+    return {'subject': subject, 'type': event_type}
+
+
+def test_events_go_to_the_first_matching_lane():
+    lanes = EventLanes([{'name': 'control', 'types': ['event.triggerflow.*']},
+                        {'name': 'init', 'subjects': ['__init__']}])
+    lanes.put(event('a', 'event.triggerflow.termination.success'))
+    lanes.put(event('__init__', 'event.triggerflow.init'))
+    lanes.put(event('__init__'))
+    lanes.put(event('b'))
+    assert lanes.depths() == {'control': 2, 'init': 1, 'default': 1}
+    assert len(lanes) == 4
+
+
+def test_events_keep_their_order_within_a_lane():
+    lanes = EventLanes([])
+    for i in range(5):
+        lanes.put(event(str(i)))
+    assert [e['subject'] for e in lanes.take(3)] == ['0', '1', '2']
+    assert [e['subject'] for e in lanes.take(10)] == ['3', '4']
+    assert lanes.take(1) == []
+
+
+def test_lanes_are_dequeued_by_weight():
+    lanes = EventLanes([{'name': 'control', 'weight': 3, 'subjects': ['c*']}], default_weight=1)
+    for i in range(100):
+        lanes.put(event('data{}'.format(i)))
+        lanes.put(event('control{}'.format(i)))
+    taken = lanes.take(40)
+    control = sum(1 for e in taken if e['subject'].startswith('c'))
+    assert control == 30
+    assert lanes.dequeued == [30, 10]
+
+
+def test_no_lane_starves():
+    lanes = EventLanes([{'name': 'control', 'weight': 100, 'subjects': ['c*']}])
+    for i in range(1000):
+        lanes.put(event('control{}'.format(i)))
+    lanes.put(event('data'))
+    subjects = [e['subject'] for e in lanes.take(101)]
+    assert 'data' in subjects
+
+
+def test_full():
+    lanes = EventLanes([], max_size=2)
+    lanes.put(event('a'))
+    assert not lanes.full()
+    lanes.put(event('b'))
+    assert lanes.full()
+
+
+def test_new_event_lanes():
+    assert new_event_lanes({}) is None
+    assert new_event_lanes({'worker': {'lanes': []}}) is None
+    assert new_event_lanes({'worker': {'lanes': True}}).names == [lane['name'] for lane in CONTROL_LANES] + ['default']
+    lanes = new_event_lanes({'worker': {'lanes': [{'name': 'x', 'weight': 2}], 'default_lane_weight': 3,
+                                        'lanes_max_buffered': 7}})
+    assert lanes.weights == [2, 3] and lanes.max_size == 7
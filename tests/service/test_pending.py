@@ -0,0 +1,159 @@
+import json
+import threading
+
+from triggerflow.service.queues import LazyEvent
+from triggerflow.service.pending import PendingEvents, SpillFile, commit_events
+
+
+def event(event_id, data=None, event_source='src'):
+    return {'id': event_id, 'subject': 's', 'event_source': event_source, 'data': data}
+
+
+class RecordingSource:
+
+    def __init__(self):
+        self.committed = []
+
+    def commit(self, event_ids):
+        self.committed.extend(event_ids)
+
+
+def test_append_and_pop():
+    events = PendingEvents()
+    events.append('a', event('1'))
+    events.append('a', event('2'))
+    events.append('b', event('3'))
+    assert sorted(events) == ['a', 'b'] and len(events) == 2
+    assert events['a'] == [event('1'), event('2')]
+    assert events.get('missing') is None
+
+    assert events.pop('a') == [('src', '1'), ('src', '2')]
+    assert 'a' not in events and events.pop('a') == []
+    assert events.pop('b') == [('src', '3')]
+    assert events.memory == 0
+
+
+def test_pop_until_sequence_number():
+    events = PendingEvents()
+    first = events.append('a', event('1'))
+    events.append('b', event('2'))
+    events.append('a', event('3'))
+    assert events.pop('a', until=first) == [('src', '1')]
+    assert events['a'] == [event('3')]
+
+
+def test_pop_matching_prefix():
+    events = PendingEvents()
+    for i in range(3):
+        events.append('map_{}'.format(i), event(str(i)))
+    events.append('other', event('x'))
+    assert sorted(events.pop_matching('map_*')) == [('src', '0'), ('src', '1'), ('src', '2')]
+    assert events.pop_matching('other') == [('src', 'x')]
+    assert len(events) == 0
+
+
+def test_payloads_over_the_memory_budget_are_spilled(tmp_path):
+    events = PendingEvents(memory_budget=1000, spill_directory=str(tmp_path))
+    for i in range(10):
+        events.append('a', event(str(i), 'x' * 300))
+    assert events.memory <= 1000
+    assert [e['id'] for e in events['a']] == [str(i) for i in range(10)]
+    assert events['a'][9]['data'] == 'x' * 300
+
+    events.pop('a')
+    assert events.memory == 0
+    events.close()
+
+
+def test_spill_file_reuses_released_space():
+    spill = SpillFile(chunk_size=4096)
+    first = spill.write(b'a' * 3000)
+    second = spill.write(b'b' * 3000)
+    assert spill.size == 8192
+    assert spill.read(first) == b'a' * 3000 and spill.read(second) == b'b' * 3000
+
+    spill.release(first)
+    third = spill.write(b'c')
+    assert third[0] == 6000
+    spill.release(second)
+    spill.release(third)
+    assert spill.write(b'd') == (0, 1)
+    spill.close()
+
+
+def test_spill_file_compaction():
+    spill = SpillFile(chunk_size=4096)
+    locations = [spill.write(data) for data in (b'a' * 10, b'b' * 20, b'c' * 30)]
+    spill.release(locations[1])
+    first, third = spill.compact([locations[2], locations[0]])
+    assert (first, third) == ((10, 30), (0, 10))
+    assert spill.read(first) == b'c' * 30 and spill.read(third) == b'a' * 10
+    assert spill.write(b'd') == (40, 1)
+    spill.close()
+
+
+def test_spill_file_is_compacted_under_steady_load(tmp_path):
+    events = PendingEvents(memory_budget=0, spill_directory=str(tmp_path))
+    # An event stays pending all along while the others are committed
+    events.append('live', event('live', 'x' * 50000))
+    for i in range(2000):
+        events.append('a', event(str(i), 'x' * 50000))
+        if i % 10 == 9:
+            events.pop('a')
+    assert events._PendingEvents__spill.size <= 4 * SpillFile().chunk_size
+    assert events['live'][0]['data'] == 'x' * 50000
+    events.append('a', event('last', 'y'))
+    assert [e['data'] for e in events['a']] == ['y']
+    events.close()
+
+
+def test_spilled_events_are_read_from_other_threads_while_compacted(tmp_path):
+    events = PendingEvents(memory_budget=0, spill_directory=str(tmp_path))
+    events.append('live', event('live', 'x' * 50000))
+    done = threading.Event()
+    reads = []
+
+    def reader():
+        # As an action running in the executor reading the pending events of its trigger
+        while not done.is_set():
+            try:
+                reads.append(events['live'][0]['data'] == 'x' * 50000)
+            except Exception:
+                reads.append(False)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for i in range(1000):
+            events.append('a', event(str(i), 'y' * 50000))
+            if i % 10 == 9:
+                events.pop('a')
+    finally:
+        done.set()
+        thread.join()
+    assert events._PendingEvents__spill.size <= 4 * SpillFile().chunk_size
+    assert reads and all(reads)
+    events.close()
+
+
+def test_lazy_events_are_not_decoded():
+    payload = json.dumps({'id': '1', 'subject': 's', 'data': {'x': 1}}).encode('utf-8')
+    lazy = LazyEvent({'id': '1', 'subject': 's', 'event_source': 'src'}, payload)
+    events = PendingEvents(memory_budget=len(payload))
+    events.append('s', lazy)
+    events.append('s', LazyEvent({'id': '2', 'subject': 's'}, payload))
+    assert not dict.__contains__(lazy, 'data')
+    assert events.memory == len(payload)
+
+    pending = events['s']
+    assert isinstance(pending[0], LazyEvent) and pending[0]['data'] == {'x': 1}
+    assert pending[1]['id'] == '2'
+    assert events.pop('s') == [('src', '1'), (None, '2')]
+    events.close()
+
+
+def test_commit_events():
+    kafka, redis = RecordingSource(), RecordingSource()
+    commit_events({'kafka': kafka, 'redis': redis}, [('kafka', '1'), (None, '2'), ('redis', '3'), ('gone', '4')])
+    assert kafka.committed == ['1']
+    assert redis.committed == ['3']
@@ -0,0 +1,140 @@
+import json
+import queue
+import pickle
+import threading
+
+import pytest
+
+from triggerflow.service.queues import SharedMemoryEventQueue, LazyEvent, new_event_queue
+
+
+@pytest.fixture
+def event_queue():
+    event_queue = SharedMemoryEventQueue(size=64 * 1024)
+    yield event_queue
+    event_queue.unlink()
+
+
+def event(subject, data=None):
+    return {'specversion': '1.0', 'id': subject, 'source': 's', 'subject': subject, 'type': 't', 'data': data}
+
+
+def test_put_and_get(event_queue):
+    event_queue.put(event('a', {'x': 1}))
+    event_queue.put(event('b', [1, 2]))
+    assert event_queue.qsize() == 2
+    first, second = event_queue.get(), event_queue.get()
+    assert first == event('a', {'x': 1})
+    assert second['data'] == [1, 2]
+    assert event_queue.empty()
+    with pytest.raises(queue.Empty):
+        event_queue.get_nowait()
+
+
+def test_put_raw_decodes_data_lazily(event_queue):
+    payload = json.dumps(event('a', json.dumps({'x': 1}))).encode('utf-8')
+    event_queue.put_raw(payload, subject='a', type='t', event_source='kafka')
+    received = event_queue.get()
+    assert isinstance(received, LazyEvent)
+    assert dict.__contains__(received, 'subject') and not dict.__contains__(received, 'data')
+    assert received['data'] == {'x': 1}
+    assert received['event_source'] == 'kafka'
+    assert received['id'] == 'a'
+
+
+def test_ring_buffer_wraps_around(event_queue):
+    data = 'x' * 5000
+    for i in range(100):
+        event_queue.put(event(str(i), data))
+        assert event_queue.get()['subject'] == str(i)
+
+
+def test_oversized_events_are_rejected(event_queue):
+    with pytest.raises(ValueError):
+        event_queue.put(event('a', 'x' * event_queue.max_event_size))
+    event_queue.put(event('a', 'x' * (event_queue.max_event_size - 1024)))
+    assert event_queue.get()['subject'] == 'a'
+
+
+def test_lazy_event():
+    lazy = LazyEvent({'subject': 'a'}, json.dumps({'subject': 'ignored', 'data': 1}).encode('utf-8'))
+    assert lazy['subject'] == 'a'
+    assert lazy.get('missing') is None
+    assert 'data' in lazy
+    assert dict(lazy.items()) == {'subject': 'a', 'data': 1}
+    assert pickle.loads(pickle.dumps(lazy)) == {'subject': 'a', 'data': 1}
+    with pytest.raises(KeyError):
+        lazy['missing']
+
+
+def test_lazy_pickled_event():
+    lazy = LazyEvent({'subject': 'a'}, pickle.dumps({'subject': 'a', 'data': [1]}), encoding=1)
+    assert lazy.copy() == {'subject': 'a', 'data': [1]}
+
+
+def test_new_event_queue():
+    assert hasattr(new_event_queue({}), 'put')
+    event_queue = new_event_queue({'worker': {'event_queue': {'class': 'SharedMemoryEventQueue',
+                                                              'parameters': {'size': 4096}}}})
+    assert isinstance(event_queue, SharedMemoryEventQueue)
+    event_queue.unlink()
+
+
+def test_full_ring_buffer():
+    event_queue = SharedMemoryEventQueue(size=4096)
+    try:
+        put = 0
+        with pytest.raises(queue.Full):
+            while True:
+                event_queue.put(event(str(put), 'x' * 200), block=False)
+                put += 1
+        with pytest.raises(queue.Full):
+            event_queue.put(event('a', 'x' * 200), timeout=0.01)
+
+        # A blocked producer goes on once the consumer frees space
+        producer = threading.Thread(target=event_queue.put, args=(event(str(put), 'x' * 200),))
+        producer.start()
+        assert event_queue.get()['subject'] == '0'
+        producer.join(timeout=5)
+        assert not producer.is_alive()
+
+        # The consumer thread does not wait for itself, its events overflow and are got in order
+        event_queue.put(event('local', 'x' * 200))
+        event_queue.put(event('local2', 'x' * 200), block=False)
+        assert event_queue.qsize() == put + 2
+        assert [event_queue.get()['subject'] for _ in range(put + 2)] == \
+            [str(i) for i in range(1, put + 1)] + ['local', 'local2']
+        assert event_queue.empty()
+    finally:
+        event_queue.unlink()
+
+
+def test_none_stops_the_consumer(event_queue):
+    event_queue.put(event('a'))
+    event_queue.put(None)
+    assert event_queue.get()['subject'] == 'a'
+    assert event_queue.get() is None
+    assert event_queue.empty()
+
+
+def test_local_producers_do_not_wait_for_the_consumer():
+    event_queue = SharedMemoryEventQueue(size=4096)
+    try:
+        with pytest.raises(queue.Empty):
+            event_queue.get(timeout=0.01)
+
+        def produce():
+            event_queue.add_local_producer()
+            for i in range(50):
+                event_queue.put(event(str(i), 'x' * 200))
+
+        # e.g. an action thread the consumer waits for, with the buffer full
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(timeout=5)
+        assert not producer.is_alive()
+        assert event_queue.qsize() == 50
+        assert [event_queue.get(timeout=1)['subject'] for _ in range(50)] == [str(i) for i in range(50)]
+        assert event_queue.empty()
+    finally:
+        event_queue.unlink()
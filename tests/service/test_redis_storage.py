@@ -0,0 +1,133 @@
+import queue
+
+import pytest
+
+from triggerflow.service.deadletters import ReplayListener
+from triggerflow.service.storage import RedisTriggerStorage, ChangesExpired
+from triggerflow.service.sync import TriggerSync
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    server = fakeredis.FakeServer()
+
+    def client(**kwargs):
+        return fakeredis.FakeStrictRedis(server=server, decode_responses=kwargs['decode_responses'])
+
+    monkeypatch.setattr('redis.StrictRedis', client)
+    storage = RedisTriggerStorage(host='localhost', max_deleted_keys=3)
+    storage.create_workspace('ws', {}, {})
+    return storage
+
+
+def test_changes_include_set_and_deleted_keys(storage):
+    since = storage.get_version('ws', 'triggers')
+    storage.set_key('ws', 'triggers', 'a', {})
+    storage.set_key('ws', 'triggers', 'b', {})
+    storage.delete_key('ws', 'triggers', 'a')
+    keys, version = storage.get_changes('ws', 'triggers', since)
+    assert sorted(keys) == ['a', 'b']
+    assert version == storage.get_version('ws', 'triggers')
+    assert storage.get_changes('ws', 'triggers', version) == ([], version)
+
+
+def test_deleted_keys_leave_the_change_and_update_logs(storage):
+    storage.set_key('ws', 'triggers', 'a', {})
+    storage.set_keys('ws', 'triggers', {'a': {'x': 1}})
+    assert storage.get_updated_keys('ws', 'triggers', since=0) == ['a']
+
+    storage.delete_key('ws', 'triggers', 'a')
+    assert storage.client.zrange('ws-triggers-changes', 0, -1) == []
+    assert storage.client.zrange('ws-triggers-deleted', 0, -1) == ['a']
+    assert storage.get_updated_keys('ws', 'triggers', since=0) == []
+
+    storage.set_key('ws', 'triggers', 'a', {})
+    assert storage.client.zrange('ws-triggers-deleted', 0, -1) == []
+
+
+def test_deleted_keys_are_trimmed(storage):
+    since = storage.get_version('ws', 'timeouts')
+    for i in range(10):
+        storage.set_key('ws', 'timeouts', str(i), {})
+        storage.delete_key('ws', 'timeouts', str(i))
+    assert storage.client.zcard('ws-timeouts-deleted') == 3
+
+    with pytest.raises(ChangesExpired):
+        storage.get_changes('ws', 'timeouts', since)
+    keys, _ = storage.get_changes('ws', 'timeouts', storage.get_version('ws', 'timeouts') - 3)
+    assert sorted(keys) == ['8', '9']
+
+
+def test_trigger_sync_reads_all_triggers_when_changes_expired(storage):
+    storage.set_key('ws', 'triggers', 'kept', {})
+    storage.set_key('ws', 'triggers', 'deleted', {})
+    sync = TriggerSync(storage, 'ws')
+    assert set(sync.load()) == {'kept', 'deleted'}
+
+    storage.delete_key('ws', 'triggers', 'deleted')
+    for i in range(5):
+        storage.set_key('ws', 'triggers', str(i), {})
+        storage.delete_key('ws', 'triggers', str(i))
+    storage.set_key('ws', 'triggers', 'added', {})
+
+    added, deleted = sync.changes(known=['kept', 'deleted'])
+    assert set(added) == {'kept', 'added'}
+    assert deleted == ['deleted']
+    assert sync.version == storage.get_version('ws', 'triggers')
+
+
+def test_change_subscriptions_are_closed(storage):
+    storage.create_workspace('other', {}, {})
+    watchers = storage._RedisTriggerStorage__watchers
+    for workspace, document_id in (('ws', 'triggers'), ('ws', 'timeouts'), ('other', 'triggers')):
+        storage.wait_changes(workspace, document_id, since=0, timeout=0.01)
+    assert len(watchers) == 3
+
+    sync = TriggerSync(storage, 'ws', interval=0.01)
+    sync.start()
+    sync.stop()
+    sync.join(timeout=5)
+    assert sorted(watchers) == ['other-triggers-version', 'ws-timeouts-version']
+
+    storage.delete_workspace('ws')
+    assert list(watchers) == ['other-triggers-version']
+    storage.stop_waiting('other')
+    assert watchers == {}
+
+
+def test_replayed_dead_letters_are_kept_until_acknowledged(storage):
+    events = [{'id': i, 'subject': 'a' if i % 2 else 'b'} for i in range(5)]
+    storage.add_dead_letters('ws', events, max_length=100, max_age=0)
+    assert storage.replay_dead_letters('ws', subjects=['a']) == 2
+    assert storage.replay_dead_letters('ws') == 3
+    assert storage.get_dead_letters('ws') == []
+
+    first = storage.pop_replayed_events('ws', timeout=1, count=3)
+    assert len(first) == 3
+    assert storage.pop_replayed_events('ws', timeout=1, count=3) == first
+    storage.ack_replayed_events('ws')
+
+    rest = storage.pop_replayed_events('ws', timeout=1, count=3)
+    assert len(rest) == 2
+    storage.ack_replayed_events('ws')
+    assert sorted(event['id'] for event in first + rest) == list(range(5))
+    assert storage.pop_replayed_events('ws', timeout=1) == []
+
+
+def test_replay_listener_restores_tuple_ids_and_acknowledges(storage):
+    storage.add_dead_letters('ws', [{'id': ('topic', 0, 7), 'subject': 'a'}], max_length=100, max_age=0)
+    storage.replay_dead_letters('ws')
+    event_queue = queue.Queue()
+    listener = ReplayListener(storage, 'ws', event_queue, interval=1)
+    listener.start()
+    try:
+        event = event_queue.get(timeout=5)
+    finally:
+        listener.stop()
+        listener.join(timeout=5)
+
+    assert event['id'] == ('topic', 0, 7)
+    assert storage.client.llen('ws-replaying') == 0
+    assert storage.client.llen('ws-replay') == 0
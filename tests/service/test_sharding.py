@@ -0,0 +1,97 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from triggerflow.service.sharding import ShardedWorker
+from triggerflow.service.queues import SharedMemoryEventQueue
+
+
+def sharded_worker(num_shards, event_queue):
+    worker = ShardedWorker('ws', {'worker': {'shards': num_shards}})
+    worker.shards = [SimpleNamespace(event_queue=event_queue()) for _ in range(num_shards)]
+    return worker
+
+
+def place(worker, triggers):
+    worker._ShardedWorker__place_triggers({t['id']: t for t in triggers})
+    return worker.trigger_shards
+
+
+def test_prefix_and_exact_subjects_of_an_event_share_a_shard(trigger, recording_queue):
+    worker = sharded_worker(16, recording_queue)
+    shards = place(worker, [trigger('exact{}'.format(i), ['map_{}'.format(i)]) for i in range(20)] +
+                   [trigger('join', ['map_*']), trigger('any', ['m*']), trigger('other', ['other'])])
+    assert len({shards['exact{}'.format(i)] for i in range(20)} | {shards['join'], shards['any']}) == 1
+
+    # Added later, they still share the shard of the triggers of the events they match
+    shards = place(worker, [trigger('exact20', ['map_20']), trigger('prefix', ['map_2*'])])
+    assert shards['exact20'] == shards['prefix'] == shards['join']
+
+
+def test_independent_triggers_are_spread(trigger, recording_queue):
+    worker = sharded_worker(4, recording_queue)
+    shards = place(worker, [trigger(str(i), ['subject{}'.format(i)]) for i in range(100)])
+    assert set(shards.values()) == {0, 1, 2, 3}
+
+
+def test_triggers_updating_each_other_share_a_shard(trigger, recording_queue):
+    worker = sharded_worker(8, recording_queue)
+    shards = place(worker, [trigger('a', ['__init__'], context={'subject': 'a'}),
+                            trigger('b', ['a'], context={'subject': 'b'}),
+                            trigger('c', ['b'])])
+    assert shards['a'] == shards['b'] == shards['c']
+
+
+def test_placement_events_fit_in_the_event_queue(trigger):
+    queues = []
+
+    def event_queue():
+        queues.append(SharedMemoryEventQueue(size=512 * 1024))
+        return queues[-1]
+
+    worker = sharded_worker(1, event_queue)
+    try:
+        place(worker, [trigger('t{}'.format(i), ['subject{}'.format(i)], context={'data': '{:04d}'.format(i) * 250})
+                       for i in range(300)])
+        assert queues[0].qsize() > 1
+        placed = {}
+        while not queues[0].empty():
+            placed.update(queues[0].get()['data'])
+        assert len(placed) == 300
+    finally:
+        for shared_queue in queues:
+            shared_queue.unlink()
+
+
+def test_connected_dag_is_reported(caplog, trigger, recording_queue):
+    worker = sharded_worker(4, recording_queue)
+    tasks = [trigger('t{}'.format(i), ['__init__'], context={'subject': 't{}'.format(i)}) for i in range(20)]
+    shards = place(worker, tasks + [trigger('join', ['t{}'.format(i) for i in range(20)])])
+    assert len(set(shards.values())) == 1
+    assert 'sharding does not spread them' in caplog.text
+
+    worker.dead_letter_queue = recording_queue()
+    worker._ShardedWorker__collect_metrics()
+    gauges = worker.metrics.snapshot()['gauges']
+    assert sorted(value for (name, _), value in gauges.items() if name == 'triggerflow_shard_triggers') == [0, 0, 0, 21]
+
+
+def test_sharded_worker_on_shared_memory_queue_stops(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr('redis.StrictRedis', lambda **kwargs: fakeredis.FakeStrictRedis(
+        server=server, decode_responses=kwargs['decode_responses']))
+    from triggerflow.service.storage import RedisTriggerStorage
+    RedisTriggerStorage(host='localhost').create_workspace('ws', {}, {})
+
+    config = {'trigger_storage': {'backend': 'redis', 'parameters': {'host': 'localhost'}},
+              'worker': {'shards': 2, 'event_queue': {'class': 'SharedMemoryEventQueue',
+                                                      'parameters': {'size': 256 * 1024}}}}
+    worker = ShardedWorker('ws', config)
+    worker.start()
+    time.sleep(1)
+    start = time.time()
+    worker.stop_worker()
+    assert time.time() - start < 20
+    assert worker.exitcode == 0
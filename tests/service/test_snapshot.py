@@ -0,0 +1,142 @@
+import queue
+
+from triggerflow.service.index import TriggerIndex
+from triggerflow.service.pending import PendingEvents
+from triggerflow.service.snapshot import TriggerSnapshot, restore_trigger, new_snapshot
+from triggerflow.service.trigger import load_trigger
+from triggerflow.service.worker import Worker
+
+
+def condition(context, event):
+    return True
+
+
+def action(context, event):
+    pass
+
+
+def context_args():
+    return {'global_context': {}, 'workspace': 'ws', 'local_event_queue': queue.Queue(),
+            'events': PendingEvents(), 'trigger_mapping': TriggerIndex(), 'triggers': {}}
+
+
+def test_write_and_read(tmp_path, trigger):
+    triggers = {trigger_id: load_trigger(trigger_id,
+                                         trigger(trigger_id, [trigger_id], context={'counter': i, 'items': [i]}),
+                                         condition, action, **context_args())
+                for i, trigger_id in enumerate(['a', 'b'])}
+    trigger_mapping = TriggerIndex()
+    trigger_mapping.add('a', 't', 'a')
+    trigger_mapping.add('b*', 't', 'b')
+
+    snapshot = TriggerSnapshot(str(tmp_path / 'ws.snapshot'))
+    state = TriggerSnapshot.capture(triggers, trigger_mapping)
+    # Changes made after the state was captured are not in the snapshot
+    triggers['a'].context['items'].append(1)
+    snapshot.write(7, 1000.5, TriggerSnapshot.dump(state), {'b'}, workspace_created=10.25)
+    triggers['a'].context['items'].pop()
+    version, timestamp, records, restored_mapping, stale, workspace_created = snapshot.read()
+
+    assert (version, timestamp, stale, workspace_created) == (7, 1000.5, {'b'}, 10.25)
+    assert restored_mapping.match('b1', 't') == ['b']
+    restored = {record[0]: restore_trigger(record, condition, action, **context_args()) for record in records}
+    assert sorted(restored) == ['a', 'b']
+    for trigger_id, trigger in restored.items():
+        assert trigger.to_dict()['context'] == triggers[trigger_id].to_dict()['context']
+        assert trigger.activation_events == triggers[trigger_id].activation_events
+        assert trigger.context.trigger_id == trigger_id and not trigger.context.modified
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_invalid_snapshots_are_ignored(tmp_path):
+    snapshot = TriggerSnapshot(str(tmp_path / 'ws.snapshot'))
+    assert snapshot.read() is None
+    (tmp_path / 'ws.snapshot').write_bytes(b'not a snapshot')
+    assert snapshot.read() is None
+    snapshot.write(1, 0, b'truncated', set())
+    assert snapshot.read() is None
+    snapshot.delete()
+    snapshot.delete()
+    assert not (tmp_path / 'ws.snapshot').exists()
+
+
+def test_new_snapshot(tmp_path):
+    assert new_snapshot({}, 'ws') is None
+    snapshot = new_snapshot({'worker': {'snapshot_dir': str(tmp_path / 'snapshots')}}, 'ws')
+    assert snapshot.path == str(tmp_path / 'snapshots' / 'ws.snapshot')
+
+
+def test_worker_takes_the_snapshot_in_the_main_loop(tmp_path, trigger):
+    config = {'worker': {'snapshot_dir': str(tmp_path)}}
+    worker = Worker('ws', config)
+    worker.snapshot = new_snapshot(config, 'ws')
+    for trigger_id in ('a', 'b', 'c'):
+        worker._Worker__load_trigger(trigger_id, trigger(trigger_id, [trigger_id], context={'counter': 0}))
+    worker.triggers['a'].context['counter'] = 1
+
+    worker._Worker__take_snapshot()
+    assert worker.checkpoint_queue.get(timeout=5).events == []
+    pending = worker._Worker__pending_snapshot
+    # Modified after the snapshot was taken and before it is written
+    worker.triggers['b'].context['counter'] = 1
+    worker.triggers['c'].context['counter'] = 1
+    worker.dirty_triggers.discard('c')
+    worker._Worker__write_snapshot(*pending)
+
+    version, timestamp, records, trigger_mapping, stale, _ = worker.snapshot.read()
+    assert stale == {'a', 'b'}
+    assert {record[0]: record[-1]['counter'] for record in records} == {'a': 1, 'b': 0, 'c': 0}
+    assert trigger_mapping.match('c', 't') == ['c']
+
+
+def test_worker_leaves_out_the_contexts_actions_may_modify(tmp_path, trigger):
+    config = {'worker': {'snapshot_dir': str(tmp_path)}}
+    worker = Worker('ws', config)
+    worker.snapshot = new_snapshot(config, 'ws')
+    for trigger_id in ('a', 'b'):
+        worker._Worker__load_trigger(trigger_id, trigger(trigger_id, [trigger_id], context={'counter': 1}))
+    worker.dirty_triggers.clear()
+
+    class Executor:
+        def idle(self):
+            return False
+
+        def busy(self, keys):
+            return ('trigger', 'b') in keys
+
+    worker.action_executor = Executor()
+    worker._Worker__take_snapshot()
+    worker._Worker__write_snapshot(*worker._Worker__pending_snapshot)
+
+    version, timestamp, records, trigger_mapping, stale, _ = worker.snapshot.read()
+    assert stale == {'b'}
+    assert {record[0]: record[-1] for record in records} == {'a': {'counter': 1}, 'b': {}}
+
+
+class Storage:
+    created = 1.0
+    version = 1
+
+    def get_workspace_creation_time(self, workspace):
+        return self.created
+
+    def get_version(self, workspace, document_id):
+        return self.version
+
+
+def test_snapshot_of_a_previous_workspace_is_discarded(tmp_path, trigger):
+    config = {'worker': {'snapshot_dir': str(tmp_path)}}
+    worker = Worker('ws', config)
+    worker.snapshot = new_snapshot(config, 'ws')
+    worker.trigger_storage = Storage()
+    worker._Worker__load_trigger('a', trigger('a', ['a']))
+    worker.snapshot.write(1, 0, TriggerSnapshot.dump(TriggerSnapshot.capture(worker.triggers, worker.trigger_mapping)),
+                          set(), workspace_created=1.0)
+
+    # Deleted and created again, its versions start over
+    worker = Worker('ws', config)
+    worker.snapshot = new_snapshot(config, 'ws')
+    worker.trigger_storage = Storage()
+    worker.trigger_storage.created = 2.0
+    assert not worker._Worker__restore_snapshot()
+    assert worker.snapshot.read() is None
@@ -0,0 +1,114 @@
+import queue
+import random
+import time
+
+from triggerflow.service.timers import TimingWheel, TimerService, TIMEOUT_EVENT_TYPE, TIMERS_EVENT_SOURCE
+
+
+def test_timers_expire_at_their_deadline():
+    wheel = TimingWheel(tick=1, slots=4, levels=2, now=0)
+    wheel.add('a', 3, 'payload')
+    wheel.add('b', 10)
+    wheel.add('c', 100)
+    assert wheel.advance(2) == []
+    assert wheel.advance(3) == [('a', 'payload')]
+    assert wheel.advance(9) == []
+    assert wheel.advance(10) == [('b', None)]
+    assert wheel.advance(99) == []
+    assert wheel.advance(100) == [('c', None)]
+    assert len(wheel) == 0
+
+
+def test_past_deadlines_expire_on_the_next_tick():
+    wheel = TimingWheel(tick=1, now=50)
+    wheel.add('a', 10)
+    assert wheel.advance(51) == [('a', None)]
+
+
+def test_add_replaces_and_cancel_removes():
+    wheel = TimingWheel(tick=1, slots=4, levels=2, now=0)
+    wheel.add('a', 3)
+    wheel.add('a', 20)
+    wheel.add('b', 5)
+    assert wheel.cancel('b') and not wheel.cancel('b')
+    assert 'a' in wheel and 'b' not in wheel
+    assert wheel.timer_ids() == ['a']
+    assert wheel.advance(19) == []
+    assert wheel.advance(20) == [('a', None)]
+
+
+def test_wheel_matches_a_sorted_schedule():
+    rng = random.Random(0)
+    wheel = TimingWheel(tick=1, slots=8, levels=3, now=0)
+    deadlines = {}
+    for now in range(0, 2000, 7):
+        for _ in range(3):
+            timer_id = str(rng.randrange(200))
+            deadlines[timer_id] = now + rng.randrange(1, 1000)
+            wheel.add(timer_id, deadlines[timer_id])
+        for timer_id, _ in wheel.advance(now + 7):
+            assert deadlines.pop(timer_id) <= now + 7
+        assert all(deadline > now + 7 for deadline in deadlines.values())
+    assert sorted(wheel.timer_ids()) == sorted(deadlines)
+
+
+class MemoryStorage:
+
+    def __init__(self, timers):
+        self.timers = timers
+
+    def get_version(self, workspace, document_id):
+        return 1
+
+    def get(self, workspace, document_id):
+        return dict(self.timers)
+
+    def wait_changes(self, workspace, document_id, since, timeout):
+        time.sleep(timeout)
+        return since
+
+    def stop_waiting(self, workspace, document_id=None):
+        pass
+
+    def delete_keys(self, workspace, document_id, keys):
+        for key in keys:
+            del self.timers[key]
+
+
+def test_timer_service_cancel_subjects():
+    timers = {'t1': {'deadline': 0, 'event': {'subject': 'timeout1'}, 'cancel_subject': 'done'},
+              't2': {'deadline': 0, 'event': {'subject': 'timeout2'}}}
+    service = TimerService(MemoryStorage(timers), 'ws', queue.Queue())
+    service.load()
+    assert len(service.wheel) == 2
+
+    service.on_event({'subject': 'done', 'type': TIMEOUT_EVENT_TYPE})
+    assert 't1' in service.wheel
+    service.on_event({'subject': 'done', 'type': 'event.triggerflow.termination.success'})
+    assert service.wheel.timer_ids() == ['t2']
+    assert service.cancel('t2') and len(service.wheel) == 0
+
+
+def test_fired_timers_are_deleted_once_their_events_are_committed():
+    storage = MemoryStorage({'t1': {'deadline': 0, 'event': {'subject': 'timeout1', 'id': 'e1'}}})
+    event_queue = queue.Queue()
+    service = TimerService(storage, 'ws', event_queue, tick=0.01, interval=0.1)
+    service.load()
+    service.start()
+    try:
+        event = event_queue.get(timeout=5)
+        assert event['type'] == TIMEOUT_EVENT_TYPE and event['event_source'] == TIMERS_EVENT_SOURCE
+        time.sleep(0.1)
+        assert 't1' in storage.timers
+
+        service.commit([('kafka', 'e1'), (TIMERS_EVENT_SOURCE, 'other')])
+        time.sleep(0.1)
+        assert 't1' in storage.timers
+
+        service.commit([(TIMERS_EVENT_SOURCE, 'e1')])
+        deadline = time.time() + 5
+        while 't1' in storage.timers and time.time() < deadline:
+            time.sleep(0.01)
+        assert storage.timers == {}
+    finally:
+        service.stop()
@@ -0,0 +1,60 @@
+import queue
+import threading
+
+from triggerflow.service import actions
+from triggerflow.service.executor import ActionExecutor
+from triggerflow.service.tracing import Tracer, TracedEventQueue, parse_traceparent
+from triggerflow.service.worker import Worker
+
+TRACEPARENT = '00-{}-{}-01'.format('a' * 32, 'b' * 16)
+
+
+class RecordingExporter(list):
+    def write(self, trace_event):
+        self.append(trace_event)
+
+    def close(self):
+        pass
+
+
+def test_traced_event_queue_continues_the_current_span(recording_queue):
+    tracer = Tracer(RecordingExporter(), sample_rate=1.0)
+    emitted = recording_queue()
+    event_queue = TracedEventQueue(emitted)
+
+    event_queue.put({'id': '1'})
+    with tracer.span('action', TRACEPARENT) as span:
+        event_queue.put({'id': '2'})
+        event_queue.put({'id': '3', 'traceparent': TRACEPARENT})
+
+    assert 'traceparent' not in emitted[0]
+    assert emitted[1]['traceparent'] == span.traceparent
+    assert parse_traceparent(emitted[1]['traceparent']) == ('a' * 32, span.span_id, True)
+    assert emitted[2]['traceparent'] == TRACEPARENT
+
+
+def test_actions_on_the_executor_continue_the_trace_of_their_event(monkeypatch, trigger, event, recording_queue):
+    def action_emit(context, event):
+        context.local_event_queue.put({'id': 'emitted', 'subject': 'next', 'type': 't'})
+
+    monkeypatch.setattr(actions, 'action_emit', action_emit, raising=False)
+    worker = Worker('ws', {})
+    worker.tracer = Tracer(RecordingExporter(), sample_rate=1.0)
+    emitted = recording_queue()
+    worker.local_event_queue = TracedEventQueue(emitted)
+    worker.dead_letter_queue = queue.Queue()
+    worker.action_executor = ActionExecutor(1)
+    worker._Worker__load_trigger('t', trigger('t', ['a'], action='EMIT'))
+
+    worker._Worker__process_event(dict(event('a', '1'), traceparent=TRACEPARENT), [])
+    worker.action_executor.wait_idle()
+    worker.action_executor.shutdown()
+
+    spans = {span['name']: span for span in worker.tracer.exporter}
+    match, action = spans['match'], spans['action']
+    assert match['args']['trace_id'] == action['args']['trace_id'] == 'a' * 32
+    assert match['args']['parent_id'] == 'b' * 16
+    # The action ran on an executor thread, as a child of the span that matched its event
+    assert action['args']['parent_id'] == match['args']['span_id']
+    assert action['tid'] != threading.get_ident()
+    assert parse_traceparent(emitted[0]['traceparent']) == ('a' * 32, action['args']['span_id'], True)
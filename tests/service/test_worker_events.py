@@ -0,0 +1,161 @@
+import queue
+import threading
+
+from triggerflow.service import actions
+from triggerflow.service.executor import ActionExecutor
+from triggerflow.service.sync import NegativeCache
+from triggerflow.service.worker import Worker
+
+
+def process(worker, events):
+    worker.dead_letter_queue = queue.Queue()
+    committed = []
+    for e in events:
+        worker._Worker__process_event(e, committed)
+    return committed
+
+
+def test_wildcard_join_commits_all_its_events(trigger, event):
+    worker = Worker('ws', {})
+    worker._Worker__load_trigger('join', trigger('join', ['map_*'], condition='JOIN', context={'join': 5}))
+
+    committed = process(worker, [event('map_{}'.format(i), str(i)) for i in range(5)])
+
+    assert sorted(committed) == [('src', str(i)) for i in range(5)]
+    assert len(worker.events) == 0
+
+
+def test_join_of_several_subjects_commits_all_its_events(trigger, event):
+    worker = Worker('ws', {})
+    worker._Worker__load_trigger('join', trigger('join', ['a', 'b'], condition='JOIN', context={'join': 3}))
+
+    committed = process(worker, [event('a', '1'), event('a', '2'), event('b', '3')])
+
+    assert sorted(committed) == [('src', '1'), ('src', '2'), ('src', '3')]
+    assert len(worker.events) == 0
+
+
+def test_events_stay_pending_until_their_trigger_fires(trigger, event):
+    worker = Worker('ws', {})
+    worker._Worker__load_trigger('join', trigger('join', ['map_*'], condition='JOIN', context={'join': 3}))
+    worker._Worker__load_trigger('other', trigger('other', ['other_*'], condition='JOIN', context={'join': 3}))
+
+    committed = process(worker, [event('map_1', '1'), event('other_1', '2'), event('map_2', '3'),
+                                 event('map_3', '4')])
+
+    assert sorted(committed) == [('src', '1'), ('src', '3'), ('src', '4')]
+    assert list(worker.events) == ['other_1']
+
+
+def test_only_updated_contexts_are_checkpointed(trigger, event):
+    worker = Worker('ws', {})
+    expression = trigger('expression', ['a'], condition='EXPRESSION')
+    expression['condition']['expression'] = 'data is not None'
+    worker._Worker__load_trigger('expression', expression)
+    worker._Worker__load_trigger('join', trigger('join', ['a'], condition='JOIN', context={'join': 5}))
+    worker._Worker__load_trigger('fired', trigger('fired', ['b']))
+
+    process(worker, [event('a', '1')])
+    assert worker.dirty_triggers == {'join'}
+
+    process(worker, [event('b', '2')])
+    assert worker.dirty_triggers == {'join', 'fired'}
+
+
+def test_batch_is_processed_in_arrival_order(trigger, event):
+    worker = Worker('ws', {})
+    worker._Worker__load_trigger('a', trigger('a', ['a'], condition='JOIN', context={'join': 10}))
+    worker.dead_letter_queue = queue.Queue()
+    order = []
+    worker._Worker__process_event = lambda e, committed: order.append(e['id']) or False
+
+    class Sync:
+        missing = NegativeCache(10)
+        syncs = 0
+
+    def sync_triggers():
+        Sync.syncs += 1
+        worker._Worker__load_trigger('b', trigger('b', ['b'], condition='JOIN', context={'join': 10}))
+
+    worker.trigger_sync = Sync
+    worker._Worker__sync_triggers = sync_triggers
+
+    worker._Worker__dispatch_batch([event('a', '1'), event('b', '2'), event('c', '3'), event('a', '4'),
+                                    event('b', '5'), event('d', '6')])
+
+    assert order == ['1', '2', '4', '5']
+    assert Sync.syncs == 1
+    assert ('c', 't') in Sync.missing
+    assert [worker.dead_letter_queue.get_nowait()['id'] for _ in range(2)] == ['3', '6']
+
+
+def test_checkpoint_captures_contexts_and_dedup_state_together(trigger, event):
+    worker = Worker('ws', {'worker': {'dedup': {'enabled': True}}})
+    worker._Worker__load_trigger('join', trigger('join', ['a'], condition='JOIN', context={'join': 5, 'ids': []}))
+    worker._Worker__load_trigger('busy', trigger('busy', ['b'], condition='JOIN', context={'join': 5}))
+    worker.triggers['join'].context['ids'].append('1')
+    process(worker, [event('a', '1'), event('b', '2')])
+
+    class Executor:
+        def busy(self, keys):
+            return ('trigger', 'busy') in keys
+
+    worker.action_executor = Executor()
+    checkpoint = worker._Worker__take_checkpoint([('src', '1')])
+    worker.action_executor = None
+    # Changes made by the main loop after the checkpoint was taken are not in it
+    worker.triggers['join'].context['ids'].append('3')
+    process(worker, [event('a', '3')])
+
+    assert checkpoint.events == [('src', '1')]
+    assert list(checkpoint.triggers) == ['join']
+    assert checkpoint.triggers['join']['context']['ids'] == ['1']
+    assert checkpoint.triggers['join']['context']['counter'] == 1
+    assert sorted(event_id for _, event_id, _ in checkpoint.dedup_state['uncommitted']) == ['1', '2']
+    # The context of the trigger an action may be modifying is left for the next checkpoint
+    assert worker.dirty_triggers == {'join', 'busy'}
+
+
+def test_events_of_failed_actions_stay_pending(monkeypatch, trigger, event):
+    def action_flaky(context, event):
+        if context.get('fail'):
+            raise Exception('Action failed')
+
+    monkeypatch.setattr(actions, 'action_flaky', action_flaky, raising=False)
+    worker = Worker('ws', {})
+    worker.action_executor = ActionExecutor(2)
+    worker._Worker__load_trigger('ok', trigger('ok', ['a'], action='FLAKY'))
+    worker._Worker__load_trigger('failing', trigger('failing', ['b'], context={'fail': True}, action='FLAKY'))
+
+    # Actions run on the executor, events are committed once they have finished
+    committed = process(worker, [event('a', '1'), event('b', '2'), event('a', '3')])
+    assert committed == []
+    worker.action_executor.wait_idle()
+    assert worker._Worker__finish_actions(committed)
+
+    assert sorted(committed) == [('src', '1'), ('src', '3')]
+    assert list(worker.events) == ['b']
+    assert 'Action failed' in worker.triggers['failing'].context['exception']
+    worker.action_executor.shutdown()
+
+
+def test_events_received_after_a_trigger_fired_are_not_committed_by_its_actions(monkeypatch, trigger, event):
+    release = threading.Event()
+    monkeypatch.setattr(actions, 'action_wait', lambda context, event: release.wait(5), raising=False)
+    worker = Worker('ws', {})
+    worker.action_executor = ActionExecutor(1)
+    expression = trigger('first', ['a'], condition='EXPRESSION', action='WAIT')
+    expression['condition']['expression'] = 'event.id == "1"'
+    expression['transient'] = True
+    worker._Worker__load_trigger('first', expression)
+    worker._Worker__load_trigger('join', trigger('join', ['a'], condition='JOIN', context={'join': 10}))
+
+    committed = process(worker, [event('a', '1'), event('a', '2')])
+    assert not release.is_set()
+    release.set()
+    worker.action_executor.wait_idle()
+    worker._Worker__finish_actions(committed)
+
+    assert committed == [('src', '1')]
+    assert [e['id'] for e in worker.events['a']] == ['2']
+    worker.action_executor.shutdown()
@@ -0,0 +1,36 @@
+import time
+import queue
+
+from triggerflow.service.worker import Worker
+from triggerflow.service.metrics import MetricsAggregator
+
+
+def test_dedup_metrics_are_exported():
+    worker = Worker('ws', {'worker': {'dedup': {'enabled': True}}})
+    worker.dead_letter_queue = queue.Queue()
+    event = {'subject': 'a', 'type': 'b', 'source': 's', 'id': '1'}
+    worker.dedup.is_duplicate(event)
+
+    worker._Worker__collect_metrics()
+    metrics_queue = queue.Queue()
+    metrics_queue.put(('ws', worker.worker_id, worker.metrics.snapshot()))
+    text = MetricsAggregator(metrics_queue).render()
+
+    assert 'triggerflow_dedup_unconfirmed_duplicates{workspace="ws"} 0' in text
+    assert 'triggerflow_dedup_bloom_bytes{workspace="ws"} ' in text
+
+
+def test_aggregator_drains_the_metrics_queue():
+    metrics_queue = queue.Queue()
+    aggregator = MetricsAggregator(metrics_queue)
+    aggregator.start()
+    for i in range(100):
+        metrics_queue.put(('ws', 'w1', {'time': 0, 'counters': {('events', ()): i}, 'gauges': {}, 'histograms': {}}))
+    metrics_queue.put(('ws', 'w2', {'time': 0, 'counters': {('events', ()): 1}, 'gauges': {}, 'histograms': {}}))
+
+    # Only the last snapshot of each worker is kept
+    deadline = time.time() + 5
+    while 'events{workspace="ws"} 100' not in aggregator.render() and time.time() < deadline:
+        time.sleep(0.01)
+    assert metrics_queue.empty()
+    assert 'events{workspace="ws"} 100' in aggregator.render()
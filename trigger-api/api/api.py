@@ -12,6 +12,8 @@ from gevent.pywsgi import WSGIServer
 import workspaces
 import triggers
 import eventsources as event_sources
+import deadletters as dead_letters
+import timeouts
 
 from triggerflow.service import storage
 
@@ -215,31 +217,77 @@ def delete_trigger(workspace, trigger_id):
     return jsonify(res), code
 
 
+#
+#   Dead letters
+#
+
+@api.route('/workspace/<string:workspace>/deadletter', methods=['GET'])
+def get_dead_letters(workspace):
+    global trigger_storage
+    if not trigger_storage.workspace_exists(workspace=workspace):
+        return jsonify({'error': 'Workspace {} not found'.format(workspace)}), 404
+
+    count = request.args.get('count', type=int)
+    res, code = dead_letters.get_dead_letters(trigger_storage, workspace, count)
+
+    return jsonify(res), code
+
+
+@api.route('/workspace/<string:workspace>/deadletter/replay', methods=['POST'])
+def replay_dead_letters(workspace):
+    global trigger_storage
+    if not trigger_storage.workspace_exists(workspace=workspace):
+        return jsonify({'error': 'Workspace {} not found'.format(workspace)}), 404
+
+    parameters = request.get_json(force=True, silent=True) or {}
+    subjects = parameters.get('subjects')
+    if subjects is not None and (not isinstance(subjects, list)
+                                 or not all([isinstance(subject, str) for subject in subjects])):
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    res, code = dead_letters.replay_dead_letters(trigger_storage, workspace, subjects)
+
+    return jsonify(res), code
+
+
 #
 #   Timeout
 #
 
 @api.route('/workspace/<string:workspace>/timeout', methods=['POST'])
 def add_timeout(workspace):
-    global trigger_storage, config_map
+    global trigger_storage
     if not trigger_storage.workspace_exists(workspace=workspace):
         return jsonify({'error': 'Workspace {} not found'.format(workspace)}), 404
 
     parameters = request.get_json(force=True, silent=True)
-    mandatory_params = {'event_source', 'event', 'seconds'}
-    if not set(parameters).issubset(mandatory_params):
+    mandatory_params = {'event', 'seconds'}
+    # The event source is no longer needed, timeout events are put straight in the worker event queue
+    optional_params = {'event_source', 'cancel_subject'}
+    if parameters is None or not mandatory_params.issubset(parameters) \
+            or not set(parameters).issubset(mandatory_params | optional_params):
         return jsonify({'error': 'Invalid parameters'.format(workspace)}), 400
 
-    if not isinstance(parameters['event_source'], dict) \
-            or not isinstance(parameters['event'], dict) \
-            or not isinstance(parameters['seconds'], float):
+    if not isinstance(parameters['event'], dict) \
+            or not isinstance(parameters['seconds'], (int, float)) \
+            or not isinstance(parameters.get('cancel_subject', ''), str):
         return jsonify({'error': 'Invalid parameters'.format(workspace)}), 400
 
-    auth = HTTPBasicAuth(username='token', password=config_map['triggerflow_controller']['token'])
-    path = '/'.join([config_map['triggerflow_controller']['endpoint'], 'workspace', workspace, 'timeout'])
-    controller_res = req.post(path, auth=auth, json=parameters)
+    res, code = timeouts.add_timeout(trigger_storage, workspace, parameters['event'], float(parameters['seconds']),
+                                     parameters.get('cancel_subject'))
+
+    return jsonify(res), code
+
+
+@api.route('/workspace/<string:workspace>/timeout/<string:timer_id>', methods=['DELETE'])
+def cancel_timeout(workspace, timer_id):
+    global trigger_storage
+    if not trigger_storage.workspace_exists(workspace=workspace):
+        return jsonify({'error': 'Workspace {} not found'.format(workspace)}), 404
 
-    return jsonify(controller_res.json()), controller_res.status_code
+    res, code = timeouts.cancel_timeout(trigger_storage, workspace, timer_id)
+
+    return jsonify(res), code
 
 
 ##########################
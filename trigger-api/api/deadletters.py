@@ -0,0 +1,11 @@
+from triggerflow.service.storage import TriggerStorage
+
+
+def get_dead_letters(trigger_storage: TriggerStorage, workspace: str, count: int = None):
+    dead_letters = trigger_storage.get_dead_letters(workspace=workspace, count=count)
+    return dead_letters, 200
+
+
+def replay_dead_letters(trigger_storage: TriggerStorage, workspace: str, subjects: list = None):
+    replayed = trigger_storage.replay_dead_letters(workspace=workspace, subjects=subjects)
+    return {'message': 'Replaying {} events'.format(replayed), 'replayed': replayed}, 200
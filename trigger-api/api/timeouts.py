@@ -0,0 +1,22 @@
+import time
+from uuid import uuid4
+
+from triggerflow.service.storage import TriggerStorage
+
+
+def add_timeout(trigger_storage: TriggerStorage, workspace: str, event: dict, seconds: float,
+                cancel_subject: str = None):
+    timer_id = uuid4().hex
+    timer = {'event': event, 'deadline': time.time() + seconds}
+    if cancel_subject is not None:
+        timer['cancel_subject'] = cancel_subject
+    # The workers of the workspace watch the timeouts document
+    trigger_storage.set_key(workspace=workspace, document_id='timeouts', key=timer_id, value=timer)
+    return {'message': 'Timeout set', 'timer_id': timer_id}, 201
+
+
+def cancel_timeout(trigger_storage: TriggerStorage, workspace: str, timer_id: str):
+    if not trigger_storage.key_exists(workspace=workspace, document_id='timeouts', key=timer_id):
+        return {'error': 'Timeout {} not found'.format(timer_id)}, 404
+    trigger_storage.delete_key(workspace=workspace, document_id='timeouts', key=timer_id)
+    return {'message': 'Timeout {} cancelled'.format(timer_id)}, 200
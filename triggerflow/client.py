@@ -347,18 +347,56 @@ class TriggerflowClient:
 
         log.info('Ok -- Deleted all triggers from workspace {}'.format(self._workspace))
 
-    def timeout(self, event: 'CloudEvent', event_source: EventSource, seconds: Union[int, float]):
+    def get_dead_letters(self, count: Optional[int] = None) -> List[dict]:
         """
-        Publish an event to a specific event source after some arbitrary seconds from now.
+        Retrieve the dead letters of the target workspace, i.e. the events that did not activate any trigger.
+        :param count: Maximum number of dead letters to retrieve, oldest first.
+        :return: List of CloudEvents.
         """
         self._check_workspace()
+        log.info('Getting dead letters of workspace {}'.format(self._workspace))
 
-        if event_source.name is None:
-            log.warning('Event source name is "{}" -- Changed to "{}" instead'.format(event_source.name, self._workspace))
-            event_source.name = self._workspace
-        if event_source.get_stream() is None:
-            log.warning('Event source stream is "{}" -- Changed to "{}" instead'.format(event_source.name, self._workspace))
-            event_source.set_stream(self._workspace)
+        url = '/'.join([self._api_endpoint, 'workspace', self._workspace, 'deadletter'])
+        res = requests.get(url, auth=self._auth, params={'count': count} if count else {})
+
+        if res.ok:
+            log.info('Ok -- Dead letters retrieved from workspace {}'.format(self._workspace))
+            return res.json()
+        else:
+            raise Exception(res.text)
+
+    def replay_dead_letters(self, subjects: Optional[List[str]] = None) -> int:
+        """
+        Send the dead letters of the target workspace back to its worker, e.g. once the triggers they
+        were missing have been added.
+        :param subjects: Only replay the dead letters with these subjects.
+        :return: Number of replayed events.
+        """
+        self._check_workspace()
+        log.info('Replaying dead letters of workspace {}'.format(self._workspace))
+
+        url = '/'.join([self._api_endpoint, 'workspace', self._workspace, 'deadletter', 'replay'])
+        res = requests.post(url, auth=self._auth, json={'subjects': subjects} if subjects else {})
+
+        if res.ok:
+            replayed = res.json()['replayed']
+            log.info('Ok -- Replaying {} dead letters of workspace {}'.format(replayed, self._workspace))
+            return replayed
+        else:
+            raise Exception(res.text)
+
+    def timeout(self, event: 'CloudEvent', event_source: Optional[EventSource], seconds: Union[int, float],
+                cancel_subject: Optional[str] = None) -> str:
+        """
+        Send an event to the worker of the workspace after some arbitrary seconds from now, with type
+        `event.triggerflow.timeout`.
+        :param event: Event to send.
+        :param event_source: Not used, timeout events do not go through an event source. Kept for compatibility.
+        :param seconds: Seconds from now.
+        :param cancel_subject: Cancel the timeout once the worker receives an event with this subject.
+        :return: Timer id, see `cancel_timeout`.
+        """
+        self._check_workspace()
 
         seconds = float(seconds)
         log.info('Adding a timeout event with subject {} of {} seconds for workspace {}'.format(event.Subject(),
@@ -367,9 +405,10 @@ class TriggerflowClient:
 
         payload = {
             'event': json.loads(event.MarshalJSON(json.dumps).read().decode('utf-8')),
-            'event_source': event_source.get_json_eventsource(),
             'seconds': seconds
         }
+        if cancel_subject is not None:
+            payload['cancel_subject'] = cancel_subject
         url = '/'.join([self._api_endpoint, 'workspace', self._workspace, 'timeout'])
         res = requests.post(url, auth=self._auth, json=payload)
 
@@ -377,6 +416,23 @@ class TriggerflowClient:
             log.info('Ok -- Added timeout of {} for event with subject {} for workspace {}'.format(seconds,
                                                                                                    event.Subject(),
                                                                                                    self._workspace))
+            return res.json()['timer_id']
+        else:
+            raise Exception(res.text)
+
+    def cancel_timeout(self, timer_id: str):
+        """
+        Cancel a timeout that has not fired yet.
+        :param timer_id: Timer id returned by `timeout`.
+        """
+        self._check_workspace()
+        log.info('Cancelling timeout {} of workspace {}'.format(timer_id, self._workspace))
+
+        url = '/'.join([self._api_endpoint, 'workspace', self._workspace, 'timeout', timer_id])
+        res = requests.delete(url, auth=self._auth)
+
+        if res.ok:
+            log.info('Ok -- Timeout {} cancelled'.format(timer_id))
         else:
             raise Exception(res.text)
 
@@ -22,6 +22,10 @@ class DefaultConditions(ConditionActionModel, Enum):
     FUNCTION_JOIN = {'name': 'FUNCTION_JOIN'}
     DAG_TASK_JOIN = {'name': 'DAG_TASK_JOIN'}
     COUNTER_THRESHOLD = {'name': 'COUNTER_THRESHOLD'}
+    # Windows on event time, see the trigger context parameters in the worker conditions
+    TUMBLING_WINDOW = {'name': 'TUMBLING_WINDOW'}
+    SLIDING_WINDOW = {'name': 'SLIDING_WINDOW'}
+    SESSION_WINDOW = {'name': 'SESSION_WINDOW'}
 
 
 class DefaultActions(ConditionActionModel, Enum):
@@ -42,8 +46,30 @@ class DockerImage(ConditionActionModel):
                       'class_name': class_name}
 
 
+class Expression(ConditionActionModel):
+    def __init__(self, expression: str):
+        """
+        Condition given as an expression, e.g. `data.temperature > context.threshold and counter >= 3`. It is
+        stored as plain JSON and compiled once by the worker, see `triggerflow.service.expressions`. It can read
+        the event (`event`, and `data` for its data), the trigger context (`context`) and `counter`, the number
+        of activation events received by the trigger.
+        """
+        # Imported here, so the client does not load the worker modules unless expressions are used
+        from .service.expressions import compile_expression
+
+        # Fail early on invalid expressions
+        compile_expression(expression)
+        self.value = {'name': 'EXPRESSION',
+                      'expression': expression}
+
+
 class PythonCallable(ConditionActionModel):
-    def __init__(self, function: callable, modules_to_capture: List[str] = None):
+    def __init__(self, function: callable, modules_to_capture: List[str] = None, process_pool: bool = False):
+        """
+        :param process_pool: Run the function in a process pool of the worker instead of its main process,
+        for CPU bound functions. The function gets a copy of the trigger context (changes are merged back)
+        with the workspace, a read-only copy of the global context and `local_event_queue`.
+        """
         try:
             assert inspect.isfunction(function)
             assert set(inspect.signature(function).parameters.keys()).issubset({'context', 'event'})
@@ -66,6 +92,8 @@ class PythonCallable(ConditionActionModel):
 
         self.value = {'name': 'PYTHON_CALLABLE',
                       'callable': encoded_callable}
+        if process_pool:
+            self.value['process_pool'] = True
 
 
 def python_object(obj: object):
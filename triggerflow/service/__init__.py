@@ -0,0 +1,17 @@
+def build_worker(workspace, config, metrics_queue=None):
+    """
+    Instantiates the worker process of a workspace as configured in the `worker` section of the config map.
+    Workers send snapshots of their metrics to `metrics_queue`, if given.
+    """
+    worker_config = config.get('worker') or {}
+
+    if worker_config.get('class') == 'AsyncWorker':
+        from .async_worker import AsyncWorker
+        return AsyncWorker(workspace, config, metrics_queue=metrics_queue)
+
+    if int(worker_config.get('shards', 1)) > 1:
+        from .sharding import ShardedWorker
+        return ShardedWorker(workspace, config, metrics_queue=metrics_queue)
+
+    from .worker import Worker
+    return Worker(workspace, config, metrics_queue=metrics_queue)
@@ -3,9 +3,10 @@ import json
 from uuid import uuid4
 from platform import node
 
-from jsonpath_ng import parse
 from datetime import datetime
 
+from ..jsonpaths import compile_path, find_values
+
 
 def action_aws_asf_pass(context, event):
     input = {}
@@ -13,8 +14,7 @@ def action_aws_asf_pass(context, event):
 
     if 'State' in context:
         if 'InputPath' in context['State']:
-            exp = parse(context['State']['InputPath'])
-            matches = [x.value for x in exp.find(event['data'])]
+            matches = find_values(context['State']['InputPath'], event['data'])
             if len(matches) == 1:
                 input = matches.pop()
             else:
@@ -23,15 +23,13 @@ def action_aws_asf_pass(context, event):
         if 'Result' in context['State']:
             for key, value in context['State']['Result']:
                 if value.startswith('$'):
-                    exp = parse(value)
                     result[key] = {}
-                    exp.update(result[key], input)
+                    compile_path(value).update(result[key], input)
 
         if 'ResultPath' in context['State']:
             key = context['State']['ResultPath'].split('.')[1]
             result[key] = {}
-            exp = parse(context['State']['ResultPath'])
-            exp.update(result, input)
+            compile_path(context['State']['ResultPath']).update(result, input)
 
     uuid = uuid4()
     termination_cloudevent = {'specversion': '1.0',
@@ -60,12 +58,11 @@ def action_aws_asf_task(context, event):
         for parameter_key, parameter_value in context['State']['Parameters'].items():
             if parameter_key.endswith('.$'):
                 key = parameter_key[:-2]
-                exp = parse(parameter_value)
-                match = exp.find(event['data'])
+                match = find_values(parameter_value, event['data'])
                 if len(match) == 1:
-                    invoke_args[key] = match.pop().value
+                    invoke_args[key] = match.pop()
                 elif len(match) > 1:
-                    invoke_args[key] = [m.value for m in match]
+                    invoke_args[key] = match
                 else:
                     invoke_args[key] = None
             else:
@@ -80,16 +77,12 @@ def action_aws_asf_task(context, event):
 
 def action_aws_asf_map(context, event):
     if 'InputPath' in context['State']:
-        exp = parse(context['State']['InputPath'])
-        match = exp.find(event['data'])
-        input = match.pop().value
+        input = find_values(context['State']['InputPath'], event['data']).pop()
     else:
         input = event['data']
 
     if 'ItemsPath' in context['State']:
-        exp = parse(context['State']['ItemsPath'])
-        match = exp.find(input)
-        iterator = match.pop().value
+        iterator = find_values(context['State']['ItemsPath'], input).pop()
     else:
         iterator = input
 
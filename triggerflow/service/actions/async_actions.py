@@ -0,0 +1,123 @@
+import time
+import asyncio
+import logging
+from functools import partial
+
+import boto3
+import requests
+from requests.auth import HTTPBasicAuth
+
+from . import default
+from .default import InvokeException, ibm_cf_invoke_payloads, aws_lambda_invoke_payloads, \
+    update_downstream_activations, check_invoke_responses
+
+
+async def action_ibm_cf_invoke(context, event):
+    if not default.ibmcf_session:
+        default.create_ibmcf_session()
+    session = default.ibmcf_session
+
+    operator, subject, invoke_payloads = ibm_cf_invoke_payloads(context)
+
+    cf_auth = operator['api_key'].split(':')
+    cf_auth_handler = HTTPBasicAuth(cf_auth[0], cf_auth[1])
+
+    url = operator['url']
+    max_retries = context['max_retries'] if 'max_retries' in context else 5
+    loop = asyncio.get_running_loop()
+
+    async def invoke(call_id, payload):
+        retry_count = 0
+        while True:
+            try:
+                start_t = time.time()
+                response = await loop.run_in_executor(None, partial(session.post, url, json=payload,
+                                                                    auth=cf_auth_handler, timeout=10.0, verify=True))
+                status_code = response.status_code
+                res_json = response.json()
+                et = round(time.time() - start_t, 3)
+                if status_code in range(200, 300) and res_json.get('activationId') is not None:
+                    act_id = res_json['activationId']
+                    logging.info(
+                        '[{}][{}] Invocation success ({}s) - Activation ID: {}'.format(context.workspace, call_id, et,
+                                                                                       act_id))
+                    return call_id, act_id
+                elif status_code in range(400, 500) and status_code not in [408, 409, 429]:
+                    logging.error(
+                        '[{}][{}] Invocation failed - Activation status code: {}'.format(context.workspace, call_id,
+                                                                                         status_code))
+                    raise InvokeException('Invocation failed')
+            except requests.exceptions.RequestException as e:
+                logging.error('[{}][{}] Error talking to OpenWhisk: {}'.format(context.workspace, call_id, e))
+                raise e
+            except InvokeException:
+                raise
+            except Exception as e:
+                logging.error("[{}][{}] Exception - {}".format(context.workspace, call_id, e))
+
+            retry_count += 1
+            if retry_count > max_retries:
+                logging.error("[{}][{}] Retrying failed after {} attempts".format(context.workspace, call_id,
+                                                                                 max_retries))
+                raise InvokeException('Invocation failed')
+            sleepy_time = pow(2, retry_count)
+            logging.info("[{}][{}] Retrying in {} second(s)".format(context.workspace, call_id, sleepy_time))
+            await asyncio.sleep(sleepy_time)
+
+    total_activations = len(invoke_payloads)
+    logging.info("[{}] Firing trigger {} - Activations: {} ".format(context.workspace, subject, total_activations))
+
+    # Downstream triggers must know how many termination events to expect before any of them is processed
+    update_downstream_activations(context, subject, total_activations)
+
+    results = await asyncio.gather(*[invoke(cid, payload) for cid, payload in enumerate(invoke_payloads)],
+                                   return_exceptions=True)
+    responses = [result for result in results if not isinstance(result, BaseException)]
+    check_invoke_responses(context, subject, total_activations, responses, 'All invocations have failed')
+
+
+async def action_aws_lambda_invoke(context, event):
+    operator, subject, invoke_payloads = aws_lambda_invoke_payloads(context)
+    function_name = operator['function_name']
+    max_retries = context['max_retries'] if 'max_retries' in context else 5
+    loop = asyncio.get_running_loop()
+
+    lambda_client = boto3.client('lambda')
+
+    async def invoke(call_id, args):
+        retry_count = 0
+        while True:
+            try:
+                response = await loop.run_in_executor(None, partial(lambda_client.invoke_async,
+                                                                    FunctionName=function_name, InvokeArgs=args))
+                status_code = response['ResponseMetadata']['HTTPStatusCode']
+                if status_code in range(200, 300):
+                    act_id = response['ResponseMetadata']['RequestId']
+                    logging.info(
+                        '[{}][{}] Invocation success - Activation ID: {}'.format(context.workspace, call_id, act_id))
+                    return call_id, act_id
+                elif status_code in range(400, 500) and status_code not in [408, 409, 429]:
+                    logging.error(
+                        '[{}][{}] Invocation failed - Activation status code: {}'.format(context.workspace, call_id,
+                                                                                         status_code))
+            except Exception as e:
+                logging.error("[{}][{}] Exception - {}".format(context.workspace, call_id, e))
+
+            retry_count += 1
+            if retry_count > max_retries:
+                logging.error("[{}][{}] Retrying failed after {} attempts".format(context.workspace, call_id,
+                                                                                 max_retries))
+                raise InvokeException('Invocation failed')
+            sleepy_time = pow(2, retry_count)
+            logging.info("[{}][{}] Retrying in {} second(s)".format(context.workspace, call_id, sleepy_time))
+            await asyncio.sleep(sleepy_time)
+
+    total_activations = len(invoke_payloads)
+    logging.info("[{}] Firing trigger {} - Activations: {} ".format(context.workspace, subject, total_activations))
+
+    update_downstream_activations(context, subject, total_activations)
+
+    results = await asyncio.gather(*[invoke(cid, payload) for cid, payload in enumerate(invoke_payloads)],
+                                   return_exceptions=True)
+    responses = [result for result in results if not isinstance(result, BaseException)]
+    check_invoke_responses(context, subject, total_activations, responses, 'All invocations are unsuccessful')
@@ -1,23 +1,23 @@
 import logging
-import pickle
 import time
 import boto3
 import urllib3
 import docker
-import jsonpath_ng
 import requests
 from uuid import uuid4
 from platform import node
 from datetime import datetime
-from base64 import b64decode
 from concurrent.futures import ThreadPoolExecutor
 from urllib3.exceptions import InsecureRequestWarning
 from requests.auth import HTTPBasicAuth
 
+from .. import callables
+from ..tracing import current_traceparent
+from ..jsonpaths import find_values
+
 
 urllib3.disable_warnings(InsecureRequestWarning)
 
-python_action_callables = {}
 docker_containers = {}
 ibmcf_session = None
 
@@ -51,17 +51,15 @@ def action_dag_dummy_task(context, event):
                 context.triggers[downstream_trigger].context['dependencies'][subject]['join'] += 1
             else:
                 context.triggers[downstream_trigger].context['dependencies'][subject]['join'] = 1
+            context.triggers[downstream_trigger].context.set_modified()
 
 
 def action_python_callable(context, event):
-    global python_action_callables
-
-    if context.trigger_id not in python_action_callables:
-        decoded_callable = b64decode(context.triggers[context.trigger_id].action_meta['callable'].encode('utf-8'))
-        f = pickle.loads(decoded_callable)
-        python_action_callables[context.trigger_id] = f
+    action_meta = context.triggers[context.trigger_id].action_meta
+    if action_meta.get('process_pool'):
+        return callables.call(context, action_meta['callable'], event)
 
-    f = python_action_callables[context.trigger_id]
+    f = callables.cache.get(action_meta['callable'])
     result = f(context=context, event=event)
 
     return result
@@ -117,23 +115,24 @@ def action_throttle_ibmcf_function(context, event):
     response = [f.result() for f in futures]
 
 
-def action_ibm_cf_invoke(context, event):
-    class InvokeException(Exception):
-        pass
+class InvokeException(Exception):
+    pass
 
-    if not ibmcf_session:
-        create_ibmcf_session()
 
+def ibm_cf_invoke_payloads(context):
+    """
+    Returns the IBM Cloud Functions operator of a trigger, the subject of its termination
+    events and the payloads of the activations to invoke
+    """
     operator = context.get('operator', context)
-
-    cf_auth = operator['api_key'].split(':')
-    cf_auth_handler = HTTPBasicAuth(cf_auth[0], cf_auth[1])
-
-    url = operator['url']
     subject = context.get('subject', None)
 
     triggerflow_meta = {'subject': subject,
                         'sink': operator.get('sink', {})}
+    # Termination events of the invocations continue the trace of the action
+    traceparent = current_traceparent()
+    if traceparent is not None:
+        triggerflow_meta['traceparent'] = traceparent
 
     invoke_payloads = []
     if operator.get('iter_data', {}):
@@ -147,14 +146,98 @@ def action_ibm_cf_invoke(context, event):
     else:
         for key, arg in operator.get('invoke_kwargs', {}).items():
             if isinstance(arg, str) and arg.startswith('$'):
-                jsonpath_expr = jsonpath_ng.parse(arg)
-                result_args = [match.value for match in jsonpath_expr.find(context['result'])]
+                result_args = find_values(arg, context['result'])
                 operator['invoke_kwargs'][key] = result_args
 
         payload = operator.get('invoke_kwargs', {})
         payload['__OW_TRIGGERFLOW'] = triggerflow_meta
         invoke_payloads.append(payload)
 
+    return operator, subject, invoke_payloads
+
+
+def aws_lambda_invoke_payloads(context):
+    """
+    Returns the AWS Lambda operator of a trigger, the subject of its termination
+    events and the payloads of the invocations
+    """
+    operator = context['operator'] if 'operator' in context else context
+    subject = context['subject'] if 'subject' in context else None
+
+    triggerflow_meta = {'subject': subject,
+                        'sink': operator['sink']}
+    # Termination events of the invocations continue the trace of the action
+    traceparent = current_traceparent()
+    if traceparent is not None:
+        triggerflow_meta['traceparent'] = traceparent
+
+    invoke_payloads = []
+    if operator['iter_data']:
+        keys = list(operator['iter_data'].keys())
+        iterdata_keyword = keys.pop()
+        for iterdata_value in operator['iter_data'][iterdata_keyword]:
+            payload = operator['invoke_kwargs'].copy()
+            payload[iterdata_keyword] = iterdata_value
+            payload['__OW_TRIGGERFLOW'] = triggerflow_meta
+            invoke_payloads.append(payload)
+    else:
+        payload = operator['invoke_kwargs'].copy()
+        payload['__OW_TRIGGERFLOW'] = triggerflow_meta
+        invoke_payloads.append(payload)
+
+    return operator, subject, invoke_payloads
+
+
+def update_downstream_activations(context, subject, total_activations):
+    """
+    Let the triggers activated by the termination events of an invocation know how many of them to expect
+    """
+    if subject in context.trigger_mapping:
+        downstream_triggers = context.trigger_mapping[subject]['event.triggerflow.termination.success']
+        for downstream_trigger in downstream_triggers:
+            downstream_trigger_ctx = context.triggers[downstream_trigger].context
+            if 'total_activations' in downstream_trigger_ctx:
+                downstream_trigger_ctx['total_activations'] += total_activations
+            else:
+                downstream_trigger_ctx['total_activations'] = total_activations
+
+            if 'dependencies' in downstream_trigger_ctx and subject in downstream_trigger_ctx['dependencies']:
+                if downstream_trigger_ctx['dependencies'][subject]['join'] > 0:
+                    downstream_trigger_ctx['dependencies'][subject]['join'] += total_activations
+                else:
+                    downstream_trigger_ctx['dependencies'][subject]['join'] = total_activations
+
+
+def check_invoke_responses(context, subject, total_activations, responses, error_message):
+    activations_done = [call_id for call_id, _ in responses]
+    activations_not_done = [call_id for call_id in range(total_activations) if call_id not in activations_done]
+
+    # All activations are unsuccessful
+    if not activations_done:
+        raise Exception(error_message)
+    # At least one activation is successful
+    else:
+        # All activations are successful
+        if len(activations_done) == total_activations:
+            logging.info('[{}][{}] All invocations successful'.format(context.workspace, subject))
+        # Only some activations are successful
+        else:
+            logging.info(
+                "[{}][{}] Could not be completely triggered - {} activations pending".format(context.workspace, subject,
+                                                                                             len(activations_not_done)))
+
+
+def action_ibm_cf_invoke(context, event):
+    if not ibmcf_session:
+        create_ibmcf_session()
+
+    operator, subject, invoke_payloads = ibm_cf_invoke_payloads(context)
+
+    cf_auth = operator['api_key'].split(':')
+    cf_auth_handler = HTTPBasicAuth(cf_auth[0], cf_auth[1])
+
+    url = operator['url']
+
     if 'max_retries' in context:
         max_retries = context['max_retries']
     else:
@@ -222,65 +305,14 @@ def action_ibm_cf_invoke(context, event):
         except InvokeException:
             pass
 
-    activations_done = [call_id for call_id, _ in responses]
-    activations_not_done = [call_id for call_id in range(total_activations) if call_id not in activations_done]
-
-    if subject in context.trigger_mapping:
-        downstream_triggers = context.trigger_mapping[subject]['event.triggerflow.termination.success']
-        for downstream_trigger in downstream_triggers:
-            downstream_trigger_ctx = context.triggers[downstream_trigger].context
-            if 'total_activations' in downstream_trigger_ctx:
-                downstream_trigger_ctx['total_activations'] += total_activations
-            else:
-                downstream_trigger_ctx['total_activations'] = total_activations
-
-            if 'dependencies' in downstream_trigger_ctx and subject in downstream_trigger_ctx['dependencies']:
-                if downstream_trigger_ctx['dependencies'][subject]['join'] > 0:
-                    downstream_trigger_ctx['dependencies'][subject]['join'] += total_activations
-                else:
-                    downstream_trigger_ctx['dependencies'][subject]['join'] = total_activations
-
-    # All activations are unsuccessful
-    if not activations_done:
-        raise Exception('All invocations have failed')
-    # At least one activation is successful
-    else:
-        # All activations are successful
-        if len(activations_done) == total_activations:
-            logging.info('[{}][{}] All invocations successful'.format(context.workspace, subject))
-        # Only some activations are successful
-        else:
-            logging.info(
-                "[{}][{}] Could not be completely triggered - {} activations pending".format(context.workspace, subject,
-                                                                                             len(activations_not_done)))
+    update_downstream_activations(context, subject, total_activations)
+    check_invoke_responses(context, subject, total_activations, responses, 'All invocations have failed')
 
 
 def action_aws_lambda_invoke(context, event):
-    class InvokeException(Exception):
-        pass
-
-    operator = context['operator'] if 'operator' in context else context
-
-    subject = context['subject'] if 'subject' in context else None
+    operator, subject, invoke_payloads = aws_lambda_invoke_payloads(context)
     function_name = operator['function_name']
 
-    triggerflow_meta = {'subject': subject,
-                        'sink': operator['sink']}
-
-    invoke_payloads = []
-    if operator['iter_data']:
-        keys = list(operator['iterdata'].keys())
-        iterdata_keyword = keys.pop()
-        for iterdata_value in operator['iterdata'][iterdata_keyword]:
-            payload = operator['invoke_kwargs'].copy()
-            payload[iterdata_keyword] = iterdata_value
-            payload['__OW_TRIGGERFLOW'] = triggerflow_meta
-            invoke_payloads.append(payload)
-    else:
-        payload = operator['invoke_kwargs'].copy()
-        payload['__OW_TRIGGERFLOW'] = triggerflow_meta
-        invoke_payloads.append(payload)
-
     if 'max_retries' in context:
         max_retries = context['max_retries']
     else:
@@ -340,34 +372,5 @@ def action_aws_lambda_invoke(context, event):
         except InvokeException:
             pass
 
-    activations_done = [call_id for call_id, _ in responses]
-    activations_not_done = [call_id for call_id in range(total_activations) if call_id not in activations_done]
-
-    if subject in context.trigger_mapping:
-        downstream_triggers = context.trigger_mapping[subject]['event.triggerflow.termination.success']
-        for downstream_trigger in downstream_triggers:
-            downstream_trigger_ctx = context.triggers[downstream_trigger].context
-            if 'total_activations' in downstream_trigger_ctx:
-                downstream_trigger_ctx['total_activations'] += total_activations
-            else:
-                downstream_trigger_ctx['total_activations'] = total_activations
-
-            if 'dependencies' in downstream_trigger_ctx and subject in downstream_trigger_ctx['dependencies']:
-                if downstream_trigger_ctx['dependencies'][subject]['join'] > 0:
-                    downstream_trigger_ctx['dependencies'][subject]['join'] += total_activations
-                else:
-                    downstream_trigger_ctx['dependencies'][subject]['join'] = total_activations
-
-    # All activations are unsuccessful
-    if not activations_done:
-        raise Exception('All invocations are unsuccessful')
-    # At least one activation is successful
-    else:
-        # All activations are successful
-        if len(activations_done) == total_activations:
-            logging.info('[{}][{}] All invocations successful'.format(context.workspace, subject))
-        # Only some activations are successful
-        else:
-            logging.info(
-                "[{}][{}] Could not be completely triggered - {} activations pending".format(context.workspace, subject,
-                                                                                             len(activations_not_done)))
+    update_downstream_activations(context, subject, total_activations)
+    check_invoke_responses(context, subject, total_activations, responses, 'All invocations are unsuccessful')
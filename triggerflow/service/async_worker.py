@@ -0,0 +1,530 @@
+import time
+import asyncio
+import logging
+import traceback
+import contextvars
+from uuid import uuid4
+from datetime import datetime
+from functools import partial
+from collections import Counter
+from multiprocessing import Process, Queue
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+from . import storage
+from . import eventsources
+from . import callables
+from . import conditions as default_conditions
+from . import actions as default_actions
+from .actions import async_actions
+from .trigger import load_trigger
+from .index import TriggerIndex
+from .worker import Worker, NO_SPAN
+from .executor import context_keys, action_keys
+from .sync import TriggerSync
+from .deadletters import DeadLetterQueue, ReplayListener
+from .pending import PendingEvents, commit_events
+from .metrics import MetricsRegistry, MetricsReporter, SIZE_BUCKETS
+from .tracing import new_tracer, TracedEventQueue
+from .eventlog import new_event_logger
+from .timers import TimerService
+from .flowcontrol import new_flow_control
+from .dedup import new_deduplicator
+
+# Settings of the `worker` section that only the Worker implements, with their disabled values
+WORKER_ONLY_SETTINGS = {'batch_size': 1, 'batch_linger_ms': 0, 'shards': 1, 'action_threads': 0, 'lanes': None,
+                        'snapshot_dir': None}
+
+
+class AsyncEventQueue:
+    """
+    Thread-safe producer side of the asyncio event queue of an AsyncWorker, used by event sources
+    and by actions that emit events
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        self.__loop = loop
+        self.__queue = queue
+
+    def put(self, event):
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, event)
+
+    def qsize(self):
+        return self.__queue.qsize()
+
+
+class AsyncWorker(Process):
+    """
+    Workspace worker built on asyncio. Conditions and actions of each matched trigger run in their own task,
+    serialized per trigger, so invocation actions (which have coroutine versions in `actions.async_actions`)
+    can have thousands of activations in flight without blocking event matching. Trigger storage calls
+    and invocation HTTP requests run on the default executor, sized by `worker.max_inflight_invocations`.
+
+    Actions may also modify the contexts of other triggers (e.g. DAG join counters). As in `Worker`, a
+    condition is not evaluated while an action that may modify its context is in flight, and actions that
+    may modify the same contexts do not run at the same time.
+    """
+
+    def __init__(self, workspace, config, metrics_queue: Queue = None):
+        super().__init__()
+        self.workspace = workspace
+        self.worker_id = str(uuid4())[:6]
+        self.__config = config
+
+        worker_config = config.get('worker') or {}
+        if new_deduplicator(config) is not None:
+            # Its state must be checkpointed with the trigger contexts, see `Worker`
+            raise ValueError('Event deduplication (worker.dedup) is not supported by the AsyncWorker')
+        for key, disabled in WORKER_ONLY_SETTINGS.items():
+            if worker_config.get(key) not in (disabled, None, False):
+                logging.warning('[{}] worker.{} is not supported by the AsyncWorker, ignored'.format(workspace, key))
+        if (worker_config.get('event_queue') or {}).get('class', 'Queue') != 'Queue':
+            # Events are put in the asyncio queue of the worker
+            logging.warning('[{}] worker.event_queue is not supported by the AsyncWorker, ignored'.format(workspace))
+        self.max_inflight_invocations = int(worker_config.get('max_inflight_invocations', 256))
+        self.trigger_sync_interval = float(worker_config.get('trigger_sync_interval', 5))
+        self.negative_cache_size = int(worker_config.get('negative_cache_size', 10000))
+        self.dead_letters_max_length = int(worker_config.get('dead_letters_max_length', 10000))
+        self.dead_letters_max_age = float(worker_config.get('dead_letters_max_age', 604800))
+        self.metrics_interval = float(worker_config.get('metrics_interval', 10))
+        self.timer_tick = float(worker_config.get('timer_tick_ms', 100)) / 1000
+        self.process_pool_size = worker_config.get('process_pool_size')
+        self.callables_cache_size = int(worker_config.get('callables_cache_size', 1024))
+        self.callables_cache_dir = worker_config.get('callables_cache_dir')
+        pending_events_memory = int(worker_config.get('pending_events_memory_mb', 64)) * 1024 * 1024
+
+        self.start_time = 0
+        self.trigger_storage = None
+        self.trigger_sync = None
+        self.timers = None
+        self.triggers = {}
+        self.trigger_mapping = TriggerIndex()
+        self.events = PendingEvents(memory_budget=pending_events_memory,
+                                    spill_directory=worker_config.get('pending_events_spill_dir'))
+        self.global_context = {}
+        self.event_sources = {}
+        self.dirty_triggers = set()
+        self.event_queue = None
+        self.control_queue = Queue()
+        self.flow_control = new_flow_control(config, self.__queue_depth, workspace)
+        self.dead_letter_queue = None
+        self.replay_listener = None
+        self.metrics = MetricsRegistry()
+        self.metrics_queue = metrics_queue
+        self.metrics_reporter = None
+        self.tracer = None
+        self.local_event_queue = None
+        self.event_log = new_event_logger(config, 'worker', workspace)
+
+        self.__queue = None
+        self.__locks = {}
+        self.__inflight = Counter()
+        self.__context_released = None
+        self.__tasks = set()
+        self.__fired_transient = set()
+        self.__unknown_events = []
+        self.__reload_task = None
+        self.__pending_commit = []
+        self.__checkpoint_requested = None
+
+        self.state = Worker.State.INITIALIZED
+
+    def __start_db(self):
+        logging.info('[{}] Creating database connection'.format(self.workspace))
+        backend = self.__config['trigger_storage']['backend']
+        trigger_storage_class = getattr(storage, backend.capitalize() + 'TriggerStorage')
+        self.trigger_storage = trigger_storage_class(**self.__config['trigger_storage']['parameters'])
+
+    def __start_event_sources(self):
+        logging.info("[{}] Starting event sources ".format(self.workspace))
+        event_sources = self.trigger_storage.get(workspace=self.workspace, document_id='event_sources')
+        for evt_src in event_sources.values():
+            if evt_src['name'] in self.event_sources:
+                continue
+            logging.info("[{}] Starting {}".format(self.workspace, evt_src['name']))
+            event_source_class = getattr(eventsources, '{}'.format(evt_src['class']))
+            event_source = event_source_class(event_queue=self.event_queue,
+                                              name=evt_src['name'],
+                                              **evt_src['parameters'])
+            event_source.tracer = self.tracer
+            event_source.flow_control = self.flow_control
+            event_source.event_log = new_event_logger(self.__config, 'event_sources', evt_src['name'])
+            event_source.start()
+            self.event_sources[evt_src['name']] = event_source
+
+    def __stop_event_sources(self):
+        logging.info("[{}] Stopping event sources ".format(self.workspace))
+        for evt_src in list(self.event_sources):
+            self.event_sources[evt_src].stop()
+            del self.event_sources[evt_src]
+
+    def __start_dead_letters(self):
+        self.dead_letter_queue = DeadLetterQueue(self.trigger_storage, self.workspace,
+                                                 max_length=self.dead_letters_max_length,
+                                                 max_age=self.dead_letters_max_age)
+        self.dead_letter_queue.start()
+        self.replay_listener = ReplayListener(self.trigger_storage, self.workspace, self.event_queue,
+                                              interval=self.trigger_sync_interval)
+        self.replay_listener.start()
+
+    def __stop_dead_letters(self):
+        self.replay_listener.stop()
+        self.dead_letter_queue.stop()
+
+    def __start_metrics(self):
+        if self.metrics_queue is None:
+            return
+        self.metrics_reporter = MetricsReporter(self.metrics, self.metrics_queue, self.workspace, self.worker_id,
+                                                interval=self.metrics_interval, collect=self.__collect_metrics)
+        self.metrics_reporter.start()
+
+    def __stop_metrics(self):
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop()
+
+    def __collect_metrics(self):
+        self.metrics.set('triggerflow_event_queue_depth', self.event_queue.qsize())
+        self.metrics.set('triggerflow_pending_events_bytes', self.events.memory)
+        self.metrics.set('triggerflow_triggers_loaded', len(self.triggers))
+        self.metrics.set('triggerflow_dead_letters_buffered', self.dead_letter_queue.qsize())
+        self.metrics.set('triggerflow_actions_running', len(self.__tasks))
+        if self.flow_control is not None:
+            self.metrics.set('triggerflow_event_sources_paused', int(self.flow_control.paused))
+            self.metrics.set('triggerflow_event_sources_pauses', self.flow_control.pauses)
+
+    def __queue_depth(self):
+        # Events are taken from the queue right away, the backlog builds up in the tasks in flight
+        return self.event_queue.qsize() + len(self.__tasks)
+
+    def __get_global_context(self):
+        logging.info('[{}] Getting workspace global context'.format(self.workspace))
+        self.global_context = self.trigger_storage.get(workspace=self.workspace, document_id='global_context')
+
+    async def __get_triggers(self):
+        logging.info("[{}] Updating triggers cache".format(self.workspace))
+        loop = asyncio.get_running_loop()
+        try:
+            all_triggers = await loop.run_in_executor(None, self.trigger_sync.load)
+            for trigger_id, trigger_json in all_triggers.items():
+                if trigger_id == "0" or trigger_id in self.triggers:
+                    continue
+                self.__load_trigger(trigger_id, trigger_json)
+        except KeyError:
+            logging.error('Could not retrieve triggers and/or source events for {}'.format(self.workspace))
+            logging.error(traceback.format_exc())
+        logging.info("[{}] Triggers updated".format(self.workspace))
+
+    async def __sync_triggers(self):
+        loop = asyncio.get_running_loop()
+        try:
+            added, deleted = await loop.run_in_executor(None, self.trigger_sync.changes, list(self.triggers))
+        except Exception:
+            logging.error('[{}] Could not retrieve trigger changes'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+
+        for trigger_id, trigger_json in added.items():
+            if trigger_id != "0" and trigger_id not in self.triggers:
+                self.__load_trigger(trigger_id, trigger_json)
+        for trigger_id in deleted:
+            trigger = self.triggers.pop(trigger_id, None)
+            self.__fired_transient.discard(trigger_id)
+            lock = self.__locks.get(trigger_id)
+            if lock is not None and not lock.locked():
+                del self.__locks[trigger_id]
+            if trigger is not None:
+                for event in trigger.activation_events:
+                    self.trigger_mapping.remove(event['subject'], event['type'], trigger_id)
+                self.dirty_triggers.discard(trigger_id)
+
+        if added or deleted:
+            logging.info("[{}] Triggers synced: {} added, {} deleted".format(self.workspace, len(added),
+                                                                             len(deleted)))
+
+    def __load_trigger(self, trigger_id, trigger_json):
+        condition_callable_name = '_'.join(['condition', trigger_json['condition']['name'].lower()])
+        action_callable_name = '_'.join(['action', trigger_json['action']['name'].lower()])
+        condition_callable = getattr(default_conditions, condition_callable_name)
+        # Prefer the coroutine version of the action if there is one
+        action_callable = getattr(async_actions, action_callable_name, None) \
+            or getattr(default_actions, action_callable_name)
+
+        trigger = load_trigger(trigger_id, trigger_json, condition_callable, action_callable,
+                               global_context=self.global_context,
+                               workspace=self.workspace,
+                               local_event_queue=self.local_event_queue,
+                               events=self.events,
+                               trigger_mapping=self.trigger_mapping,
+                               triggers=self.triggers,
+                               dirty_triggers=self.dirty_triggers)
+        self.triggers[trigger_id] = trigger
+
+        for event in trigger_json['activation_events']:
+            self.trigger_mapping.add(event['subject'], event['type'], trigger_id)
+
+    async def __reload_triggers(self):
+        await self.__sync_triggers()
+        unknown_events, self.__unknown_events = self.__unknown_events, []
+        for event in unknown_events:
+            if self.trigger_mapping.match(event['subject'], event['type']):
+                self.__match_event(event)
+            else:
+                logging.warning('[{}] Event with subject {} not in cache'.format(self.workspace, event['subject']))
+                self.trigger_sync.missing.add(event['subject'], event['type'])
+                self.dead_letter_queue.put(event)
+                self.metrics.inc('triggerflow_events_dead_lettered_total')
+        self.__reload_task = None
+        if self.__unknown_events:
+            self.__reload_task = self.__spawn(self.__reload_triggers())
+
+    def __spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    def __process_event(self, event):
+        # The events that guard a timer do not need a trigger
+        self.timers.on_event(event)
+        self.__match_event(event)
+
+    def __match_event(self, event):
+        subject = event['subject']
+        trigger_ids = self.trigger_mapping.match(subject, event['type'])
+
+        if not trigger_ids:
+            # Known to have no trigger, unless a sync is about to add it
+            if self.__reload_task is None and (subject, event['type']) in self.trigger_sync.missing:
+                logging.warning('[{}] Event with subject {} not in cache'.format(self.workspace, subject))
+                self.dead_letter_queue.put(event)
+                self.metrics.inc('triggerflow_events_dead_lettered_total')
+                return
+            # Coalesce the trigger reloads caused by events with unknown subjects
+            self.__unknown_events.append(event)
+            if self.__reload_task is None:
+                self.__reload_task = self.__spawn(self.__reload_triggers())
+            return
+
+        self.event_log.event(event)
+        sequence = self.events.append(subject, event)
+        self.metrics.inc('triggerflow_events_matched_total')
+
+        # Tasks copy the current context, so their spans continue the trace of the event
+        with self.__span('match', event=event, subject=subject, type=event['type']):
+            for trigger_id in trigger_ids:
+                if trigger_id not in self.__locks:
+                    self.__locks[trigger_id] = asyncio.Lock()
+                self.__spawn(self.__fire(self.triggers[trigger_id], event, sequence, self.__locks[trigger_id]))
+
+    def __span(self, name, event=None, **args):
+        if self.tracer is None:
+            return NO_SPAN
+        return self.tracer.span(name, event.get('traceparent') if event is not None else None, **args)
+
+    async def __fire(self, trigger, event, sequence, lock):
+        # The lock is FIFO, so the events of a trigger are evaluated in arrival order
+        async with lock:
+            if trigger.trigger_id in self.__fired_transient:
+                return
+            try:
+                # The condition needs the context, wait for the actions that may be modifying it
+                async with self.__context_released:
+                    await self.__context_released.wait_for(partial(self.__released, context_keys(trigger)))
+                    start = time.perf_counter()
+                    with self.__span('condition', trigger_id=trigger.trigger_id,
+                                     condition=trigger.condition_meta['name']):
+                        condition = trigger.condition(trigger.context, event)
+                self.metrics.observe('triggerflow_condition_seconds', time.perf_counter() - start,
+                                     condition=trigger.condition_meta['name'])
+                if condition:
+                    self.metrics.inc('triggerflow_triggers_fired_total', action=trigger.action_meta['name'])
+                    self.event_log.fired()
+                    await self.__run_action(trigger, event)
+
+                    # Delete transient fired trigger
+                    if trigger.transient:
+                        self.__fired_transient.add(trigger.trigger_id)
+                        for activation_event in trigger.activation_events:
+                            self.trigger_mapping.remove(activation_event['subject'], activation_event['type'],
+                                                        trigger.trigger_id)
+
+                    # Events received later may still be waiting for their triggers
+                    events = self.events.pop(event['subject'], until=sequence)
+                    for activation_event in trigger.activation_events:
+                        if activation_event['subject'] != event['subject']:
+                            events.extend(self.events.pop_matching(activation_event['subject'], until=sequence))
+                    self.__request_checkpoint(events)
+            except Exception:
+                trigger.context['exception'] = traceback.format_exc()
+                logging.warning(trigger.context['exception'])
+                self.metrics.inc('triggerflow_trigger_errors_total')
+                self.__request_checkpoint([])
+
+    async def __run_action(self, trigger, event):
+        """
+        Run the action of a fired trigger once no other action may be modifying the same contexts. The
+        contexts it may modify are held until it finishes, whether it runs on the loop or on the executor.
+        """
+        keys = action_keys(trigger)
+        async with self.__context_released:
+            await self.__context_released.wait_for(partial(self.__released, keys))
+            self.__inflight.update(keys)
+
+        start = time.perf_counter()
+        try:
+            with self.__span('action', trigger_id=trigger.trigger_id, action=trigger.action_meta['name']):
+                if asyncio.iscoroutinefunction(trigger.action):
+                    await trigger.action(trigger.context, event)
+                else:
+                    # Blocking actions run on the executor, in the context of the span
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, partial(contextvars.copy_context().run, trigger.action, trigger.context, event))
+        finally:
+            # Actions may update nested context values in place (e.g. invocation state)
+            trigger.context.set_modified()
+            self.metrics.observe('triggerflow_action_seconds', time.perf_counter() - start,
+                                 action=trigger.action_meta['name'])
+            self.__inflight.subtract(keys)
+            for key in keys:
+                if self.__inflight[key] <= 0:
+                    del self.__inflight[key]
+            async with self.__context_released:
+                self.__context_released.notify_all()
+
+    def __released(self, keys):
+        return not any(key in self.__inflight for key in keys)
+
+    def __request_checkpoint(self, events):
+        self.__pending_commit.extend(events)
+        self.__checkpoint_requested.set()
+
+    def __checkpoint(self, events, modified_triggers):
+        with self.__span('checkpoint', events=len(events), triggers=len(modified_triggers)):
+            if events:
+                self.event_log.log('Committing %d events', len(events), level=logging.INFO)
+                commit_events(self.event_sources, events)
+                if self.timers is not None:
+                    self.timers.commit(events)
+                self.metrics.inc('triggerflow_events_committed_total', len(events))
+
+            if modified_triggers:
+                self.event_log.log('Checkpoint of %d triggers', len(modified_triggers), level=logging.INFO)
+                start = time.perf_counter()
+                self.trigger_storage.set_keys(workspace=self.workspace, document_id='triggers', data=modified_triggers)
+                self.metrics.observe('triggerflow_checkpoint_seconds', time.perf_counter() - start)
+                self.metrics.observe('triggerflow_checkpoint_triggers', len(modified_triggers), buckets=SIZE_BUCKETS)
+
+    async def __commiter(self):
+        """
+        Commit events and checkpoint modified triggers. Checkpoint requests made while a
+        checkpoint is being written are coalesced into the next one.
+        """
+        loop = asyncio.get_running_loop()
+        logging.info('[{}] Starting committer task'.format(self.workspace))
+
+        while True:
+            await self.__checkpoint_requested.wait()
+            self.__checkpoint_requested.clear()
+
+            events, self.__pending_commit = self.__pending_commit, []
+            trigger_ids = self.dirty_triggers.copy()
+            self.dirty_triggers.clear()
+            # Serialize the contexts on the loop, so they are not modified while being written
+            modified_triggers = {trigger_id: self.triggers[trigger_id].to_dict()
+                                 for trigger_id in trigger_ids if trigger_id in self.triggers}
+            try:
+                await loop.run_in_executor(None, self.__checkpoint, events, modified_triggers)
+                for trigger_id in trigger_ids:
+                    if trigger_id in self.triggers and trigger_id not in self.dirty_triggers:
+                        self.triggers[trigger_id].context.modified = False
+            except Exception:
+                # Keep the triggers dirty, so they are written on the next checkpoint
+                self.dirty_triggers.update(trigger_ids)
+                logging.error('[{}] Checkpoint failed'.format(self.workspace))
+                logging.error(traceback.format_exc())
+
+            if not self.__should_run():
+                break
+
+    def __wait_stop(self):
+        self.control_queue.get()
+        self.event_queue.put(None)
+
+    def __should_run(self):
+        return self.state == Worker.State.RUNNING
+
+    async def __main(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_inflight_invocations))
+
+        callables.configure(self.process_pool_size, self.callables_cache_size, self.callables_cache_dir)
+        self.__queue = asyncio.Queue()
+        self.__checkpoint_requested = asyncio.Event()
+        self.__context_released = asyncio.Condition()
+        self.event_queue = AsyncEventQueue(loop, self.__queue)
+
+        await loop.run_in_executor(None, self.__start_db)
+        self.__start_dead_letters()
+        self.__start_metrics()
+        self.tracer = new_tracer(self.__config, self.workspace)
+        if self.tracer is not None:
+            self.local_event_queue = TracedEventQueue(self.event_queue)
+        else:
+            self.local_event_queue = self.event_queue
+        await loop.run_in_executor(None, self.__get_global_context)
+        await loop.run_in_executor(None, self.__start_event_sources)
+        self.trigger_sync = TriggerSync(self.trigger_storage, self.workspace,
+                                        interval=self.trigger_sync_interval,
+                                        negative_cache_size=self.negative_cache_size)
+        await self.__get_triggers()
+        self.trigger_sync.start()
+        self.timers = TimerService(self.trigger_storage, self.workspace, self.event_queue,
+                                   tick=self.timer_tick, interval=self.trigger_sync_interval)
+        await loop.run_in_executor(None, self.timers.load)
+        self.timers.start()
+
+        logging.info('[{}] Worker {} Started'.format(self.workspace, self.worker_id))
+        self.state = Worker.State.RUNNING
+
+        Thread(target=self.__wait_stop, daemon=True).start()
+        commiter = loop.create_task(self.__commiter())
+
+        while self.__should_run():
+            event = await self.__queue.get()
+            if event is None:
+                break
+            self.metrics.inc('triggerflow_events_received_total', event_source=event.get('event_source') or 'local')
+            if self.trigger_sync.pending and self.__reload_task is None:
+                self.__reload_task = self.__spawn(self.__reload_triggers())
+            self.__process_event(event)
+
+        # Let in-flight conditions and actions finish, then perform a last checkpoint
+        while self.__tasks:
+            await asyncio.gather(*list(self.__tasks), return_exceptions=True)
+        self.state = Worker.State.FINISHED
+        self.__checkpoint_requested.set()
+        await commiter
+        await loop.run_in_executor(None, callables.shutdown)
+        self.trigger_sync.stop()
+        self.timers.stop()
+        await loop.run_in_executor(None, self.__stop_dead_letters)
+        await loop.run_in_executor(None, self.__stop_event_sources)
+        self.__stop_metrics()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def run(self):
+        logging.info('[{}] Starting async worker {}'.format(self.workspace, self.worker_id))
+        self.start_time = datetime.now()
+        asyncio.run(self.__main())
+        logging.info("[{}] Worker {} finished".format(self.workspace, self.worker_id))
+
+    def stop_worker(self):
+        logging.info("[{}] Stopping Worker {}".format(self.workspace, self.worker_id))
+        self.control_queue.put(None)
+        self.join(timeout=30)
+        try:
+            self.terminate()
+        except Exception:
+            pass
+        logging.info("[{}] Worker {} stopped".format(self.workspace, self.worker_id))
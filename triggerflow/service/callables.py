@@ -0,0 +1,213 @@
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from threading import Lock
+from base64 import b64decode
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+pool = None
+pool_size = None
+pool_lock = Lock()
+# Futures submitted to the pool and not done yet, cancelled on shutdown
+pending = set()
+
+
+class CallableCache:
+    """
+    Decoded `PythonCallable`s, keyed by the sha256 digest of their pickled bytes, so the triggers that use
+    the same function share a single copy of it. The least recently used ones are evicted beyond `max_size`.
+
+    If `directory` is set, the pickled callables are also stored in it by digest, so the processes of the
+    node (e.g. the process pool) can load a callable from its digest alone.
+    """
+
+    def __init__(self, max_size: int = 1024, directory: str = None):
+        self.max_size = max(1, max_size)
+        self.directory = directory
+        self.loads = 0
+        self.__callables = OrderedDict()
+        # Digest of each encoded callable by the id of the string, which is the same object in every
+        # activation of a trigger, so the callable is not hashed again
+        self.__digests = OrderedDict()
+        self.__stored = set()
+        self.__lock = Lock()
+
+    def get(self, encoded_callable: str) -> callable:
+        """
+        Returns the function of a base64 encoded `PythonCallable`
+        """
+        return self.lookup(self.digest(encoded_callable), encoded_callable)
+
+    def digest(self, encoded_callable: str) -> str:
+        entry = self.__digests.get(id(encoded_callable))
+        if entry is not None and entry[0] is encoded_callable:
+            return entry[1]
+
+        digest = hashlib.sha256(b64decode(encoded_callable.encode('utf-8'))).hexdigest()
+        with self.__lock:
+            self.__digests[id(encoded_callable)] = (encoded_callable, digest)
+            if len(self.__digests) > self.max_size:
+                self.__digests.popitem(last=False)
+        return digest
+
+    def lookup(self, digest: str, encoded_callable: str = None) -> callable:
+        """
+        Returns the function with a digest, decoding `encoded_callable` or, if not given, loading it
+        from the cache directory if it is not cached
+        """
+        function = self.__callables.get(digest)
+        if function is not None:
+            try:
+                self.__callables.move_to_end(digest)
+            except KeyError:
+                # Evicted meanwhile by another thread
+                pass
+            return function
+
+        if encoded_callable is not None:
+            payload = b64decode(encoded_callable.encode('utf-8'))
+        else:
+            with open(self.__path(digest), 'rb') as callable_file:
+                payload = callable_file.read()
+        function = pickle.loads(payload)
+
+        with self.__lock:
+            self.loads += 1
+            self.__callables[digest] = function
+            if len(self.__callables) > self.max_size:
+                self.__callables.popitem(last=False)
+        return function
+
+    def store(self, digest: str, encoded_callable: str) -> bool:
+        """
+        Stores a callable in the cache directory. Returns True if it can be loaded from there.
+        """
+        if self.directory is None:
+            return False
+        if digest in self.__stored:
+            return True
+
+        path = self.__path(digest)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                # Written to a temporary file first, so other processes never read a partial callable
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + digest)
+                with os.fdopen(fd, 'wb') as callable_file:
+                    callable_file.write(b64decode(encoded_callable.encode('utf-8')))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning('Could not store callable {} in {}: {}'.format(digest, self.directory, e))
+            return False
+        with self.__lock:
+            self.__stored.add(digest)
+        return True
+
+    def __path(self, digest):
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def __len__(self):
+        return len(self.__callables)
+
+
+cache = CallableCache()
+
+
+class PoolEventQueue(list):
+    """
+    Collects the events put by a callable running in a pool process, they are put in the worker
+    event queue once the callable returns
+    """
+
+    def put(self, event):
+        self.append(event)
+
+
+class PoolContext(dict):
+    """
+    Context of a trigger inside a pool process. It is a copy of the trigger context with the workspace
+    attributes that can be used from another process (the global context is a read-only copy).
+    """
+
+    def __init__(self, context: dict, trigger_id: str, workspace: str, global_context: dict):
+        super().__init__(context)
+        self.trigger_id = trigger_id
+        self.workspace = workspace
+        self.global_context = global_context
+        self.local_event_queue = PoolEventQueue()
+
+
+def _initialize(cache_size, cache_directory):
+    global cache
+    cache = CallableCache(cache_size, cache_directory)
+
+
+def _call(digest, encoded_callable, context, event, trigger_id, workspace, global_context):
+    function = cache.lookup(digest, encoded_callable)
+    pool_context = PoolContext(context, trigger_id, workspace, global_context)
+    result = function(context=pool_context, event=event)
+    return result, dict(pool_context), list(pool_context.local_event_queue)
+
+
+def configure(size: int = None, cache_size: int = 1024, cache_directory: str = None):
+    """
+    Sets the number of processes of the pool (the number of CPUs by default), and the size and directory
+    of the callable cache
+    """
+    global pool_size, cache
+    pool_size = size
+    # Workers hosted in the same process share the cache
+    if (cache.max_size, cache.directory) != (max(1, cache_size), cache_directory):
+        cache = CallableCache(cache_size, cache_directory)
+
+
+def call(context, encoded_callable: str, event: dict):
+    """
+    Calls a cloudpickled `PythonCallable` in the process pool of the worker, so CPU bound functions do not
+    hold the worker GIL. Each pool process decodes the callable once (it is cached by digest), and only the
+    digest is sent to the pool once the callable is in the cache directory. The context and the event are
+    pickled, and the changes made by the callable to the context are merged back.
+
+    The pool is shared by the workers of all the workspaces of the process (see `WorkerHost`), so the
+    workspace and its global context are sent with each call.
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            size = pool_size or os.cpu_count()
+            logging.info('Starting process pool of {} processes for Python callables'.format(size))
+            pool = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_initialize, initargs=(cache.max_size, cache.directory))
+
+    digest = cache.digest(encoded_callable)
+    if cache.store(digest, encoded_callable):
+        encoded_callable = None
+    future = pool.submit(_call, digest, encoded_callable, dict(context), dict(event), context.trigger_id,
+                         context.workspace, dict(context.global_context))
+    pending.add(future)
+    future.add_done_callback(pending.discard)
+    result, updated_context, events = future.result()
+
+    for context_key in [context_key for context_key in context if context_key not in updated_context]:
+        dict.__delitem__(context, context_key)
+    dict.update(context, updated_context)
+    context.set_modified()
+
+    for event in events:
+        context.local_event_queue.put(event)
+
+    return result
+
+
+def shutdown():
+    global pool
+    if pool is not None:
+        # Cancels the calls not started yet, as executors only do it on shutdown since Python 3.9
+        for future in list(pending):
+            future.cancel()
+        pool.shutdown(wait=False)
+        pool = None
@@ -1,46 +1,48 @@
-from jsonpath_ng import parse, jsonpath
+import re
+import operator
+from threading import Lock
+from collections import OrderedDict
 from dateutil import parser
 
-lambdas_comparisons = {
-    'BooleanEquals': lambda a, b: a == b,
-    'NumericEquals': lambda a, b: a == b,
-    'NumericGreaterThan': lambda a, b: a > b,
-    'NumericGreaterThanEquals': lambda a, b: a >= b,
-    'NumericLessThan': lambda a, b: a < b,
-    'NumericLessThanEquals': lambda a, b: a <= b,
-    'StringEquals': lambda a, b: a == b,
-    'StringGreaterThan': lambda a, b: a > b,
-    'StringGreaterThanEquals': lambda a, b: a >= b,
-    'StringLessThan': lambda a, b: a < b,
-    'StringLessThanEquals': lambda a, b: a <= b,
-    'TimestampEquals': lambda a, b: parser.parse(a) == parser.parse(b),
-    'TimestampGreaterThan': lambda a, b: parser.parse(a) > parser.parse(a),
-    'TimestampGreaterThanEquals': lambda a, b: parser.parse(a) >= parser.parse(a),
-    'TimestampLessThan': lambda a, b: parser.parse(a) < parser.parse(a),
-    'TimestampLessThanEquals': lambda a, b: parser.parse(a) < parser.parse(a)
+from ..jsonpaths import compile_path
+
+comparisons = {
+    'BooleanEquals': operator.eq,
+    'NumericEquals': operator.eq,
+    'NumericGreaterThan': operator.gt,
+    'NumericGreaterThanEquals': operator.ge,
+    'NumericLessThan': operator.lt,
+    'NumericLessThanEquals': operator.le,
+    'StringEquals': operator.eq,
+    'StringGreaterThan': operator.gt,
+    'StringGreaterThanEquals': operator.ge,
+    'StringLessThan': operator.lt,
+    'StringLessThanEquals': operator.le,
+    'TimestampEquals': operator.eq,
+    'TimestampGreaterThan': operator.gt,
+    'TimestampGreaterThanEquals': operator.ge,
+    'TimestampLessThan': operator.lt,
+    'TimestampLessThanEquals': operator.le
+}
+
+type_checks = {
+    'IsNull': lambda value: value is None,
+    'IsBoolean': lambda value: isinstance(value, bool),
+    'IsNumeric': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'IsString': lambda value: isinstance(value, str),
+    'IsTimestamp': lambda value: isinstance(value, str) and _is_timestamp(value)
 }
 
+# Compiled rule of each Choice condition, see `compiled_rule`
+_compiled_rules = OrderedDict()
+_compiled_rules_lock = Lock()
+_COMPILED_RULES_SIZE = 10000
+
 
 def condition_aws_asf_condition(context, event):
     if 'Condition' in context:
-        condition = context['Condition']
-        if 'Not' in condition:
-            eval_condition = not __evaluate_condition(condition, context['global_context'])
-        elif 'And' in condition:
-            eval_condition = True
-            for cond in condition['And']:
-                if not __evaluate_condition(cond, context['global_context']):
-                    eval_condition = False
-                    break
-        elif 'Or' in condition:
-            eval_condition = False
-            for cond in condition['Or']:
-                if __evaluate_condition(cond, context['global_context']):
-                    eval_condition = True
-                    break
-        else:
-            eval_condition = __evaluate_condition(condition, event['data'])
-        return eval_condition
+        # Not, And and Or are evaluated against the state input too
+        return compiled_rule(context['Condition'])(event['data'])
     else:
         return True
 
@@ -57,15 +59,120 @@ def condition_aws_asf_join_statemachine(context, event):
         return True
 
 
-def __evaluate_condition(condition, data):
-    exp = parse(condition['Variable'])
-    matches = [match.value for match in exp.find(data)]
+def compiled_rule(condition: dict) -> callable:
+    """
+    Returns the compiled Choice rule of a trigger condition. Rules are compiled the first time the
+    condition of a loaded trigger is evaluated, and kept while the condition is in use (least recently
+    used ones are evicted).
+    """
+    entry = _compiled_rules.get(id(condition))
+    # The entry keeps the condition alive, so its id is not reused by another condition
+    if entry is not None and entry[0] is condition:
+        try:
+            _compiled_rules.move_to_end(id(condition))
+        except KeyError:
+            # Evicted meanwhile
+            pass
+        return entry[1]
+
+    rule = compile_rule(condition)
+    with _compiled_rules_lock:
+        _compiled_rules[id(condition)] = (condition, rule)
+        if len(_compiled_rules) > _COMPILED_RULES_SIZE:
+            _compiled_rules.popitem(last=False)
+    return rule
+
+
+def compile_rule(rule: dict) -> callable:
+    """
+    Compiles a Choice rule (`Not`, `And`, `Or` or a comparison of its `Variable`) into a function of the
+    state input that returns whether the rule matches
+    """
+    if 'Not' in rule:
+        inner = compile_rule(rule['Not'])
+        return lambda data: not inner(data)
+    if 'And' in rule:
+        rules = [compile_rule(inner) for inner in rule['And']]
+        return lambda data: all(inner(data) for inner in rules)
+    if 'Or' in rule:
+        rules = [compile_rule(inner) for inner in rule['Or']]
+        return lambda data: any(inner(data) for inner in rules)
+    return _compile_comparison(rule)
+
+
+def _compile_comparison(rule):
+    variable = compile_path(rule['Variable'])
+
+    for name, expected in rule.items():
+        if name in comparisons:
+            compare = comparisons[name]
+            if name.startswith('Timestamp'):
+                expected = _timestamp(expected)
+                return _every_value(variable, lambda value: compare(_timestamp(value), expected))
+            return _every_value(variable, lambda value: compare(value, expected))
+
+        if name.endswith('Path') and name[:-4] in comparisons:
+            return _compile_path_comparison(variable, comparisons[name[:-4]], name.startswith('Timestamp'),
+                                            compile_path(expected))
+
+        if name in type_checks:
+            check = type_checks[name]
+            return _every_value(variable, lambda value: check(value) == expected)
+
+        if name == 'IsPresent':
+            return lambda data: bool(variable.values(data)) == expected
+
+        if name == 'StringMatches':
+            pattern = re.compile(_wildcard_pattern(expected), re.DOTALL)
+            return _every_value(variable, lambda value: isinstance(value, str) and pattern.fullmatch(value) is not None)
+
+    raise ValueError('Choice rule without a supported comparison: {}'.format(rule))
+
+
+def _every_value(variable, predicate):
+    # Every match of the variable must satisfy the comparison
+    def evaluate(data):
+        for value in variable.values(data):
+            if not predicate(value):
+                return False
+        return True
+
+    return evaluate
+
+
+def _compile_path_comparison(variable, compare, timestamps, path):
+    convert = _timestamp if timestamps else (lambda value: value)
+
+    def evaluate(data):
+        others = path.values(data)
+        if not others:
+            return False
+        expected = convert(others[0])
+        for value in variable.values(data):
+            if not compare(convert(value), expected):
+                return False
+        return True
+
+    return evaluate
+
+
+def _timestamp(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return parser.isoparse(value)
+    except ValueError:
+        return parser.parse(value)
+
+
+def _is_timestamp(value):
+    try:
+        parser.isoparse(value)
+        return True
+    except ValueError:
+        return False
 
-    results = []
-    for match in matches:
-        intersect = set(condition).intersection(set(lambdas_comparisons)).pop()
-        f = lambdas_comparisons[intersect]
-        res = f(match, condition[intersect])
-        results.append(res)
 
-    return all(results)
+def _wildcard_pattern(pattern):
+    # `*` matches any string, `\*` is a literal asterisk
+    return '.*'.join(re.escape(part.replace('\\*', '*')) for part in re.split(r'(?<!\\)\*', pattern))
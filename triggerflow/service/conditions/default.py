@@ -1,13 +1,15 @@
 import dill
+import time
 import docker
 import requests
-import pickle
-from base64 import b64decode
+from math import ceil
+from datetime import timezone
+from dateutil import parser
 
-docker_containers = {}
-
-python_condition_callables = {}
+from .. import callables
+from ..expressions import compile_expression
 
+docker_containers = {}
 
 
 def condition_true(context, event):
@@ -19,6 +21,7 @@ def condition_dag_task_join(context, event):
         context['result'].append(event['data'])
 
     context['dependencies'][event['subject']]['counter'] += 1
+    context.set_modified()
 
     return all([dep['counter'] == dep['join'] for dep in context['dependencies'].values()])
 
@@ -50,22 +53,166 @@ def condition_counter_threshold(context, event):
     return context['counter'] >= context['threshold']
 
 
-def condition_python_callable(context, event):
-    global python_condition_callables
+def _event_time(event):
+    """
+    Event time of an event, from its CloudEvent `time` attribute (RFC 3339 or seconds since epoch), or its
+    arrival time if it has none
+    """
+    timestamp = event.get('time')
+    if timestamp is None:
+        return time.time()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    event_time = parser.isoparse(timestamp)
+    # Timestamps without an offset are taken as UTC, not as the local time of the worker
+    if event_time.tzinfo is None:
+        event_time = event_time.replace(tzinfo=timezone.utc)
+    return event_time.timestamp()
+
+
+def _field_value(event, field):
+    value = event.get('data')
+    if field is None:
+        return None
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _aggregate(window, value):
+    # Windows are [start, end, count, count of values, sum, min, max]
+    window[2] += 1
+    if value is not None:
+        window[3] += 1
+        window[4] += value
+        window[5] = value if window[5] is None else min(window[5], value)
+        window[6] = value if window[6] is None else max(window[6], value)
+
+
+def _window_result(window):
+    start, end, count, values, total, minimum, maximum = window
+    return {'start': start, 'end': end, 'count': count, 'sum': total, 'min': minimum, 'max': maximum,
+            'mean': total / values if values else None}
+
+
+def _late_event(context):
+    context['late_events'] = context.get('late_events', 0) + 1
+
+
+def _time_windows(context, event, starts):
+    """
+    Adds an event to the windows of the given start times and closes the windows that end before the
+    watermark (the latest event time seen minus the allowed `lateness`). The closed windows are set in
+    `context['closed_windows']`, and the condition is met if any was closed.
+    """
+    size = context['size']
+    event_time = _event_time(event)
+    watermark = max(context.get('watermark', event_time), event_time)
+    context['watermark'] = watermark
+    watermark -= context.get('lateness', 0)
+
+    windows = context.setdefault('windows', {})
+    closed = [window for window in windows.values() if window[1] <= watermark]
+    for window in closed:
+        del windows[repr(window[0])]
+
+    value = _field_value(event, context.get('field'))
+    for start in starts(event_time):
+        if start + size <= watermark:
+            _late_event(context)
+            continue
+        key = repr(start)
+        if key not in windows:
+            windows[key] = [start, start + size, 0, 0, 0, None, None]
+        _aggregate(windows[key], value)
+
+    context['closed_windows'] = [_window_result(window) for window in sorted(closed)]
+    return bool(closed)
+
+
+def condition_tumbling_window(context, event):
+    """
+    Aggregates events (count, and sum, min, max and mean of `context['field']` of their data) in fixed,
+    non-overlapping windows of `context['size']` seconds of event time
+    """
+    size = context['size']
+    return _time_windows(context, event, lambda event_time: [event_time - event_time % size])
+
+
+def condition_sliding_window(context, event):
+    """
+    Aggregates events in windows of `context['size']` seconds of event time that start every
+    `context['slide']` seconds, so each event is added to size / slide windows
+    """
+    size, slide = context['size'], context['slide']
+
+    def starts(event_time):
+        first = event_time - event_time % slide
+        return [first - i * slide for i in range(ceil(size / slide)) if first - i * slide + size > event_time]
+
+    return _time_windows(context, event, starts)
+
+
+def condition_session_window(context, event):
+    """
+    Aggregates events in sessions of activity: a session is closed when an event arrives more than
+    `context['gap']` seconds of event time after its last event
+    """
+    gap = context['gap']
+    event_time = _event_time(event)
+    value = _field_value(event, context.get('field'))
+    session = context.get('session')
+
+    closed = []
+    if session is not None:
+        if event_time > session[1] + gap:
+            closed.append(_window_result(session))
+            session = None
+        elif event_time < session[0] - gap:
+            # Belongs to a closed session
+            _late_event(context)
+            context['closed_windows'] = closed
+            return False
+
+    if session is None:
+        session = [event_time, event_time, 0, 0, 0, None, None]
+    session[0], session[1] = min(session[0], event_time), max(session[1], event_time)
+    _aggregate(session, value)
+    context['session'] = session
+
+    context['closed_windows'] = closed
+    return bool(closed)
 
-    if context.trigger_id not in python_condition_callables:
-        decoded_callable = b64decode(context.triggers[context.trigger_id].condition_meta['callable'].encode('utf-8'))
-        f = pickle.loads(decoded_callable)
-        python_condition_callables[context.trigger_id] = f
 
-    f = python_condition_callables[context.trigger_id]
+def condition_python_callable(context, event):
+    condition_meta = context.triggers[context.trigger_id].condition_meta
+    if condition_meta.get('process_pool'):
+        result = callables.call(context, condition_meta['callable'], event)
+        assert isinstance(result, bool)
+        return result
+
+    f = callables.cache.get(condition_meta['callable'])
     result = f(context=context, event=event)
+    # The function may have updated nested context values in place
+    context.set_modified()
 
     assert isinstance(result, bool)
 
     return result
 
 
+def condition_expression(context, event):
+    # Compiled once per expression, and shared by the triggers with the same expression
+    expression = compile_expression(context.triggers[context.trigger_id].condition_meta['expression'])
+    if expression.counter:
+        context['counter'] = context.get('counter', 0) + 1
+    return bool(expression(event, context))
+
+
 def condition_docker(context, event):
     global docker_containers
     condition_meta = context.triggers[context.trigger_id].condition_meta['image']
@@ -0,0 +1,101 @@
+import time
+import queue
+import logging
+import traceback
+from threading import Thread
+
+
+class DeadLetterQueue(Thread):
+    """
+    Dead letters of a workspace, i.e. events that did not activate any trigger.
+
+    `put` only buffers the event, the thread writes the buffered events to the trigger storage in
+    batches. The storage keeps at most `max_length` dead letters for at most `max_age` seconds, and
+    they can be listed and replayed through the trigger API.
+    """
+
+    def __init__(self, trigger_storage, workspace: str, max_length: int = 10000, max_age: float = 604800):
+        super().__init__(daemon=True)
+        self.trigger_storage = trigger_storage
+        self.workspace = workspace
+        self.max_length = max_length
+        self.max_age = max_age
+        self.__buffer = queue.SimpleQueue()
+
+    def put(self, event: dict):
+        self.__buffer.put(dict(event))
+
+    def qsize(self):
+        return self.__buffer.qsize()
+
+    def run(self):
+        while True:
+            events = [self.__buffer.get()]
+            while True:
+                try:
+                    events.append(self.__buffer.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in events
+            events = [event for event in events if event is not None]
+            if events:
+                try:
+                    self.trigger_storage.add_dead_letters(workspace=self.workspace, events=events,
+                                                          max_length=self.max_length, max_age=self.max_age)
+                    logging.info('[{}] Stored {} dead letters'.format(self.workspace, len(events)))
+                except Exception:
+                    logging.error('[{}] Could not store {} dead letters'.format(self.workspace, len(events)))
+                    logging.error(traceback.format_exc())
+            if stop:
+                break
+
+    def stop(self):
+        """
+        Writes the buffered events and stops the thread
+        """
+        self.__buffer.put(None)
+        self.join(timeout=10)
+
+
+class ReplayListener(Thread):
+    """
+    Puts back in the event queue of a worker the dead letters replayed through the trigger API, and
+    acknowledges them once they are in the queue so they are removed from the trigger storage
+    """
+
+    def __init__(self, trigger_storage, workspace: str, event_queue, interval: float = 5.0):
+        super().__init__(daemon=True)
+        self.trigger_storage = trigger_storage
+        self.workspace = workspace
+        self.event_queue = event_queue
+        self.interval = interval
+        self.__stopped = False
+
+    def run(self):
+        while not self.__stopped:
+            try:
+                events = self.trigger_storage.pop_replayed_events(workspace=self.workspace, timeout=self.interval)
+            except Exception:
+                logging.error('[{}] Error getting replayed events'.format(self.workspace))
+                logging.error(traceback.format_exc())
+                time.sleep(self.interval)
+                continue
+
+            if not events:
+                continue
+
+            logging.info('[{}] Replaying {} dead letters'.format(self.workspace, len(events)))
+            for event in events:
+                # Tuple ids (e.g. Kafka) come back as lists from the trigger storage
+                if isinstance(event.get('id'), list):
+                    event['id'] = tuple(event['id'])
+                self.event_queue.put(event)
+            try:
+                self.trigger_storage.ack_replayed_events(workspace=self.workspace)
+            except Exception:
+                logging.error('[{}] Could not acknowledge {} replayed events'.format(self.workspace, len(events)))
+                logging.error(traceback.format_exc())
+
+    def stop(self):
+        self.__stopped = True
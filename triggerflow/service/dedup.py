@@ -0,0 +1,209 @@
+import math
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+
+def _hashable(event_id):
+    """
+    Event ids of some event sources are tuples (e.g. Kafka topic, partition and offset), they come back
+    as lists once they have gone through JSON (checkpoints, dead letters)
+    """
+    return tuple(event_id) if isinstance(event_id, list) else event_id
+
+
+class BloomFilter:
+    """
+    Fixed size Bloom filter. Keys are given as the two 64 bit hashes of `ScalableBloomFilter.hashes`,
+    the positions of the key are derived from them by double hashing.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, hashes: tuple) -> bool:
+        """
+        Adds a key. Returns True if it may have been added before.
+        """
+        h1, h2 = hashes
+        bits, num_bits = self.bits, self.num_bits
+        present = True
+        for position in [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]:
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, hashes: tuple):
+        h1, h2 = hashes
+        bits, num_bits = self.bits, self.num_bits
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that adds a new filter, `growth` times larger and with a `tightening` times lower error
+    rate, when the current one is full, so the error rate stays bounded however many keys are added.
+    Memory is bounded too: when there are more than `max_filters` filters the oldest one is dropped,
+    forgetting the oldest keys.
+    """
+
+    def __init__(self, initial_capacity: int = 10000, error_rate: float = 0.001, growth: int = 2,
+                 tightening: float = 0.8, max_filters: int = 8):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.max_filters = max_filters
+        self.filters = [BloomFilter(initial_capacity, error_rate * (1 - tightening))]
+
+    @staticmethod
+    def hashes(key: str) -> tuple:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+    def add(self, hashes: tuple) -> bool:
+        """
+        Adds a key. Returns True if it may have been added before.
+        """
+        current = self.filters[-1]
+        if current.count >= current.capacity:
+            error_rate = self.error_rate * (1 - self.tightening) * self.tightening ** len(self.filters)
+            current = BloomFilter(current.capacity * self.growth, error_rate)
+            self.filters.append(current)
+            if len(self.filters) > self.max_filters:
+                del self.filters[0]
+        if current.add(hashes):
+            return True
+        return any(hashes in bloom_filter for bloom_filter in self.filters[:-1])
+
+    def __contains__(self, hashes: tuple):
+        return any(hashes in bloom_filter for bloom_filter in reversed(self.filters))
+
+    @property
+    def memory(self):
+        return sum(len(bloom_filter.bits) for bloom_filter in self.filters)
+
+
+class EventDeduplicator:
+    """
+    Detects events delivered more than once (e.g. replayed by their event source on restart), keyed by
+    their CloudEvent `source` and `id`.
+
+    Keys are kept in an exact LRU window of the last `window` keys, and in a scalable Bloom filter that
+    remembers many more keys in bounded memory. The Bloom filter is checked first: most events are new,
+    and a miss tells they are without looking at the window. An event is only dropped as duplicate if its
+    key is in the window: a Bloom filter hit outside of it may be a false positive, so the event is
+    processed and counted as an unconfirmed duplicate.
+
+    The keys of the events taken from an event source and not committed yet are the ones that can be
+    replayed after a restart. They are checkpointed with the trigger contexts (see `state`), and put in
+    the window again when the worker starts.
+    """
+
+    def __init__(self, window: int = 10000, bloom_capacity: int = 10000, bloom_error_rate: float = 0.01,
+                 bloom_max_filters: int = 8):
+        self.window_size = window
+        # Each filter but the first one holds at least `window` keys, so the keys in the window are always
+        # in the last two filters and a Bloom filter miss is never a false negative
+        self.bloom = ScalableBloomFilter(initial_capacity=max(bloom_capacity, window), error_rate=bloom_error_rate,
+                                         max_filters=max(2, bloom_max_filters))
+        self.duplicates = 0
+        self.unconfirmed = 0
+        self.__window = OrderedDict()
+        self.__uncommitted = OrderedDict()
+        self.__restored = set()
+        self.__lock = Lock()
+
+    def is_duplicate(self, event: dict) -> bool:
+        """
+        Returns True if the event was already seen, otherwise records it
+        """
+        event_id = _hashable(event.get('id'))
+        if event_id is None:
+            return False
+        key = '{}\x1f{}'.format(event.get('source'), event_id)
+        hashes = self.bloom.hashes(key)
+
+        with self.__lock:
+            if self.bloom.add(hashes):
+                if key in self.__window:
+                    self.__window.move_to_end(key)
+                    self.duplicates += 1
+                    return True
+                self.unconfirmed += 1
+            self.__window[key] = None
+            if len(self.__window) > self.window_size:
+                self.__window.popitem(last=False)
+
+            event_source = event.get('event_source')
+            if event_source is not None:
+                # Events that do not activate any trigger are never committed, so this is bounded too
+                self.__uncommitted[(event_source, event_id)] = key
+                if len(self.__uncommitted) > self.window_size:
+                    self.__uncommitted.popitem(last=False)
+        return False
+
+    def is_replayed(self, event: dict) -> bool:
+        """
+        Returns True the first time a duplicate of an uncommitted event restored from the checkpoint is seen,
+        i.e. an event that was pending when the worker stopped
+        """
+        with self.__lock:
+            try:
+                self.__restored.remove((event.get('event_source'), _hashable(event.get('id'))))
+                return True
+            except KeyError:
+                return False
+
+    def commit(self, events: list):
+        """
+        Forgets the uncommitted keys of committed (event source, id) pairs
+        """
+        with self.__lock:
+            for event_source, event_id in events:
+                event = (event_source, _hashable(event_id))
+                self.__uncommitted.pop(event, None)
+                self.__restored.discard(event)
+
+    def state(self) -> dict:
+        with self.__lock:
+            return {'uncommitted': [[event_source, event_id, key]
+                                    for (event_source, event_id), key in self.__uncommitted.items()]}
+
+    def restore(self, state: dict):
+        with self.__lock:
+            for event_source, event_id, key in state.get('uncommitted', []):
+                event = (event_source, _hashable(event_id))
+                self.__uncommitted[event] = key
+                self.__restored.add(event)
+                self.__window[key] = None
+                self.bloom.add(self.bloom.hashes(key))
+
+    def __len__(self):
+        return len(self.__window)
+
+
+def new_deduplicator(config: dict):
+    """
+    Instantiates the deduplicator configured in the `worker.dedup` section of the config map. Returns None
+    if deduplication is not enabled.
+    """
+    dedup_config = (config.get('worker') or {}).get('dedup') or {}
+    if not dedup_config.get('enabled', False):
+        return None
+    return EventDeduplicator(window=int(dedup_config.get('window', 10000)),
+                             bloom_capacity=int(dedup_config.get('bloom_capacity', 10000)),
+                             bloom_error_rate=float(dedup_config.get('bloom_error_rate', 0.01)),
+                             bloom_max_filters=int(dedup_config.get('bloom_max_filters', 8)))
@@ -0,0 +1,97 @@
+import time
+import logging
+
+
+class EventLogger:
+    """
+    Logger for the per-event hot paths of workers and event sources.
+
+    Per-event records are sampled (one of every 1 / `sample_rate` calls) and rate limited to `max_per_second`,
+    and they are only formatted when emitted. The events and fires counted are logged as an aggregate
+    summary line (events/s, fires/s) at INFO level every `summary_interval` seconds instead.
+    """
+
+    def __init__(self, name: str, level: int = logging.DEBUG, sample_rate: float = 0.01,
+                 max_per_second: int = 10, summary_interval: float = 60.0, logger: logging.Logger = None):
+        self.name = name
+        self.level = level
+        self.sample_every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.max_per_second = max_per_second
+        self.summary_interval = summary_interval
+        self.logger = logger or logging.getLogger()
+
+        self.events = 0
+        self.fires = 0
+        self.suppressed = 0
+        # Sampled separately, so the records of one method do not shift the sampling of the other
+        self.__event_calls = 0
+        self.__log_calls = 0
+        self.__second = 0
+        self.__emitted = 0
+        self.__summary_time = time.monotonic()
+        self.__summary_events = 0
+        self.__summary_fires = 0
+
+    def event(self, event: dict, message: str = 'New event'):
+        """
+        Counts an event and logs it if sampled, with its routing attributes
+        """
+        self.events += 1
+        now = time.monotonic()
+        if now - self.__summary_time >= self.summary_interval:
+            self.__summary(now)
+        self.__event_calls += 1
+        if self.__sampled(self.__event_calls, now):
+            self.logger.log(self.level, '[%s] %s subject=%s type=%s source=%s id=%s', self.name, message,
+                            event.get('subject'), event.get('type'), event.get('source'), event.get('id'))
+
+    def fired(self, count: int = 1):
+        self.fires += count
+
+    def log(self, message: str, *args, level: int = None):
+        """
+        Logs a per-event or per-batch record if sampled. `message` is %-formatted with `args` when emitted.
+        """
+        self.__log_calls += 1
+        if self.__sampled(self.__log_calls, time.monotonic(), level):
+            self.logger.log(level or self.level, '[%s] ' + message, self.name, *args)
+
+    def __sampled(self, calls, now, level=None):
+        if not self.sample_every or calls % self.sample_every:
+            return False
+        if not self.logger.isEnabledFor(level or self.level):
+            return False
+
+        second = int(now)
+        if second != self.__second:
+            self.__second = second
+            self.__emitted = 0
+        if self.__emitted >= self.max_per_second:
+            self.suppressed += 1
+            return False
+        self.__emitted += 1
+        return True
+
+    def __summary(self, now):
+        elapsed = now - self.__summary_time
+        events, fires = self.events - self.__summary_events, self.fires - self.__summary_fires
+        if events or fires:
+            self.logger.info('[%s] %.1f events/s, %.1f fires/s (%d events, %d fires in %.0fs, %d records suppressed)',
+                             self.name, events / elapsed, fires / elapsed, events, fires, elapsed, self.suppressed)
+        self.__summary_time = now
+        self.__summary_events, self.__summary_fires = self.events, self.fires
+        self.suppressed = 0
+
+
+def new_event_logger(config: dict, component: str, name: str) -> EventLogger:
+    """
+    Instantiates the hot path logger of a component (`worker` or `event_sources`) as configured in the
+    `worker.logging` section of the config map
+    """
+    logging_config = ((config.get('worker') or {}).get('logging') or {}).get(component) or {}
+    level = logging_config.get('level', 'DEBUG')
+    return EventLogger(name,
+                       level=logging.getLevelName(level) if isinstance(level, str) else level,
+                       sample_rate=float(logging_config.get('sample_rate', 0.01)),
+                       max_per_second=int(logging_config.get('max_per_second', 10)),
+                       summary_interval=float(logging_config.get('summary_interval', 60)))
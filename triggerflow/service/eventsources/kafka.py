@@ -74,24 +74,44 @@ class KafkaEventSource(EventSourceHook):
 
         self.consumer.subscribe([self.topic])
         logging.info("[{}] Started consuming from topic {}".format(self.name, self.topic))
-        payload = None
         while True:
-            try:
-                message = self.consumer.poll()
-                logging.info("[{}] Received event".format(self.name))
-                payload = message.value().decode('utf-8')
-                event = json.loads(payload)
+            if self.flow_control is not None and not self.flow_control.check():
+                self.__pause()
+            self.__put_message(self.consumer.poll())
+
+    def __pause(self):
+        assignment = self.consumer.assignment()
+        self.consumer.pause(assignment)
+        logging.info("[{}] Paused {} partitions".format(self.name, len(assignment)))
+
+        def poll():
+            # Keeps the consumer in its group, paused partitions do not return messages
+            self.__put_message(self.consumer.poll(self.flow_control.interval))
+
+        self.flow_control.wait(poll)
+        self.consumer.resume(assignment)
+        logging.info("[{}] Resumed {} partitions".format(self.name, len(assignment)))
+
+    def __put_message(self, message):
+        if message is None:
+            return
+        payload = None
+        try:
+            payload = message.value().decode('utf-8')
+            event = json.loads(payload)
+            event['id'] = (message.topic(), message.partition(), message.offset() + 1)
+            event['event_source'] = self.name
+            self.event_log.event(event, 'Received event')
+            if not self.put_event(event, message.value()):
                 try:
                     event['data'] = json.loads(event['data'])
                 except Exception:
                     pass
-                event['id'] = (message.topic(), message.partition(), message.offset() + 1)
-                event['event_source'] = self.name
                 self.event_queue.put(event)
-                self.records.append(message)
-            except TypeError:
-                logging.error("[{}] Received event did not contain "
-                              "JSON payload, got {} instead".format(self.name, type(payload)))
+            self.records.append(message)
+        except (TypeError, AttributeError):
+            logging.error("[{}] Received event did not contain "
+                          "JSON payload, got {} instead".format(self.name, type(payload)))
 
     def commit(self, ids):
         self.commit_queue.put(ids)
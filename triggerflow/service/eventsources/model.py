@@ -1,11 +1,20 @@
 from multiprocessing import Process
 from threading import Thread
 
+from ..queues import ROUTING_ATTRIBUTES
+from ..eventlog import EventLogger
+
 
 class EventSourceHook(Thread):
     def __init__(self, name: str, *args, **kwargs):
         super().__init__()
         self.name = name
+        # Set by the worker when tracing is enabled
+        self.tracer = None
+        # Set by the worker when flow control is enabled, see `FlowControl`
+        self.flow_control = None
+        # Replaced by the worker with the logger configured for the event sources
+        self.event_log = EventLogger(name)
 
     def run(self):
         raise NotImplementedError()
@@ -15,3 +24,19 @@ class EventSourceHook(Thread):
 
     def stop(self):
         raise NotImplementedError()
+
+    def put_event(self, event: dict, payload: bytes = None) -> bool:
+        """
+        Hands the original JSON `payload` of a received event over to the worker if its event queue
+        carries serialized events (see `SharedMemoryEventQueue.put_raw`), with the routing attributes of
+        `event` (as decoded and set by the event source). Returns False if the event queue only takes
+        decoded events, in which case the caller must put the event itself.
+        When tracing is enabled, the reception of the event is traced and its `traceparent` is set.
+        """
+        if self.tracer is not None:
+            self.tracer.receive(event, self.name)
+        put_raw = getattr(self.event_queue, 'put_raw', None)
+        if payload is None or put_raw is None:
+            return False
+        put_raw(payload, **{key: event[key] for key in ROUTING_ATTRIBUTES if key in event})
+        return True
@@ -47,22 +47,27 @@ class RabbitMQEventSource(EventSourceHook):
         self.__start_commiter()
 
         while True:
+            if self.flow_control is not None:
+                # Messages are pulled one by one, so they stay in the queue while paused. The connection keeps
+                # serving heartbeats meanwhile.
+                self.flow_control.wait(lambda: connection.process_data_events(time_limit=self.flow_control.interval))
             method_frame, header_frame, body = self.channel.basic_get(queue=self.queue)
             if None in {method_frame, header_frame, body}:
                 continue
             try:
                 event = json.loads(body)
-                logging.debug("[{}] Received event".format(self.name))
+                self.event_log.event(event, 'Received event')
 
                 if not {'id', 'source', 'subject', 'type'}.issubset(set(event)):
                     raise Exception('Invalid Cloudevent')
 
-                try:
-                    event['data'] = json.loads(event['data'])
-                except:
-                    pass
+                if not self.put_event(event, body):
+                    try:
+                        event['data'] = json.loads(event['data'])
+                    except:
+                        pass
 
-                self.event_queue.put(event)
+                    self.event_queue.put(event)
                 self.records[event['id']] = method_frame.delivery_tag
             except Exception as e:
                 logging.warning('[{}] Error while decoding event: {}'.format(self.name, e))
@@ -31,35 +31,31 @@ class RedisEventSource(EventSourceHook):
                                        charset="utf-8", decode_responses=True)
 
     def run(self):
-        # Recover state
-        commited_events = self.redis.lrange('{}-commited'.format(self.name), 0, -1)
-        records = self.redis.xread({self.stream: 0}, block=0)[0][1]
-        # logging.info('Total events downloaded:', len(records))
-        for last_id, event in records:
-            if last_id in commited_events:
-                continue
-            try:
-                event['data'] = json.loads(event['data'])
-            except Exception:
-                pass
-            event['id'] = last_id
-            event['event_source'] = self.name
-            logging.info("[{}] Received event".format(self.name))
-            self.event_queue.put(event)
+        # Recover state: the stream is read from the beginning, skipping the events already committed
+        commited_events = set(self.redis.lrange('{}-commited'.format(self.name), 0, -1))
+        last_id = 0
 
-        # Start consuming new events
         while self.__should_run:
-            records = self.redis.xread({self.stream: last_id}, block=0)[0][1]
+            count = None
+            if self.flow_control is not None:
+                # Read at most the events that fit below the high watermark, the rest stay in the stream
+                self.flow_control.wait()
+                count = self.flow_control.room()
+            records = self.redis.xread({self.stream: last_id}, count=count, block=0)[0][1]
             # logging.info('Total events downloaded:', len(records))
             for last_id, event in records:
+                if last_id in commited_events:
+                    commited_events.discard(last_id)
+                    continue
                 try:
                     event['data'] = json.loads(event['data'])
                 except Exception:
                     pass
                 event['id'] = last_id
                 event['event_source'] = self.name
-                logging.info("[{}] Received event".format(self.name))
-                self.event_queue.put(event)
+                self.event_log.event(event, 'Received event')
+                if not self.put_event(event):
+                    self.event_queue.put(event)
 
     def commit(self, ids):
         self.redis.rpush('{}-commited'.format(self.name), *ids)
@@ -63,11 +63,16 @@ class SQSEventSource(EventSourceHook):
         sqs_queue = self.sqs.Queue(queue_url)
 
         while True:
-            messages = sqs_queue.receive_messages(WaitTimeSeconds=10)
+            max_messages = 10
+            if self.flow_control is not None:
+                # Messages stay in the queue while paused
+                self.flow_control.wait()
+                max_messages = min(max_messages, self.flow_control.room())
+            messages = sqs_queue.receive_messages(WaitTimeSeconds=10, MaxNumberOfMessages=max_messages)
             for message in messages:
                 event = json.loads(message.body)
                 if {'specversion', 'id', 'source', 'type'}.issubset(set(event)):
-                    logging.info('[{}] Received CloudEvent'.format(self.name))
+                    self.event_log.event(event, 'Received CloudEvent')
 
                     try:
                         if 'datacontenttype' in event and event['datacontenttype'] == 'application/json':
@@ -99,7 +104,8 @@ class SQSEventSource(EventSourceHook):
                                   'datacontenttype': 'application/json',
                                   'data': event['responsePayload']}
 
-                self.event_queue.put(cloudevent)
+                if not self.put_event(cloudevent):
+                    self.event_queue.put(cloudevent)
                 self.records[event_id] = message
 
     def commit(self, records):
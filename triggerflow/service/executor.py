@@ -0,0 +1,147 @@
+import time
+import traceback
+from threading import Condition
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def context_keys(trigger) -> list:
+    """
+    Keys of the contexts read by the condition of a trigger: its own, and those updated by the actions
+    of the triggers whose events activate it (e.g. DAG join counters)
+    """
+    keys = [('trigger', trigger.trigger_id)]
+    keys.extend(('subject', event['subject']) for event in trigger.activation_events)
+    return keys
+
+
+def action_keys(trigger) -> list:
+    """
+    Keys of the contexts an action may modify, see `context_keys`
+    """
+    keys = [('trigger', trigger.trigger_id)]
+    if isinstance(trigger.context.get('subject'), str):
+        keys.append(('subject', trigger.context['subject']))
+    if isinstance(trigger.context.get('join_state_machine'), str):
+        keys.append(('trigger', trigger.context['join_state_machine']))
+    return keys
+
+
+class ActionExecutor:
+    """
+    Runs trigger actions on a bounded thread pool, so blocking actions (e.g. function invocations and
+    their retries) do not stop the worker from matching events.
+
+    Actions of the same trigger run one after the other, in submission order. Each action is submitted
+    with the keys of the contexts it may modify, and `wait` blocks until no action in flight may modify
+    the given contexts, so a condition is never evaluated while its context is being updated.
+    """
+
+    def __init__(self, max_workers: int, initializer: callable = None):
+        self.max_workers = max_workers
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='action',
+                                         initializer=initializer)
+        self.__condition = Condition()
+        self.__queues = {}
+        self.__inflight = Counter()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.__latency_total = 0.0
+        self.__latency_max = 0.0
+
+    def submit(self, trigger_id: str, keys: list, action: callable, *args, callback: callable = None):
+        """
+        Queues `action(*args)` after the actions of the trigger submitted before. `callback(error)` is
+        called from the pool thread once the action has finished, with the formatted traceback of the
+        exception raised by the action, if any.
+        """
+        task = (keys, action, args, callback, time.perf_counter())
+        with self.__condition:
+            self.__inflight.update(keys)
+            self.queued += 1
+            if trigger_id in self.__queues:
+                self.__queues[trigger_id].append(task)
+                return
+            self.__queues[trigger_id] = deque([task])
+        self.__pool.submit(self.__run, trigger_id)
+
+    def __run(self, trigger_id):
+        while True:
+            with self.__condition:
+                keys, action, args, callback, submitted = self.__queues[trigger_id][0]
+                self.queued -= 1
+                self.running += 1
+
+            error = None
+            try:
+                action(*args)
+            except Exception:
+                error = traceback.format_exc()
+            if callback is not None:
+                callback(error)
+            latency = time.perf_counter() - submitted
+
+            with self.__condition:
+                self.running -= 1
+                if error is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.__latency_total += latency
+                self.__latency_max = max(self.__latency_max, latency)
+
+                self.__inflight.subtract(keys)
+                for key in keys:
+                    if self.__inflight[key] <= 0:
+                        del self.__inflight[key]
+                self.__condition.notify_all()
+
+                queue = self.__queues[trigger_id]
+                queue.popleft()
+                if not queue:
+                    del self.__queues[trigger_id]
+                    return
+
+    def wait(self, keys: list):
+        """
+        Blocks until no action in flight may modify the contexts identified by `keys`
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: not any(key in self.__inflight for key in keys))
+
+    def busy(self, keys: list) -> bool:
+        """
+        Returns True if an action in flight may modify the contexts identified by `keys`
+        """
+        with self.__condition:
+            return any(key in self.__inflight for key in keys)
+
+    def idle(self) -> bool:
+        with self.__condition:
+            return not self.__queues
+
+    def wait_idle(self):
+        """
+        Blocks until no action is queued or running
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: not self.__queues)
+
+    def stats(self) -> dict:
+        with self.__condition:
+            finished = self.completed + self.failed
+            return {'queued': self.queued,
+                    'running': self.running,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'latency_avg': self.__latency_total / finished if finished else 0.0,
+                    'latency_max': self.__latency_max}
+
+    def shutdown(self):
+        """
+        Waits for the queued actions and stops the pool
+        """
+        self.__pool.shutdown(wait=True)
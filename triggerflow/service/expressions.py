@@ -0,0 +1,135 @@
+import ast
+import sys
+from functools import lru_cache
+
+# Names an expression can read, see `compile_expression`
+VARIABLES = ('event', 'data', 'context', 'counter')
+
+FUNCTIONS = {
+    'len': len,
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'round': round,
+    'sum': sum,
+    'any': any,
+    'all': all,
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': bool
+}
+
+_MAX_SEQUENCE_LENGTH = 100000
+
+_NODES = (
+    ast.Expression, ast.Constant, ast.Name, ast.Load, ast.Attribute, ast.Subscript, ast.Slice, ast.List,
+    ast.Tuple, ast.Set, ast.Dict, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Compare, ast.Eq, ast.NotEq,
+    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot, ast.IfExp, ast.Call
+)
+# Literals are parsed as Num, Str and NameConstant nodes before Python 3.8, and subscripts wrapped in Index
+# nodes before Python 3.9
+if sys.version_info < (3, 8):
+    _NODES += (ast.Num, ast.Str, ast.NameConstant)
+if sys.version_info < (3, 9):
+    _NODES += (ast.Index,)
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def _field(value, name):
+    # `a.b` reads the key `b` of the dict `a`, there is no access to Python attributes
+    if isinstance(value, dict):
+        return value.get(name)
+    if value is None:
+        return None
+    raise ExpressionError('Cannot read field {} of {}'.format(name, type(value).__name__))
+
+
+def _multiply(left, right):
+    if isinstance(left, (str, list, tuple)) or isinstance(right, (str, list, tuple)):
+        length = (len(left) * right) if isinstance(left, (str, list, tuple)) else (len(right) * left)
+        if length > _MAX_SEQUENCE_LENGTH:
+            raise ExpressionError('Sequence of {} items is too long'.format(length))
+    return left * right
+
+
+class _Validator(ast.NodeVisitor):
+
+    def generic_visit(self, node):
+        if not isinstance(node, _NODES):
+            raise ExpressionError('{} is not allowed in expressions'.format(type(node).__name__))
+        super().generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id not in VARIABLES and node.id not in FUNCTIONS:
+            raise ExpressionError('Unknown name {}'.format(node.id))
+
+    def visit_Attribute(self, node):
+        if node.attr.startswith('_'):
+            raise ExpressionError('Field {} is not allowed in expressions'.format(node.attr))
+        self.visit(node.value)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise ExpressionError('Only the functions {} can be called'.format(', '.join(FUNCTIONS)))
+        if node.keywords:
+            raise ExpressionError('Keyword arguments are not allowed in expressions')
+        for arg in node.args:
+            self.visit(arg)
+
+
+class _Transformer(ast.NodeTransformer):
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        return ast.Call(func=ast.Name(id='__field', ctx=ast.Load()),
+                        args=[node.value, ast.Constant(value=node.attr)], keywords=[])
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Mult):
+            return node
+        return ast.Call(func=ast.Name(id='__multiply', ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+
+
+class Expression:
+    """
+    Compiled condition expression. Calling it with an event and a trigger context returns its value.
+    `counter` is True if the expression reads the `counter` variable.
+    """
+
+    def __init__(self, source: str, function: callable, counter: bool):
+        self.source = source
+        self.function = function
+        self.counter = counter
+
+    def __call__(self, event: dict, context: dict):
+        return self.function(event, event.get('data'), context, context.get('counter'))
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(source: str) -> Expression:
+    """
+    Compiles a condition expression. Expressions are Python expressions limited to literals, comparisons,
+    boolean and arithmetic operators, conditional expressions, indexing, calls to the functions in `FUNCTIONS`
+    and the variables `event`, `data` (the event data), `context` (the trigger context) and `counter`. Fields
+    of dicts can be read as attributes, e.g. `data.temperature > context.threshold and counter >= 3`.
+    Raises ExpressionError if the expression is not valid.
+    """
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError('Invalid expression {!r}: {}'.format(source, e.msg))
+    _Validator().visit(tree)
+    counter = any(isinstance(node, ast.Name) and node.id == 'counter' for node in ast.walk(tree))
+
+    # The lambda is parsed rather than built, as the fields of ast.arguments change between Python versions
+    function = ast.parse('lambda {}: None'.format(', '.join(VARIABLES)), mode='eval')
+    function.body.body = _Transformer().visit(tree).body
+    function = ast.fix_missing_locations(function)
+    namespace = dict(FUNCTIONS, __builtins__={}, __field=_field, __multiply=_multiply)
+    return Expression(source, eval(compile(function, '<expression>', 'eval'), namespace), counter)
@@ -0,0 +1,87 @@
+import time
+import logging
+from threading import Lock
+
+
+class FlowControl:
+    """
+    Backpressure between the event queue of a worker and its event sources. Event sources pause consuming
+    from their broker once `high_watermark` events are waiting in the event queue, leaving the events in the
+    broker, and resume when the worker has drained it down to `low_watermark`.
+
+    The event queue is only soft bounded: puts never block, so the events the worker puts in its own queue
+    (from actions, timers or replayed dead letters) cannot deadlock it, and an event source may overshoot
+    the high watermark by the events it had already received when it paused.
+    """
+
+    def __init__(self, depth: callable, name: str, high_watermark: int = 10000, low_watermark: int = None,
+                 interval: float = 0.1):
+        self.depth = depth
+        self.name = name
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark if low_watermark is not None else high_watermark // 2
+        self.interval = interval
+        self.paused = False
+        self.pauses = 0
+        self.__lock = Lock()
+
+    def check(self) -> bool:
+        """
+        Returns True if event sources may keep consuming
+        """
+        try:
+            depth = self.depth()
+        except NotImplementedError:
+            # Queue.qsize is not available on macOS
+            return True
+
+        if self.paused:
+            if depth <= self.low_watermark:
+                with self.__lock:
+                    if self.paused:
+                        self.paused = False
+                        logging.info('[{}] Resuming event sources, {} events in the event queue'.format(self.name,
+                                                                                                      depth))
+        elif depth >= self.high_watermark:
+            with self.__lock:
+                if not self.paused:
+                    self.paused = True
+                    self.pauses += 1
+                    logging.info('[{}] Pausing event sources, {} events in the event queue'.format(self.name, depth))
+        return not self.paused
+
+    def room(self) -> int:
+        """
+        Number of events that can be taken before reaching the high watermark, at least 1
+        """
+        try:
+            return max(1, self.high_watermark - self.depth())
+        except NotImplementedError:
+            return self.high_watermark
+
+    def wait(self, poll: callable = None):
+        """
+        Blocks while event sources are paused. `poll` is called every `interval` seconds meanwhile instead of
+        sleeping, e.g. to keep the connection to the broker alive; it must not take new events.
+        """
+        while not self.check():
+            if poll is not None:
+                poll()
+            else:
+                time.sleep(self.interval)
+
+
+def new_flow_control(config: dict, depth: callable, name: str):
+    """
+    Instantiates the flow control configured in the `worker.flow_control` section of the config map for an
+    event queue of `depth` events. Returns None unless flow control is enabled.
+    """
+    flow_config = (config.get('worker') or {}).get('flow_control') or {}
+    if not flow_config.get('enabled', False):
+        return None
+    high_watermark = int(flow_config.get('high_watermark', 10000))
+    low_watermark = flow_config.get('low_watermark')
+    return FlowControl(depth, name,
+                       high_watermark=high_watermark,
+                       low_watermark=int(low_watermark) if low_watermark is not None else None,
+                       interval=float(flow_config.get('interval', 0.1)))
@@ -0,0 +1,338 @@
+import json
+import time
+import queue
+import logging
+import traceback
+from uuid import uuid4
+from multiprocessing import Process, Queue
+from threading import Thread, Lock
+
+from . import storage
+from . import eventsources
+from .eventlog import new_event_logger
+from .flowcontrol import new_flow_control
+from .worker import Worker, Hosted
+
+
+class WorkspaceQueue(queue.Queue):
+    """
+    Event queue of a workspace served by a `WorkerHost`. It is kept while the workspace is evicted, and an
+    event put in it activates the workspace again.
+    """
+
+    def __init__(self, workspace: str, on_event: callable):
+        super().__init__()
+        self.workspace = workspace
+        self.on_event = on_event
+        self.last_event = time.monotonic()
+
+    def put(self, event, block=True, timeout=None):
+        super().put(event, block, timeout)
+        if event is not None:
+            self.last_event = time.monotonic()
+            self.on_event(self.workspace)
+
+
+class SharedEventSource:
+    """
+    Event source consumer shared by the workspaces that define the same event source (same class, name and
+    parameters). Received events are put in the event queue of each workspace, and an event is committed
+    in the event source once every workspace it was delivered to has committed it. The consumer is paused
+    while any of the event queues is full.
+    """
+
+    def __init__(self, evt_src: dict, config: dict, tracer=None):
+        self.name = evt_src['name']
+        self.subscribers = {}
+        self.__pending = {}
+        self.__lock = Lock()
+
+        event_source_class = getattr(eventsources, '{}'.format(evt_src['class']))
+        self.event_source = event_source_class(event_queue=self, name=self.name, **evt_src['parameters'])
+        self.event_source.tracer = tracer
+        self.event_source.flow_control = new_flow_control(config, self.qsize, self.name)
+        self.event_source.event_log = new_event_logger(config, 'event_sources', self.name)
+
+    def start(self):
+        self.event_source.start()
+
+    def put(self, event):
+        with self.__lock:
+            subscribers = list(self.subscribers.items())
+            if len(subscribers) > 1 and event.get('id') is not None:
+                self.__pending[event['id']] = {workspace for workspace, _ in subscribers}
+        for _, event_queue in subscribers:
+            event_queue.put(dict(event) if len(subscribers) > 1 else event)
+
+    def qsize(self):
+        with self.__lock:
+            event_queues = list(self.subscribers.values())
+        return max((event_queue.qsize() for event_queue in event_queues), default=0)
+
+    def commit(self, workspace: str, ids: list):
+        with self.__lock:
+            ready = []
+            for event_id in ids:
+                workspaces = self.__pending.get(event_id)
+                if workspaces is None:
+                    ready.append(event_id)
+                    continue
+                workspaces.discard(workspace)
+                if not workspaces:
+                    del self.__pending[event_id]
+                    ready.append(event_id)
+        if ready:
+            self.event_source.commit(ready)
+
+    def subscribe(self, workspace: str, event_queue):
+        with self.__lock:
+            self.subscribers[workspace] = event_queue
+
+    def unsubscribe(self, workspace: str) -> bool:
+        """
+        Removes a workspace, as if it had committed all the events delivered to it. Returns True if it
+        was the last one.
+        """
+        with self.__lock:
+            self.subscribers.pop(workspace, None)
+            ready = []
+            for event_id, workspaces in list(self.__pending.items()):
+                workspaces.discard(workspace)
+                if not workspaces:
+                    del self.__pending[event_id]
+                    ready.append(event_id)
+            last = not self.subscribers
+        if ready and not last:
+            self.event_source.commit(ready)
+        return last
+
+    def stop(self):
+        self.event_source.stop()
+
+
+class SharedEventSourceHandle:
+    """
+    Event source of a workspace as seen by its worker, see `commit_events`
+    """
+
+    def __init__(self, shared: SharedEventSource, workspace: str):
+        self.shared = shared
+        self.workspace = workspace
+
+    def commit(self, ids):
+        self.shared.commit(self.workspace, ids)
+
+    def stop(self):
+        pass
+
+
+class EventSourcePool:
+    """
+    Event source consumers of the workspaces of a host. Consumers keep running while a workspace is
+    evicted, so its events keep arriving to its event queue; they are stopped when the workspace is deleted.
+    """
+
+    def __init__(self, config: dict):
+        self.__config = config
+        self.__sources = {}
+        self.__workspaces = {}
+        self.__lock = Lock()
+
+    def attach(self, workspace: str, event_sources, event_queue, tracer=None) -> dict:
+        """
+        Subscribes a workspace to its event sources, starting their consumers if needed. Returns the
+        event sources of the workspace by name.
+        """
+        handles = {}
+        with self.__lock:
+            for evt_src in event_sources:
+                key = (evt_src['class'], evt_src['name'], json.dumps(evt_src['parameters'], sort_keys=True))
+                shared = self.__sources.get(key)
+                if shared is None:
+                    logging.info("[{}] Starting {}".format(workspace, evt_src['name']))
+                    shared = self.__sources[key] = SharedEventSource(evt_src, self.__config, tracer=tracer)
+                    shared.subscribe(workspace, event_queue)
+                    shared.start()
+                else:
+                    shared.subscribe(workspace, event_queue)
+                self.__workspaces.setdefault(workspace, set()).add(key)
+                handles[shared.name] = SharedEventSourceHandle(shared, workspace)
+        return handles
+
+    def detach(self, workspace: str):
+        """
+        Unsubscribes a deleted workspace, stopping the consumers no other workspace uses
+        """
+        with self.__lock:
+            for key in self.__workspaces.pop(workspace, ()):
+                shared = self.__sources[key]
+                if shared.unsubscribe(workspace):
+                    logging.info("[{}] Stopping {}".format(workspace, shared.name))
+                    del self.__sources[key]
+                    try:
+                        shared.stop()
+                    except Exception:
+                        logging.error(traceback.format_exc())
+
+    def __len__(self):
+        return len(self.__sources)
+
+
+class WorkerHost(Process):
+    """
+    Serves many workspaces from a single process, each of them with a `Worker` running as a thread.
+
+    Trigger tables stay isolated per workspace, while the trigger storage connection, the event source
+    consumers and the Python callables process pool are shared. Workspaces are activated when requested
+    or when an event arrives for them, and evicted when they have been idle for `idle_timeout` seconds,
+    or least recently used first when more than `max_workspaces` are active. Only workspaces without
+    pending events or timers are evicted, after a last checkpoint; their event queues and event source
+    consumers are kept, so no event is lost while they are not active.
+    """
+
+    def __init__(self, config: dict, metrics_queue: Queue = None):
+        super().__init__()
+        self.host_id = str(uuid4())[:6]
+        self.__config = config
+        host_config = (config.get('worker') or {}).get('host') or {}
+        self.max_workspaces = int(host_config.get('max_workspaces', 100))
+        self.idle_timeout = float(host_config.get('idle_timeout', 300))
+        self.metrics_queue = metrics_queue
+        self.control_queue = Queue()
+
+        self.trigger_storage = None
+        self.event_source_pool = None
+        self.workers = {}
+        self.threads = {}
+        self.event_queues = {}
+        self.__activating = set()
+        # Guards self.workers and self.__activating, read by the event source and action threads
+        self.__lock = None
+
+    def start_workspace(self, workspace: str):
+        self.control_queue.put(('start', workspace))
+
+    def delete_workspace(self, workspace: str):
+        self.control_queue.put(('delete', workspace))
+
+    def stop_host(self):
+        logging.info('Stopping worker host {}'.format(self.host_id))
+        self.control_queue.put(None)
+        self.join(timeout=60)
+        try:
+            self.terminate()
+        except Exception:
+            pass
+        logging.info('Worker host {} stopped'.format(self.host_id))
+
+    def __start_db(self):
+        logging.info('[{}] Creating database connection'.format(self.host_id))
+        backend = self.__config['trigger_storage']['backend']
+        trigger_storage_class = getattr(storage, backend.capitalize() + 'TriggerStorage')
+        self.trigger_storage = trigger_storage_class(**self.__config['trigger_storage']['parameters'])
+
+    def __on_event(self, workspace):
+        # Called from the event source and action threads
+        with self.__lock:
+            if workspace in self.workers or workspace in self.__activating:
+                return
+            self.__activating.add(workspace)
+        self.control_queue.put(('activate', workspace))
+
+    def __activate(self, workspace):
+        with self.__lock:
+            self.__activating.discard(workspace)
+            if workspace in self.workers:
+                return
+        if workspace not in self.event_queues:
+            self.event_queues[workspace] = WorkspaceQueue(workspace, self.__on_event)
+        self.event_queues[workspace].last_event = time.monotonic()
+        logging.info('[{}] Activating workspace in host {}'.format(workspace, self.host_id))
+
+        hosted = Hosted(trigger_storage=self.trigger_storage,
+                        event_queue=self.event_queues[workspace],
+                        event_source_pool=self.event_source_pool)
+        worker = Worker(workspace, self.__config, metrics_queue=self.metrics_queue, hosted=hosted)
+        thread = Thread(target=worker.run, name='worker-{}'.format(workspace), daemon=True)
+        with self.__lock:
+            self.workers[workspace] = worker
+        self.threads[workspace] = thread
+        thread.start()
+
+        if len(self.workers) > self.max_workspaces:
+            self.__evict_lru()
+
+    def __deactivate(self, workspace):
+        with self.__lock:
+            worker = self.workers.pop(workspace)
+        thread = self.threads.pop(workspace)
+        worker.stop()
+        thread.join(timeout=30)
+        if thread.is_alive():
+            logging.warning('[{}] Worker did not stop in time'.format(workspace))
+
+    def __evictable(self, workspace):
+        worker = self.workers[workspace]
+        # Timers only fire while the workspace is active
+        return (worker.state == Worker.State.RUNNING and len(worker.events) == 0
+                and self.event_queues[workspace].empty() and not len(worker.lanes or ())
+                and not len(worker.timers.wheel))
+
+    def __evict_idle(self):
+        now = time.monotonic()
+        for workspace in list(self.workers):
+            if now - self.event_queues[workspace].last_event >= self.idle_timeout and self.__evictable(workspace):
+                logging.info('[{}] Evicting idle workspace from host {}'.format(workspace, self.host_id))
+                self.__deactivate(workspace)
+
+    def __evict_lru(self):
+        candidates = sorted((workspace for workspace in self.workers if self.__evictable(workspace)),
+                            key=lambda workspace: self.event_queues[workspace].last_event)
+        if not candidates:
+            logging.warning('Worker host {} has {} active workspaces, none can be evicted'.format(
+                self.host_id, len(self.workers)))
+            return
+        logging.info('[{}] Evicting least recently used workspace from host {}'.format(candidates[0],
+                                                                                       self.host_id))
+        self.__deactivate(candidates[0])
+
+    def __delete(self, workspace):
+        logging.info('[{}] Deleting workspace from host {}'.format(workspace, self.host_id))
+        if workspace in self.workers:
+            self.__deactivate(workspace)
+        self.event_source_pool.detach(workspace)
+        self.event_queues.pop(workspace, None)
+        with self.__lock:
+            self.__activating.discard(workspace)
+
+    def run(self):
+        logging.info('Starting worker host {}'.format(self.host_id))
+        self.__lock = Lock()
+        self.__start_db()
+        self.event_source_pool = EventSourcePool(self.__config)
+        interval = max(1.0, min(self.idle_timeout / 4, 30.0))
+
+        while True:
+            try:
+                request = self.control_queue.get(timeout=interval)
+            except queue.Empty:
+                request = ()
+            if request is None:
+                break
+
+            try:
+                if request:
+                    command, workspace = request
+                    if command in ('start', 'activate'):
+                        if command == 'start' or workspace in self.event_queues:
+                            self.__activate(workspace)
+                    elif command == 'delete':
+                        self.__delete(workspace)
+                self.__evict_idle()
+            except Exception:
+                logging.error('Worker host {} could not process {}'.format(self.host_id, request))
+                logging.error(traceback.format_exc())
+
+        for workspace in list(self.workers):
+            self.__deactivate(workspace)
+        logging.info('Worker host {} finished'.format(self.host_id))
@@ -0,0 +1,83 @@
+class TriggerIndex:
+    """
+    Index of the triggers activated by each (subject, type) pair.
+
+    Exact subjects are kept in a hash map `subject -> type -> trigger ids`. Subjects ending with `*`
+    (e.g. `map_*`) are registered as prefixes and match every subject that starts with them; they are
+    bucketed by prefix length, so a lookup costs one hash probe per distinct prefix length.
+    Trigger ids are stored as dict keys to keep insertion order and make removals O(1).
+
+    Item access and membership tests only consider exact subjects, so the index can still be used as the
+    nested `trigger_mapping` dict that actions rely on.
+    """
+    WILDCARD = '*'
+
+    def __init__(self):
+        self.__exact = {}
+        self.__prefixes = {}
+        self.__prefix_lengths = []
+
+    def add(self, subject: str, event_type: str, trigger_id: str):
+        if subject.endswith(TriggerIndex.WILDCARD):
+            prefix = subject[:-1]
+            length = len(prefix)
+            if length not in self.__prefixes:
+                self.__prefixes[length] = {}
+                self.__prefix_lengths = sorted(self.__prefixes)
+            types = self.__prefixes[length].setdefault(prefix, {})
+        else:
+            types = self.__exact.setdefault(subject, {})
+        types.setdefault(event_type, {})[trigger_id] = None
+
+    def remove(self, subject: str, event_type: str, trigger_id: str):
+        if subject.endswith(TriggerIndex.WILDCARD):
+            prefix = subject[:-1]
+            length = len(prefix)
+            bucket = self.__prefixes.get(length, {})
+            types = bucket.get(prefix, {})
+            types.get(event_type, {}).pop(trigger_id, None)
+            if event_type in types and not types[event_type]:
+                del types[event_type]
+            if prefix in bucket and not types:
+                del bucket[prefix]
+            if length in self.__prefixes and not bucket:
+                del self.__prefixes[length]
+                self.__prefix_lengths = sorted(self.__prefixes)
+        else:
+            types = self.__exact.get(subject, {})
+            types.get(event_type, {}).pop(trigger_id, None)
+            if event_type in types and not types[event_type]:
+                del types[event_type]
+            if subject in self.__exact and not types:
+                del self.__exact[subject]
+
+    def match(self, subject: str, event_type: str) -> list:
+        """
+        Returns the ids of the triggers activated by an event, exact subject matches first
+        """
+        types = self.__exact.get(subject)
+        trigger_ids = list(types[event_type]) if types and event_type in types else []
+
+        if self.__prefix_lengths:
+            subject_length = len(subject)
+            for length in self.__prefix_lengths:
+                if length > subject_length:
+                    break
+                types = self.__prefixes[length].get(subject[:length])
+                if types and event_type in types:
+                    trigger_ids.extend(types[event_type])
+
+        return trigger_ids
+
+    def subjects(self):
+        return list(self.__exact) + [prefix + TriggerIndex.WILDCARD
+                                     for bucket in self.__prefixes.values() for prefix in bucket]
+
+    def __contains__(self, subject):
+        return subject in self.__exact
+
+    def __getitem__(self, subject):
+        return self.__exact[subject]
+
+    def __len__(self):
+        return len(self.__exact) + sum(len(bucket) for bucket in self.__prefixes.values())
@@ -0,0 +1,71 @@
+import re
+from functools import lru_cache
+
+from jsonpath_ng import parse
+
+_DOTTED_PATH = re.compile(r'\$((?:\.[A-Za-z_][A-Za-z0-9_]*|\[\d+\])*)$')
+_STEP = re.compile(r'\.([A-Za-z_][A-Za-z0-9_]*)|\[(\d+)\]')
+
+
+class DottedPath:
+    """
+    JSONPath made of fields and indexes only (e.g. `$.a.b[0]`), evaluated with plain item lookups
+    """
+
+    def __init__(self, expression: str, steps: tuple):
+        self.expression = expression
+        self.steps = steps
+
+    def values(self, data) -> list:
+        for step in self.steps:
+            if isinstance(step, str):
+                if not isinstance(data, dict) or step not in data:
+                    return []
+            elif not isinstance(data, (list, str)) or step >= len(data):
+                return []
+            data = data[step]
+        return [data]
+
+    def update(self, data, value):
+        return parse_path(self.expression).update(data, value)
+
+
+class JsonPath:
+    """
+    Any other JSONPath, evaluated by jsonpath_ng
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.path = parse_path(expression)
+
+    def values(self, data) -> list:
+        return [match.value for match in self.path.find(data)]
+
+    def update(self, data, value):
+        return self.path.update(data, value)
+
+
+@lru_cache(maxsize=4096)
+def parse_path(expression: str):
+    """
+    Parses a JSONPath expression with jsonpath_ng, caching the most recently used ones
+    """
+    return parse(expression)
+
+
+@lru_cache(maxsize=4096)
+def compile_path(expression: str):
+    """
+    Compiles a JSONPath expression, caching the most recently used ones. The result has `values(data)`,
+    the list of matched values, and `update(data, value)`.
+    """
+    dotted = _DOTTED_PATH.match(expression)
+    if dotted is None:
+        return JsonPath(expression)
+    steps = tuple(field if field else int(index) for field, index in _STEP.findall(dotted.group(1)))
+    return DottedPath(expression, steps)
+
+
+def find_values(expression: str, data) -> list:
+    return compile_path(expression).values(data)
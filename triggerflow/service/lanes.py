@@ -0,0 +1,111 @@
+import re
+from fnmatch import translate
+from collections import deque
+
+# Workflow control events (initialization, task terminations, timeouts) ahead of data events, used when
+# `worker.lanes` is true
+CONTROL_LANES = [{'name': 'control', 'weight': 8, 'types': ['event.triggerflow.*'], 'subjects': ['__init__']}]
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(translate(pattern) for pattern in patterns)).match
+
+
+class EventLanes:
+    """
+    Schedules the events of a worker in lanes, so control events do not wait behind floods of data events.
+
+    Each event goes to the first lane with a `types` or `subjects` pattern (shell style) that matches it, or
+    to the `default` lane. Lanes are dequeued by smooth weighted round robin: while several lanes have
+    events, each of them gets a share of the dequeued events proportional to its weight, so no lane starves.
+    Events keep their arrival order within a lane.
+    """
+
+    def __init__(self, lanes: list, default_weight: int = 1, max_size: int = 100000):
+        self.names = [lane['name'] for lane in lanes] + ['default']
+        self.weights = [max(1, int(lane.get('weight', 1))) for lane in lanes] + [max(1, int(default_weight))]
+        self.queues = [deque() for _ in self.names]
+        self.dequeued = [0] * len(self.names)
+        self.max_size = max_size
+        self.__patterns = [(_compile(lane.get('types')), _compile(lane.get('subjects'))) for lane in lanes]
+        self.__current = [0] * len(self.names)
+        # Lane of each (subject, type)
+        self.__lanes = {}
+        self.__size = 0
+
+    def put(self, event: dict):
+        key = (event['subject'], event['type'])
+        lane = self.__lanes.get(key)
+        if lane is None:
+            if len(self.__lanes) >= 100000:
+                self.__lanes.clear()
+            lane = self.__lanes[key] = self.__classify(*key)
+        self.queues[lane].append(event)
+        self.__size += 1
+
+    def take(self, count: int) -> list:
+        """
+        Dequeues up to `count` events
+        """
+        events = []
+        queues, weights, current = self.queues, self.weights, self.__current
+        while len(events) < count and self.__size:
+            active = [lane for lane, lane_queue in enumerate(queues) if lane_queue]
+            if len(active) == 1:
+                lane = active[0]
+                taken = min(count - len(events), len(queues[lane]))
+                events.extend(queues[lane].popleft() for _ in range(taken))
+                self.dequeued[lane] += taken
+                self.__size -= taken
+                current[lane] = 0
+                continue
+
+            total = 0
+            lane = active[0]
+            for active_lane in active:
+                current[active_lane] += weights[active_lane]
+                total += weights[active_lane]
+                if current[active_lane] > current[lane]:
+                    lane = active_lane
+            current[lane] -= total
+            events.append(queues[lane].popleft())
+            self.dequeued[lane] += 1
+            self.__size -= 1
+            if not queues[lane]:
+                current[lane] = 0
+        return events
+
+    def depths(self) -> dict:
+        return {name: len(lane_queue) for name, lane_queue in zip(self.names, self.queues)}
+
+    def full(self) -> bool:
+        return self.__size >= self.max_size
+
+    def __classify(self, subject, event_type):
+        for lane, (types, subjects) in enumerate(self.__patterns):
+            if (types is not None and types(event_type)) or (subjects is not None and subjects(subject)):
+                return lane
+        return len(self.__patterns)
+
+    def __len__(self):
+        return self.__size
+
+
+def new_event_lanes(config: dict):
+    """
+    Instantiates the lanes configured in `worker.lanes`, a list of {name, weight, types, subjects}, or true for
+    a control lane for the `event.triggerflow.*` events and the `__init__` subject. Lanes change the order in
+    which events are processed, so they are disabled (events are processed in arrival order) unless they are
+    configured. Returns None if disabled.
+    """
+    worker_config = config.get('worker') or {}
+    lanes = worker_config.get('lanes')
+    if not lanes:
+        return None
+    if lanes is True:
+        lanes = CONTROL_LANES
+    return EventLanes(lanes,
+                      default_weight=int(worker_config.get('default_lane_weight', 1)),
+                      max_size=int(worker_config.get('lanes_max_buffered', 100000)))
@@ -0,0 +1,235 @@
+import time
+import queue
+import logging
+import traceback
+from bisect import bisect_left
+from threading import Thread, Lock, Event
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+DESCRIPTIONS = {
+    'triggerflow_events_received_total': 'Events taken from the event queue, by event source',
+    'triggerflow_events_matched_total': 'Events that activated at least one trigger',
+    'triggerflow_events_dead_lettered_total': 'Events that did not activate any trigger',
+    'triggerflow_events_committed_total': 'Events committed to their event sources',
+    'triggerflow_triggers_fired_total': 'Triggers whose condition was met, by action',
+    'triggerflow_trigger_errors_total': 'Exceptions raised by conditions and actions',
+    'triggerflow_condition_seconds': 'Time spent evaluating conditions, by condition',
+    'triggerflow_action_seconds': 'Time spent running actions, by action',
+    'triggerflow_checkpoint_triggers': 'Triggers written by each checkpoint',
+    'triggerflow_checkpoint_seconds': 'Time spent writing each checkpoint',
+    'triggerflow_event_queue_depth': 'Events waiting in the event queue',
+    'triggerflow_pending_events_bytes': 'Memory used by the pending events payloads',
+    'triggerflow_triggers_loaded': 'Triggers loaded in the worker cache',
+    'triggerflow_dead_letters_buffered': 'Dead letters waiting to be written to the trigger storage',
+    'triggerflow_actions_queued': 'Actions waiting for an action executor thread',
+    'triggerflow_actions_running': 'Actions running on the action executor',
+    'triggerflow_timers_scheduled': 'Timeouts waiting in the timing wheel',
+    'triggerflow_event_sources_paused': 'Whether event sources are paused because the event queue is full',
+    'triggerflow_lane_depth': 'Events waiting in each event lane of the worker',
+    'triggerflow_lane_events': 'Events dequeued from each event lane of the worker',
+    'triggerflow_event_sources_pauses': 'Times event sources were paused because the event queue was full',
+    'triggerflow_events_duplicated_total': 'Events dropped as duplicates of an event already processed',
+    'triggerflow_dedup_unconfirmed_duplicates': 'Events found in the deduplication Bloom filter but not in its window',
+    'triggerflow_dedup_bloom_bytes': 'Memory used by the deduplication Bloom filter',
+    'triggerflow_shard_triggers': 'Triggers placed on each shard of a sharded worker',
+}
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of a worker process. Updates only take a lock and a dict lookup,
+    so they can be made from the event processing loop. Values are cumulative since the process started,
+    the controller aggregates the snapshots sent by every worker.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__counters = defaultdict(float)
+        self.__gauges = {}
+        self.__histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__counters[key] += value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                # Bucket counts followed by the sum and the count of the observations
+                histogram = self.__histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][bisect_left(histogram[0], value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {'time': time.time(),
+                    'counters': dict(self.__counters),
+                    'gauges': dict(self.__gauges),
+                    'histograms': {key: (buckets, list(counts), total, count)
+                                   for key, (buckets, counts, total, count) in self.__histograms.items()}}
+
+
+class MetricsReporter(Thread):
+    """
+    Sends a snapshot of the metrics of a worker to the controller every `interval` seconds.
+    `collect` is called before each snapshot to sample the gauges.
+    """
+
+    def __init__(self, metrics: MetricsRegistry, metrics_queue, workspace: str, worker_id: str,
+                 interval: float = 10.0, collect: callable = None):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.metrics_queue = metrics_queue
+        self.workspace = workspace
+        self.worker_id = worker_id
+        self.interval = interval
+        self.collect = collect
+        self.__stopped = Event()
+
+    def report(self):
+        try:
+            if self.collect is not None:
+                self.collect()
+            self.metrics_queue.put((self.workspace, self.worker_id, self.metrics.snapshot()))
+        except Exception:
+            logging.error('[{}] Could not report metrics'.format(self.workspace))
+            logging.error(traceback.format_exc())
+
+    def run(self):
+        while not self.__stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """
+        Stops the thread and sends a last snapshot
+        """
+        self.__stopped.set()
+        self.report()
+
+
+class MetricsAggregator(Thread):
+    """
+    Keeps the last snapshot received from each worker and renders the metrics of all of them in the
+    Prometheus text exposition format. Counters and histograms of the workers of a workspace are added
+    up; gauges of workers that stopped reporting for `stale_after` seconds are left out.
+
+    Once started, the thread drains the metrics queue as snapshots arrive, so the queue does not grow
+    when nothing scrapes the metrics. Otherwise the queue is drained on each `render`.
+    """
+
+    def __init__(self, metrics_queue, stale_after: float = 60.0):
+        super().__init__(daemon=True)
+        self.metrics_queue = metrics_queue
+        self.stale_after = stale_after
+        self.__snapshots = {}
+        self.__lock = Lock()
+
+    def run(self):
+        while True:
+            try:
+                workspace, worker_id, snapshot = self.metrics_queue.get()
+            except Exception:
+                logging.error('Could not receive worker metrics')
+                logging.error(traceback.format_exc())
+                time.sleep(1)
+                continue
+            with self.__lock:
+                self.__snapshots[(workspace, worker_id)] = snapshot
+
+    def collect(self):
+        while True:
+            try:
+                workspace, worker_id, snapshot = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            with self.__lock:
+                self.__snapshots[(workspace, worker_id)] = snapshot
+
+    def forget(self, workspace: str):
+        """
+        Drops the snapshots of the workers of a deleted workspace
+        """
+        self.collect()
+        with self.__lock:
+            for key in [key for key in self.__snapshots if key[0] == workspace]:
+                del self.__snapshots[key]
+
+    def render(self) -> str:
+        self.collect()
+        now = time.time()
+        counters, gauges, histograms = defaultdict(float), defaultdict(float), {}
+        with self.__lock:
+            snapshots = list(self.__snapshots.items())
+
+        for (workspace, _), snapshot in snapshots:
+            for (name, labels), value in snapshot['counters'].items():
+                counters[(name, (('workspace', workspace),) + labels)] += value
+            if now - snapshot['time'] <= self.stale_after:
+                for (name, labels), value in snapshot['gauges'].items():
+                    gauges[(name, (('workspace', workspace),) + labels)] += value
+            for (name, labels), (buckets, counts, total, count) in snapshot['histograms'].items():
+                key = (name, (('workspace', workspace),) + labels)
+                if key not in histograms:
+                    histograms[key] = (buckets, [0] * len(counts), [0.0, 0])
+                histogram = histograms[key]
+                for i, bucket_count in enumerate(counts):
+                    histogram[1][i] += bucket_count
+                histogram[2][0] += total
+                histogram[2][1] += count
+
+        lines = []
+        self.__render_samples(lines, counters, 'counter')
+        self.__render_samples(lines, gauges, 'gauge')
+        for name, samples in self.__by_name(histograms).items():
+            self.__header(lines, name, 'histogram')
+            for labels, (buckets, counts, (total, count)) in samples:
+                cumulative = 0
+                for bucket, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bucket),)),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def __render_samples(self, lines, samples, metric_type):
+        for name, name_samples in self.__by_name(samples).items():
+            self.__header(lines, name, metric_type)
+            for labels, value in name_samples:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+    @staticmethod
+    def __header(lines, name, metric_type):
+        if name in DESCRIPTIONS:
+            lines.append('# HELP {} {}'.format(name, DESCRIPTIONS[name]))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+    @staticmethod
+    def __by_name(samples):
+        by_name = defaultdict(list)
+        for (name, labels), value in sorted(samples.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            by_name[name].append((labels, value))
+        return by_name
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(labels, escaped)) + '}'
@@ -0,0 +1,264 @@
+import mmap
+import pickle
+import marshal
+import tempfile
+from threading import Lock
+from collections import defaultdict
+
+from .queues import LazyEvent
+
+# Encodings of the payloads of events that are not `LazyEvent`s
+_MARSHAL, _PICKLE = 0, 1
+
+
+class SpillFile:
+    """
+    Memory-mapped temporary file holding the payloads of pending events that do not fit in the memory
+    budget. Payloads are appended, and the space of the released ones is reclaimed by `compact`, or as a
+    whole once all of them have been released. Writes and compactions move or remap the payloads, so they
+    hold `lock` with the reads of other threads.
+    """
+
+    def __init__(self, directory: str = None, chunk_size: int = 16 * 1024 * 1024):
+        self.chunk_size = chunk_size
+        self.__file = tempfile.TemporaryFile(dir=directory)
+        self.__mmap = None
+        self.__size = 0
+        self.__end = 0
+        self.__live = 0
+        self.__live_bytes = 0
+        self.lock = Lock()
+
+    def write(self, data: bytes):
+        """
+        Appends `data` and returns its (offset, size) location
+        """
+        offset = self.__end
+        if offset + len(data) > self.__size:
+            self.__grow(offset + len(data))
+        self.__mmap[offset:offset + len(data)] = data
+        self.__end += len(data)
+        self.__live += 1
+        self.__live_bytes += len(data)
+        return offset, len(data)
+
+    def read(self, location) -> bytes:
+        offset, size = location
+        return self.__mmap[offset:offset + size]
+
+    def release(self, location):
+        self.__live -= 1
+        self.__live_bytes -= location[1]
+        if self.__live == 0:
+            self.__end = 0
+
+    def compact(self, locations: list) -> list:
+        """
+        Moves the payloads at `locations`, which must be all the live ones, to the start of the file, so
+        the space of the released payloads between them is reused. Returns their new locations, in the
+        same order.
+        """
+        moved = [None] * len(locations)
+        end = 0
+        for i in sorted(range(len(locations)), key=lambda i: locations[i][0]):
+            offset, size = locations[i]
+            if offset != end:
+                self.__mmap.move(end, offset, size)
+            moved[i] = (end, size)
+            end += size
+        self.__end = end
+        return moved
+
+    def __grow(self, min_size):
+        size = max(self.__size * 2, min_size)
+        size += -size % self.chunk_size
+        if self.__mmap is not None:
+            self.__mmap.close()
+        self.__file.truncate(size)
+        self.__mmap = mmap.mmap(self.__file.fileno(), size)
+        self.__size = size
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def fragmented(self):
+        """
+        True once the released payloads not reclaimed yet take more space than the live ones, and at
+        least a chunk
+        """
+        garbage = self.__end - self.__live_bytes
+        return garbage > max(self.chunk_size, self.__live_bytes)
+
+    def close(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+        self.__file.close()
+
+
+def _serialize(event: dict) -> tuple:
+    """
+    Returns the (attributes, payload, encoding) record of an event. Events read from a
+    `SharedMemoryEventQueue` and not decoded yet keep the payload they were read from, other events are
+    marshalled (or pickled, if they hold values marshal does not support) without routing attributes.
+    """
+    if isinstance(event, LazyEvent):
+        record = event.serialized()
+        if record is not None:
+            return record
+    event = dict(event)
+    try:
+        return None, marshal.dumps(event), _MARSHAL
+    except ValueError:
+        return None, pickle.dumps(event, pickle.HIGHEST_PROTOCOL), _PICKLE
+
+
+def _deserialize(record: tuple) -> dict:
+    attributes, payload, encoding = record
+    if attributes is not None:
+        return LazyEvent(dict(attributes), payload, encoding)
+    return marshal.loads(payload) if encoding == _MARSHAL else pickle.loads(payload)
+
+
+class PendingEvents:
+    """
+    Events received for each subject that wait for one of its triggers to fire before being committed.
+
+    Only the event source and id of each event, needed to commit it, are kept as is. Payloads are kept
+    serialized (see `_serialize`) in memory up to `memory_budget` bytes, the rest are spilled to a
+    `SpillFile`, which is compacted once most of it is released. Pending events can still be read by
+    subject (e.g. `context.events[subject]`), their payloads are loaded on access, also from the threads
+    of the action executor while the worker appends and pops events.
+    """
+
+    def __init__(self, memory_budget: int = 64 * 1024 * 1024, spill_directory: str = None):
+        self.memory_budget = memory_budget
+        self.spill_directory = spill_directory
+        self.memory = 0
+        self.__subjects = {}
+        self.__sequence = 0
+        self.__spill = None
+
+    def append(self, subject: str, event: dict) -> int:
+        """
+        Adds an event to the pending events of a subject. Returns its sequence number.
+        """
+        record = _serialize(event)
+        size = len(record[1])
+        if self.memory + size > self.memory_budget:
+            if self.__spill is None:
+                self.__spill = SpillFile(self.spill_directory)
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            with self.__spill.lock:
+                payload = self.__spill.write(data)
+            record = None
+        else:
+            self.memory += size
+            payload = None
+
+        self.__sequence += 1
+        entry = [self.__sequence, event.get('event_source'), event['id'], record, payload]
+        self.__subjects.setdefault(subject, []).append(entry)
+        return self.__sequence
+
+    def pop(self, subject: str, until: int = None) -> list:
+        """
+        Removes the pending events of a subject, or only those up to sequence number `until`, and returns
+        their (event source, id) pairs
+        """
+        entries = self.__subjects.get(subject)
+        if not entries:
+            return []
+
+        if until is None:
+            popped = entries
+            del self.__subjects[subject]
+        else:
+            count = 0
+            while count < len(entries) and entries[count][0] <= until:
+                count += 1
+            popped = entries[:count]
+            del entries[:count]
+            if not entries:
+                del self.__subjects[subject]
+
+        for _, _, _, record, location in popped:
+            if record is not None:
+                self.memory -= len(record[1])
+            else:
+                self.__spill.release(location)
+        if self.__spill is not None and self.__spill.fragmented:
+            self.__compact()
+        return [(event_source, event_id) for _, event_source, event_id, _, _ in popped]
+
+    def pop_matching(self, subject: str, until: int = None) -> list:
+        """
+        Same as `pop` for an activation subject of a trigger, which may end with `*` (see `TriggerIndex`):
+        it then removes the pending events of every subject starting with its prefix
+        """
+        if not subject.endswith('*'):
+            return self.pop(subject, until)
+        prefix = subject[:-1]
+        events = []
+        for pending_subject in [pending_subject for pending_subject in self.__subjects
+                                if pending_subject.startswith(prefix)]:
+            events.extend(self.pop(pending_subject, until))
+        return events
+
+    def __compact(self):
+        spilled = [entry for entries in list(self.__subjects.values()) for entry in entries if entry[3] is None]
+        # Readers must not see a location before its payload is moved there
+        with self.__spill.lock:
+            for entry, location in zip(spilled, self.__spill.compact([entry[4] for entry in spilled])):
+                entry[4] = location
+
+    def __load(self, entry):
+        record = entry[3]
+        if record is None:
+            with self.__spill.lock:
+                data = self.__spill.read(entry[4])
+            record = pickle.loads(data)
+        return _deserialize(record)
+
+    def get(self, subject, default=None):
+        return self[subject] if subject in self else default
+
+    def keys(self):
+        return self.__subjects.keys()
+
+    def items(self):
+        return [(subject, self[subject]) for subject in self.__subjects]
+
+    def __getitem__(self, subject) -> list:
+        return [self.__load(entry) for entry in self.__subjects[subject]]
+
+    def __contains__(self, subject):
+        return subject in self.__subjects
+
+    def __iter__(self):
+        return iter(self.__subjects)
+
+    def __len__(self):
+        return len(self.__subjects)
+
+    def close(self):
+        if self.__spill is not None:
+            self.__spill.close()
+            self.__spill = None
+
+
+def commit_events(event_sources: dict, events: list):
+    """
+    Commits each (event source, id) pair in the event source the event came from. Events without
+    event source (e.g. emitted by actions) have nothing to commit.
+    """
+    source_ids = defaultdict(list)
+    for event_source, event_id in events:
+        if event_source is not None:
+            source_ids[event_source].append(event_id)
+
+    for name, event_source in event_sources.items():
+        event_ids = source_ids.get(name)
+        if event_ids:
+            event_source.commit(event_ids)
@@ -0,0 +1,295 @@
+import json
+import time
+import queue
+import pickle
+import struct
+import marshal
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing import Lock, Semaphore
+
+_HEADER = struct.Struct('QQ')
+_POSITION = struct.Struct('Q')
+_FRAME = struct.Struct('IIIB3x')
+_PADDING = 0xFFFFFFFF
+_JSON, _PICKLE, _STOP = 0, 1, 2
+
+ROUTING_ATTRIBUTES = ('subject', 'type', 'id', 'source', 'event_source', 'traceparent')
+
+
+class LazyEvent(dict):
+    """
+    CloudEvent read from a `SharedMemoryEventQueue`. Only the routing attributes are decoded when the
+    event is dequeued, the rest of the event (`data` included) is decoded the first time it is accessed.
+    """
+
+    def __init__(self, attributes: dict, payload: bytes, encoding: int = _JSON):
+        super().__init__(attributes)
+        self.__payload = payload
+        self.__encoding = encoding
+
+    def __materialize(self):
+        payload, self.__payload = self.__payload, None
+        if self.__encoding == _PICKLE:
+            dict.update(self, pickle.loads(payload))
+            return
+        event = json.loads(payload)
+        if isinstance(event.get('data'), str):
+            try:
+                event['data'] = json.loads(event['data'])
+            except Exception:
+                pass
+        for key, value in event.items():
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, value)
+
+    def serialized(self):
+        """
+        Returns the (attributes, payload, encoding) the event was read from, or None once it is decoded
+        """
+        if self.__payload is None:
+            return None
+        return dict(dict.items(self)), self.__payload, self.__encoding
+
+    def __missing__(self, key):
+        if self.__payload is None:
+            raise KeyError(key)
+        self.__materialize()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if self.__payload is not None and not dict.__contains__(self, key):
+            self.__materialize()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.__repr__(self)
+
+    def __eq__(self, other):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.__ne__(self, other)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.keys(self)
+
+    def values(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.values(self)
+
+    def items(self):
+        if self.__payload is not None:
+            self.__materialize()
+        return dict.items(self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+
+class SharedMemoryEventQueue:
+    """
+    Event queue backed by a ring buffer in shared memory, for many producers and a single consumer.
+
+    Each frame carries the routing attributes of an event (subject, type, id, source) followed by the
+    serialized CloudEvent, so the consumer only decodes the routing attributes eagerly and gets the rest
+    of the event lazily as a `LazyEvent`. Event sources hand over the JSON payload they received with
+    `put_raw`, events emitted inside the worker are pickled.
+
+    Producers wait while the buffer is full, or raise `queue.Full` if they do not block. The consumer
+    thread can not wait for itself: the frames it puts while the buffer is full (e.g. events emitted by
+    actions run in the worker main thread) are kept in a local overflow, and moved to the buffer as it gets
+    frames, so they are still got in order. The same goes for the threads of the consumer process the
+    consumer waits for (e.g. those that run actions), see `add_local_producer`.
+
+    As with a `multiprocessing.Queue`, putting None stops the consumer: it is written as an empty control
+    frame and `get` returns None for it.
+    """
+
+    def __init__(self, size: int = 64 * 1024 * 1024):
+        from multiprocessing import shared_memory
+
+        size -= size % 8
+        self.__shm = shared_memory.SharedMemory(create=True, size=size + _HEADER.size)
+        self.__capacity = size
+        self.__lock = Lock()
+        self.__frames = Semaphore(0)
+        self.__consumer = None
+        self.__local_producers = set()
+        self.__overflow = deque()
+        _HEADER.pack_into(self.__shm.buf, 0, 0, 0)
+
+    def add_local_producer(self):
+        """
+        Lets the calling thread, of the consumer process, put events in the local overflow while the buffer
+        is full instead of waiting, as the consumer thread does
+        """
+        self.__local_producers.add(threading.get_ident())
+
+    def put(self, event: dict, block=True, timeout=None):
+        thread = threading.get_ident()
+        local = thread == self.__consumer or thread in self.__local_producers
+        if event is None:
+            frame = b'', {}, _STOP
+        else:
+            event = dict(event)
+            frame = (pickle.dumps(event, pickle.HIGHEST_PROTOCOL),
+                     {key: event[key] for key in ROUTING_ATTRIBUTES if key in event}, _PICKLE)
+        # Frames put after an overflowed one overflow too, so they are not got before it
+        if not (local and self.__overflow) and self.__put(*frame, block and not local, timeout):
+            return
+        if not local:
+            raise queue.Full
+        self.__overflow.append(frame)
+        # Overflowed frames are counted with the frames in the buffer, so a waiting consumer wakes up for them
+        self.__frames.release()
+
+    def put_raw(self, payload: bytes, **attributes):
+        """
+        Enqueues an already serialized JSON CloudEvent. `attributes` must include the routing attributes
+        (at least `subject` and `type`) and take precedence over the values in the payload.
+        """
+        self.__put(payload, attributes, _JSON)
+
+    def __put(self, payload, attributes, encoding, block=True, timeout=None, release=True) -> bool:
+        """
+        Writes a frame, waiting for the consumer to free space while the buffer is full. Returns False if
+        there is no space and `block` is False or `timeout` expires.
+        """
+        header = marshal.dumps(attributes)
+        frame_size = _FRAME.size + len(header) + len(payload)
+        frame_size += -frame_size % 8
+        if frame_size > self.max_event_size:
+            raise ValueError('Event of {} bytes does not fit in the event queue'.format(frame_size))
+
+        buf = self.__shm.buf
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                head, tail = _HEADER.unpack_from(buf, 0)
+                offset = tail % self.__capacity
+                padding = self.__capacity - offset if offset + frame_size > self.__capacity else 0
+                if self.__capacity - (tail - head) >= frame_size + padding:
+                    if padding:
+                        if padding >= _FRAME.size:
+                            _FRAME.pack_into(buf, _HEADER.size + offset, _PADDING, 0, 0, 0)
+                        tail += padding
+                        offset = 0
+
+                    start = _HEADER.size + offset
+                    _FRAME.pack_into(buf, start, frame_size, len(header), len(payload), encoding)
+                    start += _FRAME.size
+                    buf[start:start + len(header)] = header
+                    start += len(header)
+                    buf[start:start + len(payload)] = payload
+                    _POSITION.pack_into(buf, 8, tail + frame_size)
+                    break
+            # The lock is not held while waiting, so other producers are not blocked by a full buffer
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(0.001)
+
+        if release:
+            self.__frames.release()
+        return True
+
+    @property
+    def max_event_size(self):
+        """
+        Largest frame that can be put. A larger frame might never fit between the position of the ring
+        buffer and its end, even once the buffer is empty.
+        """
+        return self.__capacity // 2
+
+    def get(self, block=True, timeout=None):
+        self.__consumer = threading.get_ident()
+        if not self.__frames.acquire(block, timeout):
+            raise queue.Empty
+
+        buf = self.__shm.buf
+        head, tail = _HEADER.unpack_from(buf, 0)
+        if head == tail:
+            # Frames only overflow while the buffer is full, it is empty once they are all that is left
+            payload, attributes, encoding = self.__overflow.popleft()
+        else:
+            offset = head % self.__capacity
+            if self.__capacity - offset < _FRAME.size or _FRAME.unpack_from(buf, _HEADER.size + offset)[0] == _PADDING:
+                head += self.__capacity - offset
+                offset = 0
+
+            start = _HEADER.size + offset
+            frame_size, header_size, payload_size, encoding = _FRAME.unpack_from(buf, start)
+            start += _FRAME.size
+            attributes = marshal.loads(buf[start:start + header_size])
+            start += header_size
+            payload = bytes(buf[start:start + payload_size])
+
+            _POSITION.pack_into(buf, 0, head + frame_size)
+            self.__flush_overflow()
+
+        if encoding == _STOP:
+            return None
+        return LazyEvent(attributes, payload, encoding)
+
+    def __flush_overflow(self):
+        """
+        Moves the overflowed frames to the space freed in the buffer. A frame leaves the overflow once it is in
+        the buffer, so local producers keep overflowing until the frames before theirs are in the buffer.
+        """
+        while self.__overflow:
+            if not self.__put(*self.__overflow[0], block=False, release=False):
+                return
+            self.__overflow.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.__frames.get_value()
+
+    def empty(self):
+        head, tail = _HEADER.unpack_from(self.__shm.buf, 0)
+        return head == tail and not self.__overflow
+
+    def unlink(self):
+        self.__shm.close()
+        self.__shm.unlink()
+
+
+def new_event_queue(config: dict):
+    """
+    Instantiates the event queue configured in the `worker.event_queue` section of the config map.
+    Defaults to a `multiprocessing.Queue`.
+    """
+    queue_config = (config.get('worker') or {}).get('event_queue') or {}
+    queue_class = queue_config.get('class', 'Queue')
+
+    if queue_class == 'Queue':
+        return multiprocessing.Queue()
+    return globals()[queue_class](**queue_config.get('parameters', {}))
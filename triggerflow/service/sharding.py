@@ -0,0 +1,430 @@
+import pickle
+import logging
+import traceback
+from uuid import uuid4
+from zlib import crc32
+from datetime import datetime
+from multiprocessing import Process, Queue
+from threading import Thread
+from collections import defaultdict, Counter
+
+from . import storage
+from . import eventsources
+from .index import TriggerIndex
+from .queues import new_event_queue, SharedMemoryEventQueue
+from .sync import TriggerSync
+from .deadletters import DeadLetterQueue, ReplayListener
+from .pending import commit_events
+from .metrics import MetricsRegistry, MetricsReporter
+from .tracing import new_tracer
+from .eventlog import new_event_logger
+from .timers import TimerService, TIMERS_EVENT_SOURCE
+from .flowcontrol import new_flow_control
+from .worker import Worker, Shard, SHARD_TRIGGERS_EVENT_TYPE
+
+
+class ShardedWorker(Process):
+    """
+    Processes a single workspace with several worker processes.
+
+    The router process consumes the workspace event sources and forwards every event to the shards that
+    own the triggers activated by it. Triggers are placed so that each shard owns a disjoint partition of
+    the trigger table: triggers that can be activated by the same event (same activation subject, or a
+    prefix subject that matches it), and triggers whose actions update the context of the triggers
+    activated by the subject they emit (e.g. DAG task joins), always land on the same shard. Events
+    emitted by actions are sent back to the router, so they reach the right shard.
+
+    Sharding therefore scales with the number of independent trigger groups of a workspace (e.g. event
+    processing rules over disjoint subjects, or many independent workflows): the triggers of a connected
+    DAG form a single group, and run on a single shard however wide the DAG is, since its actions update
+    the join counters in the contexts of its downstream triggers. A warning is logged when most triggers
+    of the workspace form a single group, and the triggers placed on each shard are exported as the
+    `triggerflow_shard_triggers` gauge.
+    """
+
+    def __init__(self, workspace, config, metrics_queue: Queue = None):
+        super().__init__()
+        self.workspace = workspace
+        self.worker_id = str(uuid4())[:6]
+        self.__config = config
+        worker_config = config.get('worker') or {}
+        self.num_shards = max(1, int(worker_config.get('shards', 1)))
+        self.trigger_sync_interval = float(worker_config.get('trigger_sync_interval', 5))
+        self.negative_cache_size = int(worker_config.get('negative_cache_size', 10000))
+        self.dead_letters_max_length = int(worker_config.get('dead_letters_max_length', 10000))
+        self.dead_letters_max_age = float(worker_config.get('dead_letters_max_age', 604800))
+        self.metrics_interval = float(worker_config.get('metrics_interval', 10))
+        self.timer_tick = float(worker_config.get('timer_tick_ms', 100)) / 1000
+
+        self.start_time = 0
+        self.trigger_storage = None
+        self.trigger_sync = None
+        self.timers = None
+        self.event_sources = {}
+        self.event_queue = new_event_queue(config)
+        self.commit_queue = Queue()
+        self.flow_control = new_flow_control(config, self.__queue_depth, workspace)
+        self.dead_letter_queue = None
+        self.replay_listener = None
+        self.metrics = MetricsRegistry()
+        self.metrics_queue = metrics_queue
+        self.metrics_reporter = None
+        self.tracer = None
+        self.shards = []
+        self.trigger_mapping = TriggerIndex()
+        self.trigger_shards = {}
+        self.__activations = {}
+        self.__parents = {}
+        self.__group_shards = {}
+        self.__exact_subjects = set()
+        self.__prefix_subjects = set()
+        self.__unbalanced = False
+
+        self.state = Worker.State.INITIALIZED
+
+    def __start_db(self):
+        logging.info('[{}] Creating database connection'.format(self.workspace))
+        backend = self.__config['trigger_storage']['backend']
+        trigger_storage_class = getattr(storage, backend.capitalize() + 'TriggerStorage')
+        self.trigger_storage = trigger_storage_class(**self.__config['trigger_storage']['parameters'])
+
+    def __start_event_sources(self):
+        logging.info("[{}] Starting event sources ".format(self.workspace))
+        event_sources = self.trigger_storage.get(workspace=self.workspace, document_id='event_sources')
+        for evt_src in event_sources.values():
+            if evt_src['name'] in self.event_sources:
+                continue
+            logging.info("[{}] Starting {}".format(self.workspace, evt_src['name']))
+            event_source_class = getattr(eventsources, '{}'.format(evt_src['class']))
+            event_source = event_source_class(event_queue=self.event_queue,
+                                              name=evt_src['name'],
+                                              **evt_src['parameters'])
+            # The router only traces the reception of events, the shards trace their processing
+            event_source.tracer = self.tracer
+            event_source.flow_control = self.flow_control
+            event_source.event_log = new_event_logger(self.__config, 'event_sources', evt_src['name'])
+            event_source.start()
+            self.event_sources[evt_src['name']] = event_source
+
+    def __stop_event_sources(self):
+        logging.info("[{}] Stopping event sources ".format(self.workspace))
+        for evt_src in list(self.event_sources):
+            self.event_sources[evt_src].stop()
+            del self.event_sources[evt_src]
+
+    def __start_dead_letters(self):
+        self.dead_letter_queue = DeadLetterQueue(self.trigger_storage, self.workspace,
+                                                 max_length=self.dead_letters_max_length,
+                                                 max_age=self.dead_letters_max_age)
+        self.dead_letter_queue.start()
+        self.replay_listener = ReplayListener(self.trigger_storage, self.workspace, self.event_queue,
+                                              interval=self.trigger_sync_interval)
+        self.replay_listener.start()
+
+    def __stop_dead_letters(self):
+        self.replay_listener.stop()
+        self.dead_letter_queue.stop()
+
+    def __start_metrics(self):
+        if self.metrics_queue is None:
+            return
+        self.metrics_reporter = MetricsReporter(self.metrics, self.metrics_queue, self.workspace, self.worker_id,
+                                                interval=self.metrics_interval, collect=self.__collect_metrics)
+        self.metrics_reporter.start()
+
+    def __stop_metrics(self):
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop()
+
+    def __collect_metrics(self):
+        # The shards report the depth of their own event queues
+        try:
+            self.metrics.set('triggerflow_event_queue_depth', self.event_queue.qsize(), role='router')
+        except NotImplementedError:
+            pass
+        self.metrics.set('triggerflow_dead_letters_buffered', self.dead_letter_queue.qsize())
+        shard_triggers = Counter(self.trigger_shards.values())
+        for shard in range(self.num_shards):
+            self.metrics.set('triggerflow_shard_triggers', shard_triggers[shard], shard=str(shard))
+        if self.flow_control is not None:
+            self.metrics.set('triggerflow_event_sources_paused', int(self.flow_control.paused))
+            self.metrics.set('triggerflow_event_sources_pauses', self.flow_control.pauses)
+
+    def __queue_depth(self):
+        # The router forwards events as soon as it gets them, the backlog builds up in the slowest shard
+        return self.event_queue.qsize() + max((shard.event_queue.qsize() for shard in self.shards), default=0)
+
+    def __start_shards(self):
+        logging.info('[{}] Starting {} shards'.format(self.workspace, self.num_shards))
+        for index in range(self.num_shards):
+            shard = Shard(index=index, router_queue=self.event_queue, commit_queue=self.commit_queue)
+            worker = Worker(self.workspace, self.__config, shard=shard, metrics_queue=self.metrics_queue)
+            worker.start()
+            self.shards.append(worker)
+
+    def __stop_shards(self):
+        logging.info("[{}] Stopping shards ".format(self.workspace))
+        for worker in self.shards:
+            try:
+                worker.stop_worker()
+            except Exception:
+                worker.kill()
+
+    def __start_commiter(self):
+
+        def commiter(commit_queue):
+            """
+            Commit the events processed by the shards
+            """
+            while True:
+                events = commit_queue.get()
+                if events is None:
+                    break
+                commit_events(self.event_sources, events)
+                self.timers.commit(events)
+
+        self.__commiter = Thread(target=commiter, args=(self.commit_queue,), daemon=True)
+        self.__commiter.start()
+
+    def __find(self, node):
+        parents = self.__parents
+        root = parents.setdefault(node, node)
+        while root != parents[root]:
+            root = parents[root]
+        while node != root:
+            parents[node], node = root, parents[node]
+        return root
+
+    def __union(self, node_a, node_b):
+        root_a, root_b = self.__find(node_a), self.__find(node_b)
+        if root_a == root_b:
+            return
+        shard_a, shard_b = self.__group_shards.pop(root_a, None), self.__group_shards.pop(root_b, None)
+        if shard_a is not None and shard_b is not None and shard_a != shard_b:
+            logging.warning('[{}] Triggers of {} and {} are already placed on different shards'.format(
+                self.workspace, node_a, node_b))
+        self.__parents[root_b] = root_a
+        shard = shard_a if shard_a is not None else shard_b
+        if shard is not None:
+            self.__group_shards[root_a] = shard
+
+    def __link_subject(self, subject):
+        """
+        Groups an activation subject with the subjects that match the same events: an exact subject with
+        the prefix subjects (e.g. `map_*`) it starts with, and overlapping prefix subjects, so an event is
+        always routed to a single shard
+        """
+        wildcard = TriggerIndex.WILDCARD
+        if subject.endswith(wildcard):
+            if subject in self.__prefix_subjects:
+                return
+            prefix = subject[:-1]
+            overlapping = [exact for exact in self.__exact_subjects if exact.startswith(prefix)]
+            overlapping.extend(other for other in self.__prefix_subjects
+                               if other[:-1].startswith(prefix) or prefix.startswith(other[:-1]))
+            self.__prefix_subjects.add(subject)
+        else:
+            if subject in self.__exact_subjects:
+                return
+            overlapping = [other for other in self.__prefix_subjects if subject.startswith(other[:-1])]
+            self.__exact_subjects.add(subject)
+        for other in overlapping:
+            self.__union('subject:' + subject, 'subject:' + other)
+
+    @staticmethod
+    def __affinity_nodes(trigger_id, trigger_json):
+        nodes = ['trigger:' + trigger_id]
+        nodes.extend('subject:' + event['subject'] for event in trigger_json['activation_events'])
+        context = trigger_json['context']
+        # Actions that update the context of the triggers activated by the subject they emit
+        if isinstance(context.get('subject'), str):
+            nodes.append('subject:' + context['subject'])
+        if isinstance(context.get('join_state_machine'), str):
+            nodes.append('trigger:' + context['join_state_machine'])
+        return nodes
+
+    def __get_triggers(self):
+        logging.info("[{}] Updating triggers placement".format(self.workspace))
+        try:
+            all_triggers = self.trigger_sync.load()
+        except KeyError:
+            logging.error('Could not retrieve triggers for {}'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+        self.__place_triggers(all_triggers)
+
+    def __sync_triggers(self):
+        try:
+            added, deleted = self.trigger_sync.changes(self.trigger_shards)
+        except Exception:
+            logging.error('[{}] Could not retrieve trigger changes'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+
+        # Deleted triggers stay loaded in their shard, but no longer get events routed to them
+        for trigger_id in deleted:
+            if self.trigger_shards.pop(trigger_id, None) is not None:
+                for subject, event_type in self.__activations.pop(trigger_id):
+                    self.trigger_mapping.remove(subject, event_type, trigger_id)
+        self.__place_triggers(added)
+
+    def __place_triggers(self, triggers):
+        new_triggers = {key: value for key, value in triggers.items()
+                        if key != "0" and key not in self.trigger_shards}
+
+        for trigger_id, trigger_json in new_triggers.items():
+            nodes = self.__affinity_nodes(trigger_id, trigger_json)
+            for node in nodes[1:]:
+                self.__union(nodes[0], node)
+            for event in trigger_json['activation_events']:
+                self.__link_subject(event['subject'])
+
+        placement = defaultdict(dict)
+        for trigger_id, trigger_json in new_triggers.items():
+            root = self.__find('trigger:' + trigger_id)
+            if root not in self.__group_shards:
+                self.__group_shards[root] = crc32(root.encode('utf-8')) % self.num_shards
+            shard = self.__group_shards[root]
+
+            self.trigger_shards[trigger_id] = shard
+            self.__activations[trigger_id] = [(event['subject'], event['type'])
+                                              for event in trigger_json['activation_events']]
+            for event in trigger_json['activation_events']:
+                self.trigger_mapping.add(event['subject'], event['type'], trigger_id)
+            placement[shard][trigger_id] = trigger_json
+
+        for shard, triggers in placement.items():
+            for chunk in self.__placement_chunks(self.shards[shard].event_queue, triggers):
+                try:
+                    self.shards[shard].event_queue.put({'specversion': '1.0',
+                                                        'id': uuid4().hex,
+                                                        'source': 'urn:triggerflow:router:{}'.format(self.worker_id),
+                                                        'type': SHARD_TRIGGERS_EVENT_TYPE,
+                                                        'subject': SHARD_TRIGGERS_EVENT_TYPE,
+                                                        'data': chunk})
+                except ValueError:
+                    logging.error('[{}] Could not place triggers {} in shard {}, they do not fit in its event '
+                                  'queue'.format(self.workspace, ', '.join(chunk), shard))
+        if new_triggers:
+            logging.info("[{}] Placed {} new triggers".format(self.workspace, len(new_triggers)))
+            self.__check_balance()
+
+    def __check_balance(self):
+        """
+        Warns, once, when most triggers of the workspace are in the same group, which sharding can not spread
+        """
+        if self.num_shards == 1 or self.__unbalanced or len(self.trigger_shards) < 2 * self.num_shards:
+            return
+        groups = Counter(self.__find('trigger:' + trigger_id) for trigger_id in self.trigger_shards)
+        root, size = groups.most_common(1)[0]
+        if size > len(self.trigger_shards) / 2:
+            self.__unbalanced = True
+            logging.warning('[{}] {} of {} triggers update each other\'s context (e.g. a DAG) and run on shard {}, '
+                            'sharding does not spread them'.format(self.workspace, size, len(self.trigger_shards),
+                                                                   self.__group_shards[root]))
+
+    @staticmethod
+    def __placement_chunks(event_queue, triggers):
+        """
+        Splits the triggers placed in a shard so each placement event fits in its event queue
+        """
+        max_size = getattr(event_queue, 'max_event_size', None)
+        if max_size is None:
+            return [triggers]
+        # Room for the attributes of the placement event
+        max_size -= 1024
+
+        chunks = [{}]
+        size = 0
+        for trigger_id, trigger_json in triggers.items():
+            trigger_size = len(pickle.dumps(trigger_json, pickle.HIGHEST_PROTOCOL)) + len(trigger_id)
+            if chunks[-1] and size + trigger_size > max_size:
+                chunks.append({})
+                size = 0
+            chunks[-1][trigger_id] = trigger_json
+            size += trigger_size
+        return chunks
+
+    def __should_run(self):
+        return self.state == Worker.State.RUNNING
+
+    def run(self):
+        logging.info('[{}] Starting sharded worker {}'.format(self.workspace, self.worker_id))
+        self.start_time = datetime.now()
+
+        self.__start_db()
+        self.__start_dead_letters()
+        self.__start_metrics()
+        self.tracer = new_tracer(self.__config, self.workspace)
+        self.__start_shards()
+        self.trigger_sync = TriggerSync(self.trigger_storage, self.workspace,
+                                        interval=self.trigger_sync_interval,
+                                        negative_cache_size=self.negative_cache_size)
+        self.__get_triggers()
+        self.trigger_sync.start()
+        # Timeout events are routed as any other event
+        self.timers = TimerService(self.trigger_storage, self.workspace, self.event_queue,
+                                   tick=self.timer_tick, interval=self.trigger_sync_interval)
+        self.timers.load()
+        self.timers.start()
+        self.__start_commiter()
+        self.__start_event_sources()
+
+        logging.info('[{}] Sharded worker {} Started'.format(self.workspace, self.worker_id))
+        self.state = Worker.State.RUNNING
+
+        while self.__should_run():
+            event = self.event_queue.get()
+            if event is None:
+                break
+            self.metrics.inc('triggerflow_events_received_total', event_source=event.get('event_source') or 'local',
+                             role='router')
+
+            if self.trigger_sync.pending:
+                self.__sync_triggers()
+
+            subject, event_type = event['subject'], event['type']
+            # The events that guard a timer do not need a trigger
+            self.timers.on_event(event)
+            trigger_ids = self.trigger_mapping.match(subject, event_type)
+            if not trigger_ids:
+                if (subject, event_type) not in self.trigger_sync.missing:
+                    self.__sync_triggers()
+                    trigger_ids = self.trigger_mapping.match(subject, event_type)
+                if not trigger_ids:
+                    logging.warning('[{}] Event with subject {} not in cache'.format(self.workspace, subject))
+                    self.trigger_sync.missing.add(subject, event_type)
+                    if event.get('event_source') == TIMERS_EVENT_SOURCE:
+                        # No trigger will commit it, its timer would fire again on every restart
+                        self.timers.commit([(TIMERS_EVENT_SOURCE, event['id'])])
+                    self.dead_letter_queue.put(event)
+                    self.metrics.inc('triggerflow_events_dead_lettered_total')
+                    continue
+
+            for shard in {self.trigger_shards[trigger_id] for trigger_id in trigger_ids}:
+                self.shards[shard].event_queue.put(event)
+
+        self.state = Worker.State.FINISHED
+        self.trigger_sync.stop()
+        self.timers.stop()
+        self.__stop_dead_letters()
+        self.__stop_event_sources()
+        self.__stop_shards()
+        self.__stop_metrics()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.commit_queue.put(None)
+        logging.info("[{}] Sharded worker {} finished".format(self.workspace, self.worker_id))
+
+    def stop_worker(self):
+        logging.info("[{}] Stopping sharded worker {}".format(self.workspace, self.worker_id))
+        self.state = Worker.State.FINISHED
+        self.event_queue.put(None)  # Stop router, which in turn stops the shards
+        self.join(timeout=30)
+        try:
+            self.terminate()
+        except Exception:
+            pass
+        if isinstance(self.event_queue, SharedMemoryEventQueue):
+            self.event_queue.unlink()
+        logging.info("[{}] Sharded worker {} stopped".format(self.workspace, self.worker_id))
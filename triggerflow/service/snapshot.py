@@ -0,0 +1,125 @@
+import os
+import copy
+import mmap
+import pickle
+import struct
+import cloudpickle
+
+from .trigger import Context, Trigger
+
+_MAGIC = b'TFSNAP02'
+# Magic, creation time of the workspace, version of the triggers document, time the snapshot was taken and
+# sizes of the two payloads
+_HEADER = struct.Struct('<8sdQdQQ')
+
+
+class TriggerSnapshot:
+    """
+    Local binary snapshot of the materialized trigger table and trigger index of a worker, so a restarting
+    worker does not have to decode every trigger from the trigger storage again.
+
+    The snapshot is tagged with the version of the `triggers` document it reflects and the time it was
+    taken. On restart, the triggers added, updated or deleted since that version and the triggers
+    checkpointed since that time (plus the triggers that were not checkpointed yet when it was taken,
+    which are kept in the snapshot as stale) are read from the trigger storage again. The snapshot is also
+    tagged with the creation time of the workspace, as versions start over when a workspace is created again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def capture(triggers: dict, trigger_mapping, skip: set = frozenset()) -> tuple:
+        """
+        Copies the trigger table and index, so they can be serialized by `dump` on another thread while the
+        worker goes on. The contexts of the triggers in `skip` (e.g. being modified by an action) are left
+        out, they must be stored as stale.
+        """
+        records = [(trigger.trigger_id, trigger.condition_meta, trigger.action_meta, trigger.activation_events,
+                    trigger.transient, trigger.uuid, trigger.workspace, trigger.timestamp,
+                    {} if trigger.trigger_id in skip else dict(trigger.context))
+                   for trigger in triggers.values()]
+        return copy.deepcopy((records, trigger_mapping, list(set(Context._python_objects))))
+
+    @staticmethod
+    def dump(state: tuple) -> bytes:
+        """
+        Serializes a state taken by `capture`. Trigger contexts keep their Python objects as they are.
+        """
+        return cloudpickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, version: int, timestamp: float, data: bytes, stale: set, workspace_created: float = 0.0):
+        stale_data = pickle.dumps(list(stale), pickle.HIGHEST_PROTOCOL)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(_HEADER.pack(_MAGIC, workspace_created, version, timestamp, len(data),
+                                             len(stale_data)))
+            snapshot_file.write(data)
+            snapshot_file.write(stale_data)
+        # Readers never see a partially written snapshot
+        os.replace(tmp_path, self.path)
+
+    def read(self):
+        """
+        Returns the (version, timestamp, records, trigger index, stale trigger ids, workspace creation time) of
+        the snapshot, or None if there is no valid snapshot
+        """
+        try:
+            with open(self.path, 'rb') as snapshot_file, \
+                    mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                magic, workspace_created, version, timestamp, data_size, stale_size = _HEADER.unpack_from(snapshot)
+                if magic != _MAGIC:
+                    return None
+                offset = _HEADER.size
+                with memoryview(snapshot) as view:
+                    records, trigger_mapping, python_objects = pickle.loads(view[offset:offset + data_size])
+                    stale = pickle.loads(view[offset + data_size:offset + data_size + stale_size])
+        except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError):
+            return None
+
+        for key in python_objects:
+            if key not in Context._python_objects:
+                Context._python_objects.append(key)
+        return version, timestamp, records, trigger_mapping, set(stale), workspace_created
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def restore_trigger(record: tuple, condition: callable, action: callable, **context_args) -> Trigger:
+    """
+    Materializes a trigger from a snapshot record, see `load_trigger`
+    """
+    trigger_id, condition_meta, action_meta, activation_events, transient, uuid, workspace, timestamp, values = record
+    context = Context(trigger_id=trigger_id,
+                      activation_events=activation_events,
+                      condition=condition,
+                      action=action,
+                      **context_args)
+    dict.update(context, values)
+
+    return Trigger(condition=condition,
+                   action=action,
+                   context=context,
+                   trigger_id=trigger_id,
+                   condition_meta=condition_meta,
+                   action_meta=action_meta,
+                   activation_events=activation_events,
+                   transient=transient,
+                   uuid=uuid,
+                   workspace=workspace,
+                   timestamp=timestamp)
+
+
+def new_snapshot(config: dict, workspace: str):
+    """
+    Returns the snapshot of a workspace if a `worker.snapshot_dir` is configured
+    """
+    directory = (config.get('worker') or {}).get('snapshot_dir')
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return TriggerSnapshot(os.path.join(directory, '{}.snapshot'.format(workspace)))
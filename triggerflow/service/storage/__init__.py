@@ -1,2 +1,2 @@
-from .model import TriggerStorage
+from .model import TriggerStorage, ChangesExpired
 from .redis import RedisTriggerStorage
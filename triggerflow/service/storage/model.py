@@ -1,5 +1,13 @@
 
 
+class ChangesExpired(Exception):
+    """
+    Raised by `get_changes` when changes newer than `since` were already trimmed from the change log, so
+    the reader has to read the whole document again
+    """
+    pass
+
+
 class TriggerStorage:
     def __init__(self):
         pass
@@ -28,6 +36,9 @@ class TriggerStorage:
     def workspace_exists(self, workspace):
         raise NotImplementedError()
 
+    def get_workspace_creation_time(self, workspace):
+        raise NotImplementedError()
+
     def delete_workspace(self, workspace):
         raise NotImplementedError()
 
@@ -43,14 +54,53 @@ class TriggerStorage:
     def set_key(self, workspace, document_id, key, value):
         raise NotImplementedError()
 
+    def set_keys(self, workspace: str, document_id: str, data: dict):
+        raise NotImplementedError()
+
+    def set_documents_keys(self, workspace: str, documents: dict):
+        raise NotImplementedError()
+
+    def get_updated_keys(self, workspace: str, document_id: str, since: float):
+        raise NotImplementedError()
+
     def get_key(self, workspace, document_id, key):
         raise NotImplementedError()
 
+    def get_keys(self, workspace: str, document_id: str, keys: list):
+        raise NotImplementedError()
+
     def delete_key(self, workspace, document_id, key):
         raise NotImplementedError()
 
     def delete_keys(self, workspace: str, document_id: str, keys: list):
         raise NotImplementedError()
 
+    def get_version(self, workspace: str, document_id: str):
+        raise NotImplementedError()
+
+    def get_changes(self, workspace: str, document_id: str, since: int):
+        raise NotImplementedError()
+
+    def wait_changes(self, workspace: str, document_id: str, since: int, timeout: float):
+        raise NotImplementedError()
+
+    def stop_waiting(self, workspace: str, document_id: str = None):
+        raise NotImplementedError()
+
+    def add_dead_letters(self, workspace: str, events: list, max_length: int, max_age: float):
+        raise NotImplementedError()
+
+    def get_dead_letters(self, workspace: str, count: int = None):
+        raise NotImplementedError()
+
+    def replay_dead_letters(self, workspace: str, subjects: list = None):
+        raise NotImplementedError()
+
+    def pop_replayed_events(self, workspace: str, timeout: float, count: int = 1000):
+        raise NotImplementedError()
+
+    def ack_replayed_events(self, workspace: str):
+        raise NotImplementedError()
+
     def new_trigger(self, workspace):
         raise NotImplementedError()
@@ -3,14 +3,18 @@ import time
 import json
 import logging
 
-from triggerflow.service.storage.model import TriggerStorage
+from triggerflow.service.storage.model import TriggerStorage, ChangesExpired
 
 
 class RedisTriggerStorage(TriggerStorage):
-    def __init__(self, host: str, port: int = 6379, password: str = None, db: int = 0):
+    def __init__(self, host: str, port: int = 6379, password: str = None, db: int = 0,
+                 max_deleted_keys: int = 10000):
         super().__init__()
         self.client = redis.StrictRedis(host=host, port=port, password=password, db=db,
                                         charset="utf-8", decode_responses=True)
+        self.db = db
+        self.max_deleted_keys = max_deleted_keys
+        self.__watchers = {}
         if not self.client.ping():
             raise Exception('Could not establish a connection to Redis node')
 
@@ -25,7 +29,8 @@ class RedisTriggerStorage(TriggerStorage):
         for key in data:
             formated_data[key] = json.dumps(data[key])
         if formated_data:
-            self.client.hmset(redis_key, formated_data)
+            self.__log_changes(workspace, document_id, list(formated_data),
+                               lambda pipe: pipe.hmset(redis_key, formated_data))
 
     def get(self, workspace: str, document_id: str):
         redis_key = '{}-{}'.format(workspace, document_id)
@@ -62,9 +67,18 @@ class RedisTriggerStorage(TriggerStorage):
         redis_key = 'triggerflow-workspaces'
         return self.client.hexists(redis_key, workspace)
 
+    def get_workspace_creation_time(self, workspace):
+        """
+        Returns the time a workspace was created, which tells apart a workspace deleted and created again
+        """
+        redis_key = 'triggerflow-workspaces'
+        created = self.client.hget(redis_key, workspace)
+        return float(created) if created is not None else None
+
     def delete_workspace(self, workspace):
         redis_key = 'triggerflow-workspaces'
         self.client.hdel(redis_key, workspace)
+        self.stop_waiting(workspace)
 
         wk = self.client.keys('{}-*'.format(workspace))
         for k in wk:
@@ -84,20 +98,226 @@ class RedisTriggerStorage(TriggerStorage):
 
     def set_key(self, workspace, document_id, key, value):
         redis_key = '{}-{}'.format(workspace, document_id)
-        self.client.hset(redis_key, key, json.dumps(value))
+        self.__log_changes(workspace, document_id, [key],
+                           lambda pipe: pipe.hset(redis_key, key, json.dumps(value)))
+
+    def set_keys(self, workspace: str, document_id: str, data: dict):
+        # All keys are written with a single HSET, i.e. in one round trip. Meant for updates of
+        # existing keys (e.g. trigger checkpoints), which are not logged as changes. The time of the
+        # last update of each key is kept apart, see `get_updated_keys`
+        self.set_documents_keys(workspace, {document_id: data})
+
+    def set_documents_keys(self, workspace: str, documents: dict):
+        """
+        `set_keys` of several documents, written atomically in one round trip
+        """
+        pipe = self.client.pipeline(transaction=True)
+        for document_id, data in documents.items():
+            if data:
+                redis_key = '{}-{}'.format(workspace, document_id)
+                updates_key = '{}-{}-updates'.format(workspace, document_id)
+                pipe.hset(redis_key, mapping={key: json.dumps(value) for key, value in data.items()})
+                pipe.zadd(updates_key, {key: time.time() for key in data})
+        if len(pipe):
+            pipe.execute()
+
+    def get_updated_keys(self, workspace: str, document_id: str, since: float):
+        """
+        Returns the keys of a document written with `set_keys` after time `since`
+        """
+        updates_key = '{}-{}-updates'.format(workspace, document_id)
+        return self.client.zrangebyscore(updates_key, '({}'.format(since), '+inf')
 
     def get_key(self, workspace, document_id, key):
         redis_key = '{}-{}'.format(workspace, document_id)
         value = self.client.hget(redis_key, key)
         return json.loads(value) if value is not None else None
 
+    def get_keys(self, workspace: str, document_id: str, keys: list):
+        redis_key = '{}-{}'.format(workspace, document_id)
+        if not keys:
+            return {}
+        values = self.client.hmget(redis_key, keys)
+        return {key: json.loads(value) if value is not None else None for key, value in zip(keys, values)}
+
     def delete_key(self, workspace, document_id, key):
         redis_key = '{}-{}'.format(workspace, document_id)
-        return self.client.hdel(redis_key, key)
+        return self.__log_changes(workspace, document_id, [key],
+                                  lambda pipe: pipe.hdel(redis_key, key), deleted=True)
 
     def delete_keys(self, workspace: str, document_id: str, keys: list):
         redis_key = '{}-{}'.format(workspace, document_id)
-        self.client.hdel(redis_key, *keys)
+        if keys:
+            self.__log_changes(workspace, document_id, keys,
+                               lambda pipe: pipe.hdel(redis_key, *keys), deleted=True)
+
+    def __log_changes(self, workspace, document_id, keys, write, deleted=False):
+        """
+        Runs `write` in a transaction that also increments the version of the document and logs the
+        written keys in its change log, a sorted set that keeps the last version in which each key changed.
+        Deleted keys are logged apart, in a sorted set of at most `max_deleted_keys` keys: the oldest ones
+        are trimmed, and the last trimmed version is kept so `get_changes` can tell when a reader is
+        behind it. Returns the result of `write`.
+        """
+        version_key = '{}-{}-version'.format(workspace, document_id)
+        changes_key = '{}-{}-changes'.format(workspace, document_id)
+        deleted_key = '{}-{}-deleted'.format(workspace, document_id)
+        trimmed_key = '{}-{}-trimmed'.format(workspace, document_id)
+        updates_key = '{}-{}-updates'.format(workspace, document_id)
+
+        def transaction(pipe):
+            version = int(pipe.get(version_key) or 0) + 1
+            trimmed = []
+            if deleted:
+                deleted_keys = pipe.zcard(deleted_key)
+                excess = min(deleted_keys, deleted_keys + len(keys) - self.max_deleted_keys)
+                if excess > 0:
+                    trimmed = pipe.zrange(deleted_key, excess - 1, excess - 1, withscores=True)
+            pipe.multi()
+            write(pipe)
+            pipe.set(version_key, version)
+            if deleted:
+                pipe.zrem(changes_key, *keys)
+                pipe.zrem(updates_key, *keys)
+                if trimmed:
+                    pipe.zremrangebyrank(deleted_key, 0, excess - 1)
+                    pipe.set(trimmed_key, int(trimmed[0][1]))
+                pipe.zadd(deleted_key, {key: version for key in keys})
+            else:
+                pipe.zadd(changes_key, {key: version for key in keys})
+                pipe.zrem(deleted_key, *keys)
+
+        return self.client.transaction(transaction, version_key)[0]
+
+    def get_version(self, workspace: str, document_id: str):
+        version_key = '{}-{}-version'.format(workspace, document_id)
+        return int(self.client.get(version_key) or 0)
+
+    def get_changes(self, workspace: str, document_id: str, since: int):
+        """
+        Returns the keys of a document that were set or deleted after version `since`, and the version
+        they are up to date with. Raises ChangesExpired if deletions after `since` were already trimmed.
+        """
+        changes_key = '{}-{}-changes'.format(workspace, document_id)
+        deleted_key = '{}-{}-deleted'.format(workspace, document_id)
+        trimmed_key = '{}-{}-trimmed'.format(workspace, document_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrangebyscore(changes_key, '({}'.format(since), '+inf', withscores=True)
+        pipe.zrangebyscore(deleted_key, '({}'.format(since), '+inf', withscores=True)
+        pipe.get(trimmed_key)
+        changes, deletions, trimmed = pipe.execute()
+
+        if since < int(trimmed or 0):
+            raise ChangesExpired('Changes of {}-{} since version {} were trimmed up to version {}'.format(
+                workspace, document_id, since, trimmed))
+        changes += deletions
+        version = int(max(score for _, score in changes)) if changes else since
+        return [key for key, _ in changes], version
+
+    def wait_changes(self, workspace: str, document_id: str, since: int, timeout: float):
+        """
+        Blocks until the version of a document is newer than `since` or `timeout` seconds elapse, and
+        returns the current version. Changes are notified through keyspace events if they are enabled
+        in the Redis server (notify-keyspace-events), otherwise the version is polled every `timeout` seconds.
+        """
+        version_key = '{}-{}-version'.format(workspace, document_id)
+        if version_key not in self.__watchers:
+            watcher = self.client.pubsub(ignore_subscribe_messages=True)
+            watcher.subscribe('__keyspace@{}__:{}'.format(self.db, version_key))
+            self.__watchers[version_key] = watcher
+        watcher = self.__watchers[version_key]
+
+        version = self.get_version(workspace, document_id)
+        if version <= since:
+            if watcher.get_message(timeout=timeout) is not None:
+                while watcher.get_message() is not None:
+                    pass
+            version = self.get_version(workspace, document_id)
+        return version
+
+    def stop_waiting(self, workspace: str, document_id: str = None):
+        """
+        Closes the keyspace event subscriptions of `wait_changes` for a document, or for all the documents
+        of a workspace
+        """
+        prefix = '{}-{}-version'.format(workspace, document_id) if document_id is not None else workspace + '-'
+        for version_key in [key for key in self.__watchers if key.startswith(prefix)]:
+            watcher = self.__watchers.pop(version_key, None)
+            if watcher is not None:
+                watcher.close()
+
+    def add_dead_letters(self, workspace: str, events: list, max_length: int, max_age: float):
+        """
+        Adds events to the dead letters of a workspace, a sorted set scored by the time they were added,
+        dropping the oldest ones beyond `max_length` events or `max_age` seconds
+        """
+        redis_key = '{}-dead_letters'.format(workspace)
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zadd(redis_key, {json.dumps(event): now for event in events})
+        if max_age:
+            pipe.zremrangebyscore(redis_key, '-inf', now - max_age)
+        if max_length:
+            pipe.zremrangebyrank(redis_key, 0, -max_length - 1)
+        pipe.execute()
+
+    def get_dead_letters(self, workspace: str, count: int = None):
+        redis_key = '{}-dead_letters'.format(workspace)
+        dead_letters = self.client.zrange(redis_key, 0, count - 1 if count else -1)
+        return [json.loads(event) for event in dead_letters]
+
+    def replay_dead_letters(self, workspace: str, subjects: list = None):
+        """
+        Moves the dead letters of a workspace (only those with one of `subjects`, if given) to its replay
+        queue, from which workers take them back. The oldest event is at the tail of the queue. Returns the
+        number of replayed events.
+        """
+        redis_key = '{}-dead_letters'.format(workspace)
+        replay_key = '{}-replay'.format(workspace)
+
+        def transaction(pipe):
+            dead_letters = pipe.zrange(redis_key, 0, -1)
+            if subjects:
+                dead_letters = [event for event in dead_letters if json.loads(event).get('subject') in subjects]
+            pipe.multi()
+            if dead_letters:
+                pipe.zrem(redis_key, *dead_letters)
+                pipe.lpush(replay_key, *dead_letters)
+            return len(dead_letters)
+
+        return self.client.transaction(transaction, redis_key, value_from_callable=True)
+
+    def pop_replayed_events(self, workspace: str, timeout: float, count: int = 1000):
+        """
+        Blocks until there are events in the replay queue of a workspace or `timeout` seconds elapse,
+        and takes up to `count` of them. The events are kept in the replaying list of the workspace
+        until `ack_replayed_events` is called, so the events of a worker that stopped before
+        acknowledging them are returned again by the next call.
+        """
+        replay_key = '{}-replay'.format(workspace)
+        replaying_key = '{}-replaying'.format(workspace)
+        events = self.client.lrange(replaying_key, 0, -1)
+        if not events:
+            item = self.client.brpoplpush(replay_key, replaying_key, timeout=timeout)
+            if item is None:
+                return []
+
+            def transaction(pipe):
+                more = pipe.lrange(replay_key, -(count - 1), -1)[::-1] if count > 1 else []
+                pipe.multi()
+                if more:
+                    pipe.ltrim(replay_key, 0, -len(more) - 1)
+                    pipe.rpush(replaying_key, *more)
+                return [item] + more
+
+            events = self.client.transaction(transaction, replay_key, value_from_callable=True)
+        return [json.loads(event) for event in events]
+
+    def ack_replayed_events(self, workspace: str):
+        """
+        Deletes the replayed events taken by the last call to `pop_replayed_events`
+        """
+        self.client.delete('{}-replaying'.format(workspace))
 
     def new_trigger(self, workspace):
         p = self.client.pubsub()
@@ -0,0 +1,132 @@
+import time
+import logging
+import traceback
+from threading import Thread, Event
+from collections import OrderedDict
+
+from .storage import ChangesExpired
+
+
+class NegativeCache:
+    """
+    Bounded LRU set of the (subject, type) pairs known to have no trigger
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.__entries = OrderedDict()
+
+    def add(self, subject: str, event_type: str):
+        self.__entries[(subject, event_type)] = None
+        self.__entries.move_to_end((subject, event_type))
+        if len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class TriggerSync(Thread):
+    """
+    Keeps the trigger cache of a worker up to date with the trigger storage.
+
+    The thread waits for changes of the `triggers` document of the workspace (notified by the storage
+    or polled every `interval` seconds) and flags them. The worker then fetches only the triggers added
+    or deleted since the version of its cache with `changes()`, from its own thread, so the cache is
+    never modified concurrently. Pairs of subject and type found to have no trigger are kept in a
+    negative cache, so stray events do not hit the storage until new triggers are added.
+    """
+
+    def __init__(self, trigger_storage, workspace: str, interval: float = 5.0, negative_cache_size: int = 10000):
+        super().__init__(daemon=True)
+        self.trigger_storage = trigger_storage
+        self.workspace = workspace
+        self.interval = interval
+        self.version = 0
+        self.missing = NegativeCache(negative_cache_size)
+
+        self.__notified_version = 0
+        self.__pending = Event()
+        self.__stopped = Event()
+
+    def load(self) -> dict:
+        """
+        Returns all triggers of the workspace. Changes are tracked from this point on.
+        """
+        # Get the version first, changes made while reading are fetched again by the next sync
+        self.version = self.trigger_storage.get_version(workspace=self.workspace, document_id='triggers')
+        self.__pending.clear()
+        self.missing.clear()
+        return self.trigger_storage.get(workspace=self.workspace, document_id='triggers')
+
+    def resume(self, version: int):
+        """
+        Tracks changes from `version` on, e.g. the version of a trigger snapshot. The triggers changed since
+        then are returned by the next call to `changes()`.
+        """
+        self.version = version
+        self.__pending.set()
+        self.missing.clear()
+
+    @property
+    def pending(self) -> bool:
+        return self.__pending.is_set()
+
+    def changes(self, known=()):
+        """
+        Returns the triggers added and the ids of the triggers deleted since the last sync. If the changes
+        are no longer in the change log, all the triggers are returned as added, and the `known` trigger
+        ids that no longer exist as deleted.
+        """
+        self.__pending.clear()
+        try:
+            keys, version = self.trigger_storage.get_changes(workspace=self.workspace, document_id='triggers',
+                                                             since=self.version)
+            triggers = self.trigger_storage.get_keys(workspace=self.workspace, document_id='triggers', keys=keys)
+        except ChangesExpired:
+            logging.warning('[{}] Trigger changes since version {} expired, reading all triggers'.format(
+                self.workspace, self.version))
+            version = self.trigger_storage.get_version(workspace=self.workspace, document_id='triggers')
+            triggers = self.trigger_storage.get(workspace=self.workspace, document_id='triggers')
+            triggers.update((trigger_id, None) for trigger_id in known if trigger_id not in triggers)
+        self.version = version
+
+        added = {trigger_id: trigger_json for trigger_id, trigger_json in triggers.items()
+                 if trigger_json is not None}
+        deleted = [trigger_id for trigger_id, trigger_json in triggers.items() if trigger_json is None]
+        if added:
+            # New triggers may be activated by any of the subjects known to have none
+            self.missing.clear()
+        return added, deleted
+
+    def run(self):
+        logging.info('[{}] Starting trigger sync'.format(self.workspace))
+        while not self.__stopped.is_set():
+            try:
+                since = max(self.version, self.__notified_version)
+                version = self.trigger_storage.wait_changes(workspace=self.workspace, document_id='triggers',
+                                                            since=since, timeout=self.interval)
+            except Exception:
+                logging.error('[{}] Error waiting for trigger changes'.format(self.workspace))
+                logging.error(traceback.format_exc())
+                time.sleep(self.interval)
+                continue
+
+            if version > since:
+                self.__notified_version = version
+                self.__pending.set()
+
+        # Closed by the thread that waits on it
+        try:
+            self.trigger_storage.stop_waiting(workspace=self.workspace, document_id='triggers')
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def stop(self):
+        self.__stopped.set()
@@ -0,0 +1,268 @@
+import time
+import logging
+import traceback
+from math import ceil
+from threading import Thread, Event, Lock
+
+from .storage import ChangesExpired
+
+TIMEOUT_EVENT_TYPE = 'event.triggerflow.timeout'
+# Event source of the timeout events, committed with `TimerService.commit`
+TIMERS_EVENT_SOURCE = 'triggerflow.timers'
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel (Varghese and Lauck). Level 0 has `slots` slots of `tick` seconds, and each
+    slot of the next levels spans a whole turn of the previous level. Timers are added and cancelled in
+    O(1); they move one level down each time the wheel below completes a turn, until they expire.
+    Timers beyond the span of the last level wait in an overflow slot.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 64, levels: int = 4, now: float = None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int((now if now is not None else time.time()) / tick)
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.overflow = {}
+        self.__spans = [slots ** level for level in range(levels + 1)]
+        self.__timers = {}
+
+    def add(self, timer_id: str, deadline: float, payload=None):
+        """
+        Schedules a timer, replacing the timer with the same id. Timers past their deadline expire on the
+        next tick.
+        """
+        self.cancel(timer_id)
+        self.__place(timer_id, max(ceil(deadline / self.tick), self.current + 1), payload)
+
+    def cancel(self, timer_id: str) -> bool:
+        slot = self.__timers.pop(timer_id, None)
+        if slot is None:
+            return False
+        del slot[timer_id]
+        return True
+
+    def advance(self, now: float) -> list:
+        """
+        Moves the wheel up to time `now`, returns the (timer id, payload) of the expired timers
+        """
+        target = int(now / self.tick)
+        if not self.__timers:
+            self.current = max(self.current, target)
+            return []
+
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # Higher levels first, their timers may cascade to a slot of a lower level due on this tick
+            if self.current % self.__spans[self.levels] == 0:
+                self.__cascade(self.overflow)
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % self.__spans[level] == 0:
+                    self.__cascade(self.wheels[level][(self.current // self.__spans[level]) % self.slots])
+
+            slot = self.wheels[0][self.current % self.slots]
+            for timer_id, (_, payload) in slot.items():
+                del self.__timers[timer_id]
+                expired.append((timer_id, payload))
+            slot.clear()
+        return expired
+
+    def __place(self, timer_id, expires, payload):
+        # Lowest level whose current turn includes the expiration tick
+        for level in range(self.levels):
+            if expires // self.__spans[level + 1] == self.current // self.__spans[level + 1]:
+                slot = self.wheels[level][(expires // self.__spans[level]) % self.slots]
+                break
+        else:
+            slot = self.overflow
+        slot[timer_id] = (expires, payload)
+        self.__timers[timer_id] = slot
+
+    def __cascade(self, slot):
+        timers = list(slot.items())
+        slot.clear()
+        for timer_id, (expires, payload) in timers:
+            self.__place(timer_id, expires, payload)
+
+    def timer_ids(self) -> list:
+        return list(self.__timers)
+
+    def __contains__(self, timer_id):
+        return timer_id in self.__timers
+
+    def __len__(self):
+        return len(self.__timers)
+
+
+class TimerService(Thread):
+    """
+    Timeouts of a workspace. Timers are stored in its `timeouts` document, {timer id: {'event', 'deadline',
+    'cancel_subject'}}, so they survive worker restarts, and scheduled in a timing wheel. When a timer expires
+    its event is put straight in the worker event queue with type `event.triggerflow.timeout`, and the timer
+    is deleted from the document once the event is committed, so it fires again after a restart until then.
+
+    Timers are added and cancelled by writing the document; a watcher thread applies the changes, as
+    `TriggerSync` does for triggers. A timer with a `cancel_subject` is also cancelled once the worker
+    processes an event with that subject (e.g. the termination of the task it guards).
+    """
+
+    def __init__(self, trigger_storage, workspace: str, event_queue, tick: float = 0.1, interval: float = 5.0):
+        super().__init__(daemon=True)
+        self.trigger_storage = trigger_storage
+        self.workspace = workspace
+        self.event_queue = event_queue
+        self.interval = interval
+        self.version = 0
+        self.wheel = TimingWheel(tick=tick)
+        self.fired = 0
+        self.__cancel_subjects = {}
+        self.__timer_subjects = {}
+        self.__fired = {}
+        self.__deleted = []
+        self.__lock = Lock()
+        self.__wakeup = Event()
+        self.__stopped = Event()
+        self.__watcher = Thread(target=self.__watch, daemon=True)
+
+    def load(self):
+        """
+        Schedules the timers of the workspace. Changes are tracked from this point on.
+        """
+        self.version = self.trigger_storage.get_version(workspace=self.workspace, document_id='timeouts')
+        timers = self.trigger_storage.get(workspace=self.workspace, document_id='timeouts')
+        for timer_id, timer in timers.items():
+            self.schedule(timer_id, timer)
+        if timers:
+            logging.info('[{}] Loaded {} timers'.format(self.workspace, len(timers)))
+
+    def schedule(self, timer_id: str, timer: dict):
+        with self.__lock:
+            # Scheduled again, the event it fired before does not delete it
+            self.__fired.pop(timer_id, None)
+            self.__unindex(timer_id)
+            self.wheel.add(timer_id, timer['deadline'], timer)
+            if timer.get('cancel_subject'):
+                self.__cancel_subjects.setdefault(timer['cancel_subject'], set()).add(timer_id)
+                self.__timer_subjects[timer_id] = timer['cancel_subject']
+        self.__wakeup.set()
+
+    def cancel(self, timer_id: str):
+        with self.__lock:
+            self.__fired.pop(timer_id, None)
+            self.__unindex(timer_id)
+            return self.wheel.cancel(timer_id)
+
+    def commit(self, events: list):
+        """
+        Deletes the timers whose events are among the committed (event source, id) pairs
+        """
+        event_ids = {event_id for event_source, event_id in events if event_source == TIMERS_EVENT_SOURCE}
+        if not event_ids:
+            return
+        with self.__lock:
+            timer_ids = [timer_id for timer_id, event_id in self.__fired.items() if event_id in event_ids]
+            for timer_id in timer_ids:
+                del self.__fired[timer_id]
+            self.__deleted.extend(timer_ids)
+        self.__wakeup.set()
+
+    def on_event(self, event: dict):
+        """
+        Cancels the timers guarded by the subject of a processed event. Called for every event, so
+        it only checks a dict when no timer is guarded by it.
+        """
+        if event['subject'] not in self.__cancel_subjects or event['type'] == TIMEOUT_EVENT_TYPE:
+            return
+        with self.__lock:
+            for timer_id in self.__cancel_subjects.pop(event['subject'], ()):
+                del self.__timer_subjects[timer_id]
+                self.wheel.cancel(timer_id)
+                self.__deleted.append(timer_id)
+
+    def __unindex(self, timer_id):
+        subject = self.__timer_subjects.pop(timer_id, None)
+        if subject is not None:
+            timer_ids = self.__cancel_subjects[subject]
+            timer_ids.discard(timer_id)
+            if not timer_ids:
+                del self.__cancel_subjects[subject]
+
+    def __fire(self, timer_id, timer):
+        event = dict(timer['event'])
+        event['type'] = TIMEOUT_EVENT_TYPE
+        event['event_source'] = TIMERS_EVENT_SOURCE
+        # Timers fired again after a restart carry the same id, see `EventDeduplicator`
+        event.setdefault('id', timer_id)
+        self.event_queue.put(event)
+        self.fired += 1
+
+    def __watch(self):
+        while not self.__stopped.is_set():
+            try:
+                version = self.trigger_storage.wait_changes(workspace=self.workspace, document_id='timeouts',
+                                                            since=self.version, timeout=self.interval)
+                if version <= self.version:
+                    continue
+                try:
+                    keys, version = self.trigger_storage.get_changes(workspace=self.workspace,
+                                                                     document_id='timeouts', since=self.version)
+                    timers = self.trigger_storage.get_keys(workspace=self.workspace, document_id='timeouts',
+                                                           keys=keys)
+                except ChangesExpired:
+                    # Read all the timers, those no longer stored were deleted
+                    version = self.trigger_storage.get_version(workspace=self.workspace, document_id='timeouts')
+                    timers = self.trigger_storage.get(workspace=self.workspace, document_id='timeouts')
+                    with self.__lock:
+                        timers.update((timer_id, None) for timer_id in self.wheel.timer_ids()
+                                      if timer_id not in timers)
+                self.version = version
+            except Exception:
+                logging.error('[{}] Error waiting for timer changes'.format(self.workspace))
+                logging.error(traceback.format_exc())
+                time.sleep(self.interval)
+                continue
+
+            for timer_id, timer in timers.items():
+                if timer is None:
+                    self.cancel(timer_id)
+                else:
+                    self.schedule(timer_id, timer)
+
+        # Closed by the thread that waits on it
+        try:
+            self.trigger_storage.stop_waiting(workspace=self.workspace, document_id='timeouts')
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def run(self):
+        logging.info('[{}] Starting timer service'.format(self.workspace))
+        self.__watcher.start()
+        while not self.__stopped.is_set():
+            with self.__lock:
+                self.__wakeup.clear()
+                expired = self.wheel.advance(time.time())
+                for timer_id, timer in expired:
+                    self.__unindex(timer_id)
+                    self.__fired[timer_id] = timer['event'].get('id', timer_id)
+                deleted = self.__deleted
+                self.__deleted = []
+                idle = len(self.wheel) == 0
+
+            for timer_id, timer in expired:
+                self.__fire(timer_id, timer)
+            if deleted:
+                try:
+                    self.trigger_storage.delete_keys(workspace=self.workspace, document_id='timeouts', keys=deleted)
+                except Exception:
+                    logging.error('[{}] Could not delete {} timers'.format(self.workspace, len(deleted)))
+                    logging.error(traceback.format_exc())
+
+            # Tick while there are timers, otherwise sleep until one is scheduled
+            self.__wakeup.wait(None if idle else self.wheel.tick)
+
+    def stop(self):
+        self.__stopped.set()
+        self.__wakeup.set()
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+from threading import Thread, get_ident
+from contextvars import ContextVar
+
+_current_span = ContextVar('span', default=None)
+
+
+def current_span():
+    """
+    Span being run by the current thread or task, if any
+    """
+    return _current_span.get()
+
+
+def current_traceparent():
+    """
+    `traceparent` of the span being run by the current thread or task, if any
+    """
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+def parse_traceparent(traceparent: str):
+    """
+    Returns the (trace id, parent span id, sampled) of a W3C `traceparent` value, or None if it is malformed
+    """
+    try:
+        version, trace_id, span_id, flags = traceparent.split('-')
+        int(trace_id, 16), int(span_id, 16)
+        if len(version) != 2 or len(trace_id) != 32 or len(span_id) != 16:
+            return None
+        return trace_id, span_id, bool(int(flags, 16) & 1)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Span:
+    """
+    Timed operation of a trace. Spans of traces that are not sampled are not exported, they only carry the
+    trace context, so the events they emit are not sampled either.
+    """
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'sampled', 'args', 'timestamp', 'start',
+                 'token')
+
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, args):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.args = args
+        self.timestamp = None
+        self.start = None
+        self.token = None
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-{}'.format(self.trace_id, self.span_id, '01' if self.sampled else '00')
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        if self.sampled:
+            self.timestamp = time.time()
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        _current_span.reset(self.token)
+        if self.sampled:
+            if exc_type is not None:
+                self.args['error'] = exc_type.__name__
+            self.tracer.export(self, time.perf_counter() - self.start)
+
+
+class Tracer:
+    """
+    Traces events from the event source that receives them to the conditions and actions they activate.
+    The trace context travels between processes in the `traceparent` CloudEvent extension attribute
+    (W3C Trace Context), and is passed to invoked functions so their termination events continue the
+    trace of the action that invoked them.
+
+    A trace is sampled with probability `sample_rate` when its first event is received; spans of traces
+    that are not sampled only cost a couple of random numbers.
+    """
+
+    def __init__(self, exporter, sample_rate: float = 0.01, category: str = 'triggerflow'):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.category = category
+
+    def span(self, name: str, parent=None, **args) -> Span:
+        """
+        Returns a span to be used as a context manager. `parent` is a `Span`, a `traceparent` value or
+        None, in which case the span continues the current span, or starts a new trace.
+        """
+        if parent is None:
+            parent = _current_span.get()
+        elif isinstance(parent, str):
+            parent = parse_traceparent(parent)
+
+        if isinstance(parent, Span):
+            return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, args)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            return Span(self, name, trace_id, parent_id, sampled, args)
+        return Span(self, name, '%032x' % random.getrandbits(128), None, random.random() < self.sample_rate, args)
+
+    def receive(self, event: dict, event_source: str):
+        """
+        Records the reception of an event by an event source and sets its `traceparent`, so the spans of the
+        worker continue its trace
+        """
+        span = self.span('receive', event.get('traceparent'), event_source=event_source,
+                         subject=event.get('subject'), type=event.get('type'))
+        event['traceparent'] = span.traceparent
+        if span.sampled:
+            span.timestamp = time.time()
+            self.export(span, 0.0)
+
+    def export(self, span: Span, duration: float):
+        args = span.args
+        args['trace_id'] = span.trace_id
+        args['span_id'] = span.span_id
+        if span.parent_id is not None:
+            args['parent_id'] = span.parent_id
+        self.exporter.write({'name': span.name, 'cat': self.category,
+                             'ph': 'X' if duration else 'i',
+                             'ts': round(span.timestamp * 1000000),
+                             'dur': round(duration * 1000000),
+                             'pid': os.getpid(), 'tid': get_ident(),
+                             'args': args})
+
+    def close(self):
+        self.exporter.close()
+
+
+class ChromeTraceExporter(Thread):
+    """
+    Writes spans to a file in the Chrome trace event format, which can be opened with chrome://tracing or
+    Perfetto. Spans are written by a background thread. The closing bracket of the JSON array is optional
+    in this format, so the file can be read while it is being written.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(daemon=True)
+        self.path = path
+        self.__buffer = queue.SimpleQueue()
+
+    def write(self, trace_event: dict):
+        self.__buffer.put(trace_event)
+
+    def run(self):
+        with open(self.path, 'w') as trace_file:
+            trace_file.write('[\n')
+            while True:
+                trace_events = [self.__buffer.get()]
+                while True:
+                    try:
+                        trace_events.append(self.__buffer.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = None in trace_events
+                for trace_event in trace_events:
+                    if trace_event is not None:
+                        trace_file.write(json.dumps(trace_event, default=str))
+                        trace_file.write(',\n')
+                trace_file.flush()
+                if stop:
+                    break
+
+    def close(self):
+        self.__buffer.put(None)
+        self.join(timeout=10)
+
+
+class TracedEventQueue:
+    """
+    Wraps the event queue used by actions to emit events, so emitted events continue the trace of the
+    action that emitted them
+    """
+
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
+
+    def put(self, event):
+        traceparent = current_traceparent()
+        if traceparent is not None and 'traceparent' not in event:
+            event = dict(event, traceparent=traceparent)
+        self.event_queue.put(event)
+
+    def __getattr__(self, name):
+        return getattr(self.event_queue, name)
+
+
+def new_tracer(config: dict, workspace: str):
+    """
+    Instantiates the tracer configured in the `worker.tracing` section of the config map. Returns None
+    if tracing is not enabled.
+    """
+    tracing_config = (config.get('worker') or {}).get('tracing') or {}
+    sample_rate = float(tracing_config.get('sample_rate', 0))
+    if sample_rate <= 0:
+        return None
+
+    directory = tracing_config.get('directory', '/tmp/triggerflow-traces')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}.json'.format(workspace, os.getpid()))
+    logging.info('[{}] Tracing {:.2%} of the events to {}'.format(workspace, sample_rate, path))
+
+    exporter = ChromeTraceExporter(path)
+    exporter.start()
+    return Tracer(exporter, sample_rate=sample_rate)
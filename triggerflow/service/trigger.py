@@ -1,8 +1,12 @@
+import pickle
+from base64 import b64decode
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Set
 from multiprocessing import Queue
 from datetime import datetime
 
+from .index import TriggerIndex
+from .pending import PendingEvents
 from ..functions import python_object
 
 
@@ -11,21 +15,40 @@ class Context(dict):
     global_context: dict
     workspace: str
     local_event_queue: Queue
-    events: Dict[str, List[dict]]
-    trigger_mapping: Dict[str, Dict[str, str]]
+    events: PendingEvents
+    trigger_mapping: TriggerIndex
     triggers: Dict[str, object]
     trigger_id: str
     activation_events: List[dict]
     condition: callable
     action: callable
     modified: bool = False
+    dirty_triggers: Set[str] = None
 
     _python_objects = []
 
     def __setitem__(self, key, value):
-        self.modified = True
+        self.set_modified()
         super().__setitem__(key, value)
 
+    def update(self, *args, **kwargs):
+        self.set_modified()
+        super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.set_modified()
+        return super().setdefault(key, default)
+
+    def set_modified(self):
+        """
+        Queues the trigger for the next checkpoint. Must be called explicitly after in-place updates
+        of nested values, which `__setitem__` does not see
+        """
+        self.modified = True
+        if self.dirty_triggers is not None:
+            self.dirty_triggers.add(self.trigger_id)
+
     def to_dict(self):
         json = self.copy()
         for key in self._python_objects:
@@ -60,3 +83,38 @@ class Trigger:
             'workspace': self.workspace,
             'timestamp': datetime.utcnow().isoformat()
         }
+
+
+def load_trigger(trigger_id: str, trigger_json: dict, condition: callable, action: callable, **context_args) -> Trigger:
+    """
+    Materializes a trigger from its JSON representation in the trigger storage. `context_args` are
+    the worker structures shared by all trigger contexts (global context, event queue, trigger index...)
+    """
+    context = Context(trigger_id=trigger_id,
+                      activation_events=trigger_json['activation_events'],
+                      condition=condition,
+                      action=action,
+                      **context_args)
+
+    # Restoring the stored context does not make the trigger dirty
+    for key, value in trigger_json['context'].items():
+        if isinstance(value, dict) and '__object__' in value:
+            obj = value['__object__']
+            decoded_obj = b64decode(obj.encode('utf-8'))
+            python_obj = pickle.loads(decoded_obj)
+            dict.__setitem__(context, key, python_obj)
+            context._python_objects.append(key)
+        else:
+            dict.__setitem__(context, key, value)
+
+    return Trigger(condition=condition,
+                   action=action,
+                   context=context,
+                   trigger_id=trigger_id,
+                   condition_meta=trigger_json['condition'],
+                   action_meta=trigger_json['action'],
+                   activation_events=trigger_json['activation_events'],
+                   transient=trigger_json['transient'],
+                   uuid=trigger_json['uuid'],
+                   workspace=trigger_json['workspace'],
+                   timestamp=trigger_json['timestamp'])
@@ -1,19 +1,44 @@
+import copy
+import time
+import queue
 import logging
-import pickle
 import traceback
-from base64 import b64decode
 from uuid import uuid4
 from enum import Enum
 from datetime import datetime
 from multiprocessing import Process, Queue
-from threading import Thread
-from collections import defaultdict
+from threading import Thread, Lock
+from functools import partial
+from contextlib import nullcontext
+from collections import Counter, deque
+from dataclasses import dataclass, field
 
 from . import storage
+from . import callables
 from . import eventsources
 from . import conditions as default_conditions
 from . import actions as default_actions
-from .trigger import Trigger, Context
+from .trigger import load_trigger
+from .index import TriggerIndex
+from .queues import new_event_queue, SharedMemoryEventQueue
+from .sync import TriggerSync
+from .deadletters import DeadLetterQueue, ReplayListener
+from .executor import ActionExecutor, context_keys, action_keys
+from .pending import PendingEvents, commit_events
+from .metrics import MetricsRegistry, MetricsReporter, SIZE_BUCKETS
+from .tracing import new_tracer, current_span, TracedEventQueue
+from .eventlog import new_event_logger
+from .snapshot import new_snapshot, restore_trigger
+from .dedup import new_deduplicator
+from .timers import TimerService, TIMERS_EVENT_SOURCE
+from .flowcontrol import new_flow_control
+from .lanes import new_event_lanes
+
+
+SHARD_TRIGGERS_EVENT_TYPE = 'event.triggerflow.shard.triggers'
+NO_SPAN = nullcontext()
+# How long the main loop waits for an event while actions are running, before handling the finished ones
+ACTIONS_POLL_INTERVAL = 0.01
 
 
 class AuthHandlerException(Exception):
@@ -21,33 +46,112 @@ class AuthHandlerException(Exception):
         self.response = response
 
 
+@dataclass
+class Shard:
+    """
+    Links a worker running as one of the shards of a `ShardedWorker` with its router process
+    """
+    index: int
+    router_queue: Queue
+    commit_queue: Queue
+
+
+@dataclass
+class Hosted:
+    """
+    Links a worker running as a thread of a `WorkerHost` with the resources it shares with the workers
+    of other workspaces. The event queue belongs to the host, so it outlives the worker when evicted.
+    """
+    trigger_storage: object
+    event_queue: queue.Queue
+    event_source_pool: object
+
+
+@dataclass
+class Checkpoint:
+    """
+    State handed by the main loop to the committer thread: the events to commit, and the contexts of the
+    triggers modified since the last checkpoint and the deduplication state, captured at the same moment
+    """
+    events: list
+    triggers: dict = field(default_factory=dict)
+    dedup_state: dict = None
+
+
 class Worker(Process):
     class State(Enum):
         INITIALIZED = 'Initialized'
         RUNNING = 'Running'
         FINISHED = 'Finished'
 
-    def __init__(self, workspace, config):
+    def __init__(self, workspace, config, shard: Shard = None, metrics_queue: Queue = None, hosted: Hosted = None):
         super().__init__()
         self.workspace = workspace
         self.worker_id = str(uuid4())[:6]
         self.__config = config
+        self.shard = shard
+        self.hosted = hosted
+
+        worker_config = config.get('worker') or {}
+        self.batch_size = max(1, int(worker_config.get('batch_size', 1)))
+        self.batch_linger = float(worker_config.get('batch_linger_ms', 0)) / 1000
+        self.trigger_sync_interval = float(worker_config.get('trigger_sync_interval', 5))
+        self.negative_cache_size = int(worker_config.get('negative_cache_size', 10000))
+        self.dead_letters_max_length = int(worker_config.get('dead_letters_max_length', 10000))
+        self.dead_letters_max_age = float(worker_config.get('dead_letters_max_age', 604800))
+        self.action_threads = int(worker_config.get('action_threads', 0))
+        self.process_pool_size = worker_config.get('process_pool_size')
+        self.callables_cache_size = int(worker_config.get('callables_cache_size', 1024))
+        self.callables_cache_dir = worker_config.get('callables_cache_dir')
+        self.metrics_interval = float(worker_config.get('metrics_interval', 10))
+        self.snapshot_interval = float(worker_config.get('snapshot_interval', 60))
+        self.timer_tick = float(worker_config.get('timer_tick_ms', 100)) / 1000
+        pending_events_memory = int(worker_config.get('pending_events_memory_mb', 64)) * 1024 * 1024
 
         self.start_time = 0
         self.trigger_storage = None
+        self.trigger_sync = None
+        self.timers = None
         self.triggers = {}
-        self.trigger_mapping = {}
-        self.events = defaultdict(list)
+        self.trigger_mapping = TriggerIndex()
+        self.events = PendingEvents(memory_budget=pending_events_memory,
+                                    spill_directory=worker_config.get('pending_events_spill_dir'))
         self.global_context = {}
         self.event_sources = {}
-        self.event_queue = Queue()
-        self.checkpoint_queue = Queue()
-        self.dead_letter_queue = Queue()
+        self.event_queue = hosted.event_queue if hosted else new_event_queue(config)
+        # Events emitted by actions go back to the router when running as a shard, as their subject
+        # may be owned by another shard
+        self.local_event_queue = shard.router_queue if shard else self.event_queue
+        self.checkpoint_queue = queue.Queue() if hosted else Queue()
+        self.lanes = new_event_lanes(config)
+        # Event sources of hosted workers are flow controlled by the host
+        self.flow_control = None if hosted else new_flow_control(config, self.__queue_depth, workspace)
+        self.dead_letter_queue = None
+        self.replay_listener = None
+        self.action_executor = None
+        self.metrics = MetricsRegistry()
+        self.metrics_queue = metrics_queue
+        self.metrics_reporter = None
+        self.tracer = None
+        self.event_log = new_event_logger(config, 'worker', workspace)
+        self.snapshot = None
+        self.dedup = new_deduplicator(config)
+        # Key of the checkpointed deduplication state in the `dedup` document
+        self.__dedup_key = 'shard-{}'.format(shard.index) if shard else 'worker'
+        self.__snapshot_time = 0
+        self.__pending_snapshot = None
+        self.__workspace_created = None
+        self.__finished_actions = deque()
+        self.__synced_version = 0
         self.deleted_triggers = {}
+        self.dirty_triggers = set()
 
         self.state = Worker.State.INITIALIZED
 
     def __start_db(self):
+        if self.hosted is not None:
+            self.trigger_storage = self.hosted.trigger_storage
+            return
         logging.info('[{}] Creating database connection'.format(self.workspace))
         # Instantiate DB client
         backend = self.__config['trigger_storage']['backend']
@@ -57,6 +161,11 @@ class Worker(Process):
     def __start_event_sources(self):
         logging.info("[{}] Starting event sources ".format(self.workspace))
         event_sources = self.trigger_storage.get(workspace=self.workspace, document_id='event_sources')
+        if self.hosted is not None:
+            # Consumers are shared with the workspaces that define the same event sources
+            self.event_sources = self.hosted.event_source_pool.attach(self.workspace, event_sources.values(),
+                                                                      self.event_queue, tracer=self.tracer)
+            return
         for evt_src in event_sources.values():
             if evt_src['name'] in self.event_sources:
                 continue
@@ -65,6 +174,9 @@ class Worker(Process):
             event_source = event_source_class(event_queue=self.event_queue,
                                               name=evt_src['name'],
                                               **evt_src['parameters'])
+            event_source.tracer = self.tracer
+            event_source.flow_control = self.flow_control
+            event_source.event_log = new_event_logger(self.__config, 'event_sources', evt_src['name'])
             event_source.start()
             self.event_sources[evt_src['name']] = event_source
 
@@ -74,102 +186,623 @@ class Worker(Process):
             self.event_sources[evt_src].stop()
             del self.event_sources[evt_src]
 
+    def __start_dead_letters(self):
+        self.dead_letter_queue = DeadLetterQueue(self.trigger_storage, self.workspace,
+                                                 max_length=self.dead_letters_max_length,
+                                                 max_age=self.dead_letters_max_age)
+        self.dead_letter_queue.start()
+        if self.shard is not None:
+            # Replayed events go to the router
+            return
+        self.replay_listener = ReplayListener(self.trigger_storage, self.workspace, self.event_queue,
+                                              interval=self.trigger_sync_interval)
+        self.replay_listener.start()
+
+    def __stop_dead_letters(self):
+        if self.replay_listener is not None:
+            self.replay_listener.stop()
+        self.dead_letter_queue.stop()
+
+    def __start_metrics(self):
+        if self.metrics_queue is None:
+            return
+        self.metrics_reporter = MetricsReporter(self.metrics, self.metrics_queue, self.workspace, self.worker_id,
+                                                interval=self.metrics_interval, collect=self.__collect_metrics)
+        self.metrics_reporter.start()
+
+    def __stop_metrics(self):
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop()
+
+    def __collect_metrics(self):
+        try:
+            self.metrics.set('triggerflow_event_queue_depth', self.event_queue.qsize())
+        except NotImplementedError:
+            # Queue.qsize is not available on macOS
+            pass
+        self.metrics.set('triggerflow_pending_events_bytes', self.events.memory)
+        self.metrics.set('triggerflow_triggers_loaded', len(self.triggers))
+        self.metrics.set('triggerflow_dead_letters_buffered', self.dead_letter_queue.qsize())
+        if self.action_executor is not None:
+            stats = self.action_executor.stats()
+            self.metrics.set('triggerflow_actions_queued', stats['queued'])
+            self.metrics.set('triggerflow_actions_running', stats['running'])
+        if self.timers is not None:
+            self.metrics.set('triggerflow_timers_scheduled', len(self.timers.wheel))
+        self.metrics.set('triggerflow_callables_cached', len(callables.cache))
+        self.metrics.set('triggerflow_callables_loaded', callables.cache.loads)
+        if self.flow_control is not None and self.event_sources:
+            self.metrics.set('triggerflow_event_sources_paused', int(self.flow_control.paused))
+            self.metrics.set('triggerflow_event_sources_pauses', self.flow_control.pauses)
+        if self.lanes is not None:
+            for lane, depth in self.lanes.depths().items():
+                self.metrics.set('triggerflow_lane_depth', depth, lane=lane)
+            for lane, dequeued in zip(self.lanes.names, self.lanes.dequeued):
+                self.metrics.set('triggerflow_lane_events', dequeued, lane=lane)
+        if self.dedup is not None:
+            self.metrics.set('triggerflow_dedup_unconfirmed_duplicates', self.dedup.unconfirmed)
+            self.metrics.set('triggerflow_dedup_bloom_bytes', self.dedup.bloom.memory)
+
+    def __queue_depth(self):
+        # Events taken from the event queue wait in the lanes
+        return self.event_queue.qsize() + (len(self.lanes) if self.lanes is not None else 0)
+
     def __get_global_context(self):
         logging.info('[{}] Getting workspace global context'.format(self.workspace))
         self.global_context = self.trigger_storage.get(workspace=self.workspace, document_id='global_context')
 
+    def __restore_dedup(self):
+        if self.dedup is None:
+            return
+        try:
+            state = self.trigger_storage.get_key(workspace=self.workspace, document_id='dedup', key=self.__dedup_key)
+            if state is None:
+                return
+            self.dedup.restore(state)
+        except Exception:
+            # Replayed events are then processed again, as without deduplication
+            logging.error('[{}] Could not restore the deduplication state'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+        logging.info('[{}] Restored deduplication state of {} uncommitted events'.format(
+            self.workspace, len(state.get('uncommitted', []))))
+
     def __get_triggers(self):
         logging.info("[{}] Updating triggers cache".format(self.workspace))
+        if self.snapshot is not None and self.__restore_snapshot():
+            return
         try:
-            all_triggers = self.trigger_storage.get(workspace=self.workspace, document_id='triggers')
+            all_triggers = self.trigger_sync.load()
             new_triggers = {key: all_triggers[key] for key in all_triggers.keys() if key not in self.triggers}
 
             for new_trigger_id, new_trigger_json in new_triggers.items():
                 if new_trigger_id == "0":
                     continue
-                for event in new_trigger_json['activation_events']:
-                    if event['subject'] not in self.trigger_mapping:
-                        self.trigger_mapping[event['subject']] = {}
-                    if event['type'] not in self.trigger_mapping[event['subject']]:
-                        self.trigger_mapping[event['subject']][event['type']] = []
-
-                    condition_callable_name = '_'.join(['condition', new_trigger_json['condition']['name'].lower()])
-                    action_callable_name = '_'.join(['action', new_trigger_json['action']['name'].lower()])
-                    condition_callable = getattr(default_conditions, condition_callable_name)
-                    action_callable = getattr(default_actions, action_callable_name)
-
-                    new_trigger_context = Context(global_context=self.global_context,
-                                                  workspace=self.workspace,
-                                                  local_event_queue=self.event_queue,
-                                                  events=self.events,
-                                                  trigger_mapping=self.trigger_mapping,
-                                                  triggers=self.triggers,
-                                                  trigger_id=new_trigger_id,
-                                                  activation_events=new_trigger_json['activation_events'],
-                                                  condition=condition_callable,
-                                                  action=action_callable)
-
-                    for key, value in new_trigger_json['context'].items():
-                        if isinstance(value, dict) and '__object__' in value:
-                            obj = value['__object__']
-                            decoded_obj = b64decode(obj.encode('utf-8'))
-                            python_obj = pickle.loads(decoded_obj)
-                            new_trigger_context[key] = python_obj
-                            new_trigger_context._python_objects.append(key)
-                        else:
-                            new_trigger_context[key] = value
-
-                    new_trigger = Trigger(condition=condition_callable,
-                                          action=action_callable,
-                                          context=new_trigger_context,
-                                          trigger_id=new_trigger_id,
-                                          condition_meta=new_trigger_json['condition'],
-                                          action_meta=new_trigger_json['action'],
-                                          activation_events=new_trigger_json['activation_events'],
-                                          transient=new_trigger_json['transient'],
-                                          uuid=new_trigger_json['uuid'],
-                                          workspace=new_trigger_json['workspace'],
-                                          timestamp=new_trigger_json['timestamp'])
-                    self.triggers[new_trigger_id] = new_trigger
-                    self.trigger_mapping[event['subject']][event['type']].append(new_trigger_id)
+                self.__load_trigger(new_trigger_id, new_trigger_json)
+            self.__synced_version = self.trigger_sync.version
 
         except KeyError:
             logging.error('Could not retrieve triggers and/or source events for {}'.format(self.workspace))
             logging.error(traceback.format_exc())
         logging.info("[{}] Triggers updated".format(self.workspace))
 
+    def __sync_triggers(self):
+        """
+        Apply the triggers added to and deleted from the trigger storage since the last sync
+        """
+        try:
+            added, deleted = self.trigger_sync.changes(self.triggers)
+        except Exception:
+            logging.error('[{}] Could not retrieve trigger changes'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+
+        for trigger_id, trigger_json in added.items():
+            if trigger_id != "0" and trigger_id not in self.triggers:
+                self.__load_trigger(trigger_id, trigger_json)
+        for trigger_id in deleted:
+            self.__unload_trigger(trigger_id)
+        self.__synced_version = self.trigger_sync.version
+
+        if added or deleted:
+            logging.info("[{}] Triggers synced: {} added, {} deleted".format(self.workspace, len(added),
+                                                                             len(deleted)))
+
+    def __restore_snapshot(self):
+        """
+        Load the triggers from the local snapshot, then read again from the trigger storage the triggers
+        changed since its version and those checkpointed since it was taken. Returns False if there is no
+        usable snapshot.
+        """
+        start = time.time()
+        self.__workspace_created = self.trigger_storage.get_workspace_creation_time(self.workspace)
+        snapshot = self.snapshot.read()
+        if snapshot is None:
+            return False
+        version, timestamp, records, trigger_mapping, stale, workspace_created = snapshot
+        if workspace_created != self.__workspace_created or \
+                version > self.trigger_storage.get_version(workspace=self.workspace, document_id='triggers'):
+            # The workspace was created again after the snapshot was taken
+            logging.warning('[{}] Discarding trigger snapshot of a previous workspace'.format(self.workspace))
+            self.snapshot.delete()
+            return False
+
+        self.trigger_mapping = trigger_mapping
+        for record in records:
+            condition_callable, action_callable = self.__get_callables(record[1]['name'], record[2]['name'])
+            self.triggers[record[0]] = restore_trigger(record, condition_callable, action_callable,
+                                                       **self.__context_args())
+
+        try:
+            self.trigger_sync.resume(version)
+            added, deleted = self.trigger_sync.changes(self.triggers)
+            updated = set(self.trigger_storage.get_updated_keys(workspace=self.workspace, document_id='triggers',
+                                                                since=timestamp))
+            updated = updated.union(stale).difference(added)
+            triggers = self.trigger_storage.get_keys(workspace=self.workspace, document_id='triggers',
+                                                     keys=list(updated))
+        except Exception:
+            logging.error('[{}] Could not retrieve the triggers changed since the snapshot'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            self.triggers.clear()
+            self.trigger_mapping = TriggerIndex()
+            return False
+        triggers.update(added)
+        triggers.update((trigger_id, None) for trigger_id in deleted)
+
+        for trigger_id, trigger_json in triggers.items():
+            self.__unload_trigger(trigger_id)
+            if trigger_id != "0" and trigger_json is not None:
+                self.__load_trigger(trigger_id, trigger_json)
+        self.__synced_version = self.trigger_sync.version
+
+        logging.info('[{}] Restored {} triggers from snapshot in {:.2f}s ({} read from storage)'.format(
+            self.workspace, len(records), time.time() - start, len(triggers)))
+        return True
+
+    def __take_snapshot(self):
+        """
+        Copy the triggers for the local snapshot. It runs in the main loop between batches, so the triggers,
+        the index and the contexts do not change meanwhile, except the contexts that actions in flight may
+        modify, which are left out and stored as stale. The committer thread serializes and writes it.
+        """
+        self.__snapshot_time = time.time()
+        busy = set()
+        if self.action_executor is not None and not self.action_executor.idle():
+            busy = {trigger_id for trigger_id, trigger in self.triggers.items() if self.__busy(trigger)}
+        try:
+            state = self.snapshot.capture(self.triggers, self.trigger_mapping, skip=busy)
+        except Exception:
+            logging.error('[{}] Could not take trigger snapshot'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+        self.__pending_snapshot = (self.__synced_version, self.__snapshot_time, state,
+                                   busy.union(self.dirty_triggers))
+        # Wake up the committer
+        self.checkpoint_queue.put(Checkpoint([]))
+
+    def __write_snapshot(self, version, timestamp, state, stale):
+        """
+        Serialize and write the local snapshot of the triggers. It runs in the committer thread, so no checkpoint
+        is written meanwhile: triggers modified before the snapshot was taken or not checkpointed since stay
+        dirty, and are stored as stale.
+        """
+        start = time.time()
+        try:
+            data = self.snapshot.dump(state)
+            self.snapshot.write(version, timestamp, data, stale.union(self.dirty_triggers),
+                                workspace_created=self.__workspace_created or 0.0)
+        except Exception:
+            logging.error('[{}] Could not write trigger snapshot'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return
+        logging.info('[{}] Trigger snapshot written in {:.2f}s ({} bytes)'.format(
+            self.workspace, time.time() - start, len(data)))
+
+    def __get_callables(self, condition_name, action_name):
+        condition_callable_name = '_'.join(['condition', condition_name.lower()])
+        action_callable_name = '_'.join(['action', action_name.lower()])
+        return getattr(default_conditions, condition_callable_name), getattr(default_actions, action_callable_name)
+
+    def __context_args(self):
+        return dict(global_context=self.global_context,
+                    workspace=self.workspace,
+                    local_event_queue=self.local_event_queue,
+                    events=self.events,
+                    trigger_mapping=self.trigger_mapping,
+                    triggers=self.triggers,
+                    dirty_triggers=self.dirty_triggers)
+
+    def __load_trigger(self, trigger_id, trigger_json):
+        condition_callable, action_callable = self.__get_callables(trigger_json['condition']['name'],
+                                                                   trigger_json['action']['name'])
+        trigger = load_trigger(trigger_id, trigger_json, condition_callable, action_callable,
+                               **self.__context_args())
+        self.triggers[trigger_id] = trigger
+
+        for event in trigger_json['activation_events']:
+            self.trigger_mapping.add(event['subject'], event['type'], trigger_id)
+
+        return trigger
+
+    def __unload_trigger(self, trigger_id):
+        trigger = self.triggers.pop(trigger_id, None)
+        if trigger is None:
+            return
+        for event in trigger.activation_events:
+            self.trigger_mapping.remove(event['subject'], event['type'], trigger_id)
+        self.dirty_triggers.discard(trigger_id)
+
     def __start_commiter(self):
 
         def commiter(commit_queue):
             """
-            Commit events and delete transient triggers
+            Write the checkpoints taken by the main loop, then commit their events in the event sources
             """
             logging.info('[{}] Starting committer thread'.format(self.workspace))
+            # Events of the checkpoints that could not be written, they are committed with the next one
+            uncommitted = []
 
-            while self.__should_run():
-                events_subject = commit_queue.get()
+            while True:
+                checkpoint = commit_queue.get()
 
-                if events_subject is None:
+                if checkpoint is None:
                     break
 
-                events_to_commit = self.events[events_subject]
+                events = uncommitted + checkpoint.events
+                with self.__span('checkpoint', events=len(events)):
+                    if not self.__write_checkpoint(checkpoint):
+                        uncommitted = events
+                    elif events:
+                        uncommitted = []
+                        self.event_log.log('Committing %d events', len(events), level=logging.INFO)
+                        self.metrics.inc('triggerflow_events_committed_total', len(events))
+
+                        if self.shard:
+                            self.shard.commit_queue.put(events)
+                        commit_events(self.event_sources, events)
+                        if self.timers is not None:
+                            self.timers.commit(events)
+                        if self.dedup is not None:
+                            self.dedup.commit(events)
+
+                if self.__pending_snapshot is not None:
+                    snapshot, self.__pending_snapshot = self.__pending_snapshot, None
+                    self.__write_snapshot(*snapshot)
 
-                if events_to_commit:
-                    logging.info('[{}] Committing {} events'.format(self.workspace, len(events_to_commit)))
+        self.__commiter = Thread(target=commiter, args=(self.checkpoint_queue,))
+        self.__commiter.start()
 
-                    for event_source in self.event_sources.values():
-                        event_source.commit([event['id'] for event in events_to_commit])
+    def __take_checkpoint(self, events: list) -> Checkpoint:
+        """
+        Capture the contexts of the triggers modified since the last checkpoint along with the deduplication
+        state, in the main loop, so the committer persists both as of the same moment. The events to commit
+        are still uncommitted in that deduplication state: if they are replayed after a restart, they are
+        pending again instead of being evaluated twice. Triggers whose context may be modified by an action
+        in flight stay dirty until the next checkpoint.
+        """
+        trigger_ids = {trigger_id for trigger_id in self.dirty_triggers.copy()
+                       if trigger_id not in self.triggers or not self.__busy(self.triggers[trigger_id])}
+        self.dirty_triggers.difference_update(trigger_ids)
+        triggers = {trigger_id: copy.deepcopy(self.triggers[trigger_id].to_dict())
+                    for trigger_id in trigger_ids if trigger_id in self.triggers}
+        dedup_state = self.dedup.state() if self.dedup is not None else None
+        return Checkpoint(events, triggers, dedup_state)
+
+    def __busy(self, trigger):
+        return self.action_executor is not None and self.action_executor.busy(context_keys(trigger))
+
+    def __write_checkpoint(self, checkpoint: Checkpoint) -> bool:
+        """
+        Write the contexts and the deduplication state of a checkpoint in a single storage round trip.
+        Triggers are dirty again if the write fails, so they are retried on the next checkpoint.
+        Returns False if the write failed.
+        """
+        if not checkpoint.triggers:
+            return True
+
+        start = time.perf_counter()
+        try:
+            self.event_log.log('Checkpoint of %d triggers', len(checkpoint.triggers), level=logging.INFO)
+            if checkpoint.dedup_state is None:
+                self.trigger_storage.set_keys(workspace=self.workspace, document_id='triggers',
+                                              data=checkpoint.triggers)
+            else:
+                self.trigger_storage.set_documents_keys(workspace=self.workspace,
+                                                        documents={'triggers': checkpoint.triggers,
+                                                                   'dedup': {self.__dedup_key: checkpoint.dedup_state}})
+            self.metrics.observe('triggerflow_checkpoint_seconds', time.perf_counter() - start)
+            self.metrics.observe('triggerflow_checkpoint_triggers', len(checkpoint.triggers), buckets=SIZE_BUCKETS)
+        except Exception:
+            self.dirty_triggers.update(checkpoint.triggers)
+            logging.error('[{}] Checkpoint failed'.format(self.workspace))
+            logging.error(traceback.format_exc())
+            return False
+
+        for trigger_id in checkpoint.triggers:
+            # Changes made after the checkpoint was taken keep the trigger dirty
+            if trigger_id in self.triggers and trigger_id not in self.dirty_triggers:
+                self.triggers[trigger_id].context.modified = False
+        return True
+
+    def __wait_event(self):
+        """
+        Block until an event is available. While actions are running, or finished ones were not handled yet,
+        only wait `ACTIONS_POLL_INTERVAL` and raise `queue.Empty`, so finished actions do not wait for the
+        next event.
+        """
+        # Idle is checked first: actions add themselves to the finished ones before they are done
+        if self.action_executor is None or (self.action_executor.idle() and not self.__finished_actions):
+            return self.event_queue.get()
+        return self.event_queue.get(timeout=ACTIONS_POLL_INTERVAL)
+
+    def __get_event_batch(self):
+        """
+        Block until an event is available, then keep draining the event queue until
+        `batch_size` events are collected or `batch_linger_ms` have elapsed
+        """
+        if self.lanes is not None:
+            return self.__get_lanes_batch()
 
-                for trigger in self.triggers.values():
-                    if trigger.context.modified:
-                        logging.info('[{}] Checkpoint of trigger {}'.format(self.workspace, trigger.trigger_id))
-                        self.trigger_storage.set_key(workspace=self.workspace,
-                                                     document_id='triggers',
-                                                     key=trigger.trigger_id,
-                                                     value=self.triggers[trigger.trigger_id].to_dict())
+        try:
+            batch = [self.__wait_event()]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.batch_linger
+
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.event_queue.get(timeout=timeout))
+                else:
+                    batch.append(self.event_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if batch[-1] is None:
+            # Put by `stop`
+            batch.pop()
+            self.state = Worker.State.FINISHED
+        return batch
+
+    def __get_lanes_batch(self):
+        """
+        Same as `__get_event_batch`, but the events available in the event queue are first moved to the
+        lanes (up to `lanes_max_buffered`), and the batch is taken from them by weight, so a control event
+        does not wait for the data events that arrived before it
+        """
+        stop = False
+        if not len(self.lanes):
+            try:
+                event = self.__wait_event()
+            except queue.Empty:
+                return []
+            if event is None:
+                stop = True
+            else:
+                self.lanes.put(event)
+        deadline = time.time() + self.batch_linger
+
+        while not stop and not self.lanes.full():
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0 and len(self.lanes) < self.batch_size:
+                    event = self.event_queue.get(timeout=timeout)
+                else:
+                    event = self.event_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is None:
+                stop = True
+            else:
+                self.lanes.put(event)
+
+        if stop:
+            # Put by `stop`, the events already taken from the event queue are not left behind
+            self.state = Worker.State.FINISHED
+            return self.lanes.take(len(self.lanes))
+        return self.lanes.take(self.batch_size)
+
+    def __dispatch_batch(self, batch):
+        """
+        Processes a batch of events in arrival order. Events of a subject not in the trigger cache cause
+        a single trigger sync per batch, events that still activate no trigger are dead-lettered.
+        Returns whether a checkpoint is needed and the (event source, id) pairs of the events to commit.
+        """
+        # Triggers are matched once per subject and type of the batch
+        matches = {}
+        synced = False
+        checkpoint = False
+        events_to_commit = []
+        dead_lettered = 0
+        for event in batch:
+            subject, event_type = key = event['subject'], event['type']
+            if event_type == SHARD_TRIGGERS_EVENT_TYPE:
+                # Triggers assigned to this shard by the router
+                for trigger_id, trigger_json in event['data'].items():
+                    self.__load_trigger(trigger_id, trigger_json)
+                matches.clear()
+                continue
 
-        self.__commiter = Thread(target=commiter, args=(self.checkpoint_queue,))
-        self.__commiter.start()
+            if key not in matches:
+                matches[key] = bool(self.trigger_mapping.match(subject, event_type))
+                # Changes may not have been notified yet, unless the subjects are known to have no trigger
+                if not matches[key] and not synced and self.trigger_sync is not None \
+                        and key not in self.trigger_sync.missing:
+                    logging.warning('[{}] Subject {} not in cache'.format(self.workspace, subject))
+                    self.__sync_triggers()
+                    synced = True
+                    matches.clear()
+                    matches[key] = bool(self.trigger_mapping.match(subject, event_type))
+
+            if matches[key]:
+                checkpoint |= self.__process_event(event, events_to_commit)
+            else:
+                if self.trigger_sync is not None:
+                    self.trigger_sync.missing.add(subject, event_type)
+                if self.timers is not None:
+                    # The events that guard a timer do not need a trigger
+                    self.timers.on_event(event)
+                if event.get('event_source') == TIMERS_EVENT_SOURCE:
+                    # No trigger will commit it, its timer would fire again on every restart
+                    events_to_commit.append((TIMERS_EVENT_SOURCE, event['id']))
+                    checkpoint = True
+                self.dead_letter_queue.put(event)
+                dead_lettered += 1
+
+        if dead_lettered:
+            self.metrics.inc('triggerflow_events_dead_lettered_total', dead_lettered)
+
+        return checkpoint, events_to_commit
+
+    def __process_event(self, event, events_to_commit):
+        """
+        Evaluate the triggers activated by an event. Events are kept until a trigger they activate fires,
+        then the (event source, id) pairs of the events of all its activation subjects are moved to
+        `events_to_commit`.
+        Returns True if a checkpoint is needed.
+        """
+        subject = event['subject']
+        event_type = event['type']
+        self.event_log.event(event)
+
+        if self.dedup is not None and self.dedup.is_duplicate(event):
+            if self.dedup.is_replayed(event):
+                # Replay of an event that was pending before the restart: it is pending again, so it is
+                # committed once a trigger of its subject fires, but it is not evaluated again
+                self.events.append(subject, event)
+            self.event_log.log('Dropped duplicate event %s from %s', event.get('id'), event.get('source'))
+            self.metrics.inc('triggerflow_events_duplicated_total')
+            return False
+        if self.timers is not None:
+            self.timers.on_event(event)
+
+        sequence = self.events.append(subject, event)
+        self.metrics.inc('triggerflow_events_matched_total')
+
+        with self.__span('match', event=event, subject=subject, type=event_type):
+            fired = []
+            checkpoint = False
+            deferred = []
+            for trigger_id in self.trigger_mapping.match(subject, event_type):
+                trigger = self.triggers[trigger_id]
+
+                if self.action_executor is not None:
+                    # The condition needs the context, wait for the actions that may be modifying it
+                    self.action_executor.wait(context_keys(trigger))
+
+                try:
+                    start = time.perf_counter()
+                    with self.__span('condition', trigger_id=trigger_id, condition=trigger.condition_meta['name']):
+                        condition = trigger.condition(trigger.context, event)
+                    self.metrics.observe('triggerflow_condition_seconds', time.perf_counter() - start,
+                                         condition=trigger.condition_meta['name'])
+                    if condition:
+                        self.metrics.inc('triggerflow_triggers_fired_total', action=trigger.action_meta['name'])
+                        self.event_log.fired()
+                        if self.action_executor is not None:
+                            deferred.append(trigger)
+                        else:
+                            self.__run_action(trigger, event)
+
+                        # Delete transient fired trigger
+                        if trigger.transient:
+                            for activation_event in trigger.activation_events:
+                                self.trigger_mapping.remove(activation_event['subject'], activation_event['type'],
+                                                            trigger_id)
+                        fired.append(trigger)
+                except Exception:
+                    trigger.context['exception'] = traceback.format_exc()
+                    logging.warning(trigger.context['exception'])
+                    self.metrics.inc('triggerflow_trigger_errors_total')
+                    checkpoint = True
+
+            if deferred:
+                self.__submit_actions(deferred, event, subject, sequence)
+            elif fired:
+                events_to_commit.extend(self.__pop_events(fired, subject))
+
+        return bool(fired and not deferred) or checkpoint
+
+    def __pop_events(self, triggers, subject, until=None):
+        """
+        Removes the pending events committed when triggers fire: those of the subject of the event, and
+        those of the other subjects the triggers are activated by (e.g. all the `map_*` subjects of a join).
+        Only the events up to sequence number `until` are removed, if given.
+        """
+        events = self.events.pop(subject, until)
+        for trigger in triggers:
+            for activation_event in trigger.activation_events:
+                if activation_event['subject'] != subject:
+                    events.extend(self.events.pop_matching(activation_event['subject'], until))
+        return events
+
+    def __run_action(self, trigger, event, parent_span=None):
+        start = time.perf_counter()
+        try:
+            with self.__span('action', parent_span, trigger_id=trigger.trigger_id,
+                             action=trigger.action_meta['name']):
+                trigger.action(trigger.context, event)
+        finally:
+            # Actions may update nested context values in place (e.g. invocation state)
+            trigger.context.set_modified()
+            self.metrics.observe('triggerflow_action_seconds', time.perf_counter() - start,
+                                 action=trigger.action_meta['name'])
+
+    def __span(self, name, parent=None, event=None, **args):
+        """
+        Span of the tracer, if tracing is enabled. Spans of an event continue the trace of its `traceparent`.
+        """
+        if self.tracer is None:
+            return NO_SPAN
+        if event is not None:
+            parent = event.get('traceparent')
+        return self.tracer.span(name, parent, **args)
+
+    def __submit_actions(self, triggers, event, subject, sequence):
+        """
+        Run the actions of the triggers fired by an event on the action executor. The events pending when
+        they fired (up to the event, sequence number `sequence`) stay pending until all of them have
+        succeeded, and are then committed by the main loop. If an action fails they stay pending, as when
+        actions run in the main loop.
+        """
+        remaining = [len(triggers)]
+        failed = [False]
+        lock = Lock()
+        # Actions run on other threads, their spans continue the trace of the event explicitly
+        parent_span = current_span()
+
+        def action_done(trigger, error):
+            if error is not None:
+                trigger.context['exception'] = error
+                logging.warning(error)
+                self.metrics.inc('triggerflow_trigger_errors_total')
+            with lock:
+                remaining[0] -= 1
+                failed[0] |= error is not None
+                last = remaining[0] == 0
+            if last:
+                # Handled by the main loop, which owns the pending events and takes the checkpoints
+                self.__finished_actions.append((triggers, subject, sequence, failed[0]))
+
+        for trigger in triggers:
+            self.action_executor.submit(trigger.trigger_id, action_keys(trigger),
+                                        self.__run_action, trigger, event, parent_span,
+                                        callback=partial(action_done, trigger))
+
+    def __finish_actions(self, events_to_commit):
+        """
+        Move the pending events of the fired triggers whose actions have all succeeded to `events_to_commit`.
+        Returns True if a checkpoint is needed.
+        """
+        checkpoint = False
+        while self.__finished_actions:
+            triggers, subject, sequence, failed = self.__finished_actions.popleft()
+            if not failed:
+                events_to_commit.extend(self.__pop_events(triggers, subject, sequence))
+            checkpoint = True
+        return checkpoint
 
     def __should_run(self):
         return self.state == Worker.State.RUNNING
@@ -179,69 +812,102 @@ class Worker(Process):
         self.start_time = datetime.now()
 
         self.__start_db()
-        self.__start_event_sources()
+        self.__start_dead_letters()
+        self.__start_metrics()
+        self.tracer = new_tracer(self.__config, self.workspace)
+        if self.tracer is not None:
+            # Events emitted by actions continue the trace of the action
+            self.local_event_queue = TracedEventQueue(self.local_event_queue)
         self.__get_global_context()
-        self.__get_triggers()
+        self.__restore_dedup()
+        if self.shard is None:
+            self.snapshot = new_snapshot(self.__config, self.workspace)
+            self.__start_event_sources()
+            self.trigger_sync = TriggerSync(self.trigger_storage, self.workspace,
+                                            interval=self.trigger_sync_interval,
+                                            negative_cache_size=self.negative_cache_size)
+            self.__get_triggers()
+            self.trigger_sync.start()
+            # Timeout events are put straight in the event queue
+            self.timers = TimerService(self.trigger_storage, self.workspace, self.event_queue,
+                                       tick=self.timer_tick, interval=self.trigger_sync_interval)
+            self.timers.load()
+            self.timers.start()
+        else:
+            logging.info('[{}] Worker {} running as shard {}'.format(self.workspace, self.worker_id,
+                                                                     self.shard.index))
 
         logging.info('[{}] Worker {} Started'.format(self.workspace, self.worker_id))
         self.state = Worker.State.RUNNING
 
+        if self.action_threads > 0:
+            initializer = None
+            if self.shard is None and isinstance(self.event_queue, SharedMemoryEventQueue):
+                # The main loop waits for the actions, they must not wait for it to free space in its event queue
+                initializer = self.event_queue.add_local_producer
+            self.action_executor = ActionExecutor(self.action_threads, initializer=initializer)
+        callables.configure(self.process_pool_size, self.callables_cache_size, self.callables_cache_dir)
         self.__start_commiter()
 
         while self.__should_run():
-            logging.info('[{}] Waiting for events...'.format(self.workspace))
-            event = self.event_queue.get()
-            logging.info('[{}] New event from {}'.format(self.workspace, event['source']))
-            subject = event['subject']
-            event_type = event['type']
-
-            if subject in self.trigger_mapping and event_type in self.trigger_mapping[subject]:
-                self.events[subject].append(event)
-
-                fired = False
-                for trigger_id in self.trigger_mapping[subject][event_type]:
-                    trigger = self.triggers[trigger_id]
-
-                    try:
-                        if trigger.condition(trigger.context, event):
-                            trigger.action(trigger.context, event)
-
-                            # Delete transient fired trigger
-                            if trigger.transient:
-                                self.trigger_mapping[subject][event_type].remove(trigger_id)
-                            fired = True
-                    except Exception:
-                        trigger.context['exception'] = traceback.format_exc()
-                        logging.warning(trigger.context['exception'])
-                        self.checkpoint_queue.put('')
-
-                if fired:
-                    logging.info('[{}] Performing state checkpoint'.format(self.workspace))
-                    self.checkpoint_queue.put(subject)
-                    del self.events[subject]
-            else:
-                logging.warning('[{}] Event with subject {} not in cache'.format(self.workspace, subject))
-                self.__get_triggers()
-                if subject in self.trigger_mapping:
-                    self.event_queue.put(event)  # Put the event to the queue to process it again
-                else:
-                    self.dead_letter_queue.put(event)
-
+            batch = self.__get_event_batch()
+            self.event_log.log('Processing batch of %d events', len(batch))
+            received = Counter(event.get('event_source') or 'local' for event in batch)
+            for event_source, count in received.items():
+                self.metrics.inc('triggerflow_events_received_total', count, event_source=event_source)
+
+            if self.trigger_sync is not None and self.trigger_sync.pending:
+                self.__sync_triggers()
+
+            checkpoint, events_to_commit = self.__dispatch_batch(batch)
+            checkpoint |= self.__finish_actions(events_to_commit)
+
+            if checkpoint:
+                self.event_log.log('Performing state checkpoint', level=logging.INFO)
+                self.checkpoint_queue.put(self.__take_checkpoint(events_to_commit))
+
+            if self.snapshot is not None and time.time() - self.__snapshot_time >= self.snapshot_interval:
+                self.__take_snapshot()
+
+        if self.action_executor is not None:
+            self.action_executor.shutdown()
+        # Last checkpoint, with the events of the last actions
+        events_to_commit = []
+        self.__finish_actions(events_to_commit)
+        self.checkpoint_queue.put(self.__take_checkpoint(events_to_commit))
+        self.checkpoint_queue.put(None)
+        self.__commiter.join()
+        if self.hosted is None:
+            # The process pool of a hosted worker is shared with the workers of the other workspaces of the host
+            callables.shutdown()
+        if self.trigger_sync is not None:
+            self.trigger_sync.stop()
+        if self.timers is not None:
+            self.timers.stop()
+        self.__stop_dead_letters()
+        self.__stop_metrics()
+        if self.tracer is not None:
+            self.tracer.close()
         logging.info("[{}] Worker {} finished".format(self.workspace, self.worker_id))
 
+    def stop(self):
+        """
+        Stops a worker running as a thread of a `WorkerHost` once it has processed the events already
+        in its event queue
+        """
+        self.event_queue.put(None)
+
     def stop_worker(self):
         logging.info("[{}] Stopping Worker {}".format(self.workspace, self.worker_id))
         self.state = Worker.State.FINISHED
-        self.checkpoint_queue.put("")  # Checkpoint missing triggers
-        self.checkpoint_queue.put(None)  # Stop committer
-        try:
-            self.__commiter.join()
-        except:
-            # fails with: AttributeError: 'Worker' object has no attribute '_Worker__commiter'
-            pass
+        # Stop the main loop, which takes the last checkpoint and stops the committer
+        self.event_queue.put(None)
+        self.join(timeout=30)
         self.__stop_event_sources()
         try:
             self.terminate()
         except Exception:
             pass
+        if isinstance(self.event_queue, SharedMemoryEventQueue):
+            self.event_queue.unlink()
         logging.info("[{}] Worker {} stopped".format(self.workspace, self.worker_id))